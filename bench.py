@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Headless renderer benchmarks for blocks_lib.
+
+Usage:
+    python bench.py
+    python bench.py --frames 200 --connections 1000
+"""
+
+import argparse
+import json
+import os
+import random
+import gc
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import numpy as np
+import pygame
+
+import blocks_lib
+import diagram_file
+from bench_suite import generate_scene
+from blocks_lib import (BG, CURVE_SAMPLES, Block, Connection, LayeredRenderer, cubic_bezier,
+                        cubic_bezier_tangent, curves_to_array, draw_arrowhead, draw_connections,
+                        flatten_segments, SceneIndex, SparkSystem, parse_args, refresh_geometry, scene_index)
+
+
+def blocks_scene():
+    import blocks
+    scene_blocks, connections, _ = blocks.build_scene(parse_args([]))
+    return scene_blocks, connections, (blocks.WIDTH, blocks.HEIGHT)
+
+
+def legacy_draw_connections(surface, connections):
+    """The scalar path: fresh geometry, CURVE_SAMPLES cubic_bezier and draw.line calls per stroke."""
+    curves = []
+    for conn in connections:
+        p0, d0, p3, d3 = conn.endpoints()
+        c1, c2 = conn.controls(p0, d0, p3, d3)
+        curve = (p0, c1, c2, p3)
+        for color, width in (((0, 0, 0), conn.width + 2), (conn.color, conn.width)):
+            prev = p0
+            for i in range(1, CURVE_SAMPLES + 1):
+                pt = cubic_bezier(p0, c1, c2, p3, i / CURVE_SAMPLES)
+                pygame.draw.line(surface, color, prev, pt, width)
+                prev = pt
+        draw_arrowhead(surface, p3, cubic_bezier_tangent(p0, c1, c2, p3, 1.0), conn.color)
+        curves.append(curve)
+    return curves
+
+
+def uncached_draw_connections(surface, connections):
+    """Batched path with every geometry cache dropped, as if all blocks moved."""
+    for conn in connections:
+        conn.invalidate()
+    return draw_connections(surface, connections)
+
+
+def time_frames(draw, surface, connections, frames):
+    """Mean milliseconds per frame for draw(surface, connections)."""
+    draw(surface, connections)  # warm-up
+    start = time.perf_counter()
+    for _ in range(frames):
+        surface.fill(BG)
+        draw(surface, connections)
+    return (time.perf_counter() - start) * 1000.0 / frames
+
+
+def bench_curves(name, connections, size, frames):
+    surface = pygame.Surface(size)
+    legacy = time_frames(legacy_draw_connections, surface, connections, frames)
+    batched = time_frames(uncached_draw_connections, surface, connections, frames)
+    cached = time_frames(draw_connections, surface, connections, frames)
+    print(f"{name:<28} {len(connections):>6} conns  "
+          f"legacy {legacy:8.2f}  batched {batched:8.2f}  cached {cached:8.2f} ms/frame  "
+          f"speedup x{legacy / batched:.1f} / x{legacy / cached:.1f}")
+
+
+def bench_flatten(name, connections, size, frames):
+    """Segments per curve and stroke time: fixed CURVE_SAMPLES vs adaptive flattening."""
+    surface = pygame.Surface(size)
+    refresh_geometry(connections)
+    segments = flatten_segments(curves_to_array([conn.curve() for conn in connections]))
+
+    def fixed(surface, connections):
+        for conn in connections:
+            points = conn.polyline().tolist()
+            pygame.draw.lines(surface, (0, 0, 0), False, points, conn.width + 2)
+            pygame.draw.lines(surface, conn.color, False, points, conn.width)
+
+    def adaptive(surface, connections):
+        for conn in connections:
+            points = conn.stroke()
+            pygame.draw.lines(surface, (0, 0, 0), False, points, conn.width + 2)
+            pygame.draw.lines(surface, conn.color, False, points, conn.width)
+
+    timings = [time_frames(fn, surface, connections, frames) for fn in (fixed, adaptive)]
+    print(f"{name + ' flattening':<28} {len(connections):>6} conns  "
+          f"segments {CURVE_SAMPLES} -> {segments.mean():.1f} mean  "
+          f"strokes {timings[0]:8.2f} -> {timings[1]:8.2f} ms/frame")
+
+
+def bench_drag(connections, block, moves):
+    """Geometry cost per drag step: incident connections only vs everything."""
+    x, y = block.rect.topleft
+
+    def step(i, refresh_all):
+        block.move_to(x + i % 7, y)
+        if refresh_all:
+            for conn in connections:
+                conn.invalidate()
+            refresh_geometry(connections)
+        else:
+            refresh_geometry(block.connections)
+
+    timings = []
+    for refresh_all in (True, False):
+        start = time.perf_counter()
+        for i in range(moves):
+            step(i + 1, refresh_all)
+        timings.append((time.perf_counter() - start) * 1000.0 / moves)
+    full, incident = timings
+    print(f"{'drag one block':<28} {len(connections):>6} conns  "
+          f"degree {len(block.connections):>4}  full {full:8.3f}  incident {incident:8.3f} ms/move")
+
+
+def bench_sparks(connections, frames):
+    """Spark positions per frame: per-spark cubic_bezier loop vs one batched SparkSystem pass."""
+    refresh_geometry(connections)
+    system = SparkSystem(connections, np.random.default_rng(0))
+
+    def legacy(elapsed):
+        out = []
+        for conn in connections:
+            p0, c1, c2, p3 = conn.curve()
+            for i in range(conn.sparks):
+                pt = cubic_bezier(p0, c1, c2, p3, (i / conn.sparks + elapsed * conn.spark_speed) % 1.0)
+                out.append((int(pt.x), int(pt.y)))
+        return out
+
+    def batched(elapsed):
+        system.step(1.0 / 120)
+        return system.positions(elapsed)[0].astype(int)
+
+    timings = []
+    for fn in (legacy, batched):
+        start = time.perf_counter()
+        for i in range(frames):
+            fn(i / 120)
+        timings.append((time.perf_counter() - start) * 1000.0 / frames)
+    print(f"{'spark positions':<28} {len(system):>6} sparks "
+          f"legacy {timings[0]:8.2f}  batched {timings[1]:8.2f} ms/frame  "
+          f"speedup x{timings[0] / timings[1]:.1f}")
+
+
+def bench_picking(blocks, connections, picks, seed=0):
+    """Block and curve picks at random points: linear scan vs SceneIndex."""
+    refresh_geometry(connections)
+    start = time.perf_counter()
+    index = SceneIndex(blocks, connections)
+    build = (time.perf_counter() - start) * 1000.0
+    rng = random.Random(seed)
+    x1 = max(b.rect.right for b in blocks)
+    y1 = max(b.rect.bottom for b in blocks)
+    points = [(rng.uniform(0, x1), rng.uniform(0, y1)) for _ in range(picks)]
+
+    def linear(pos):
+        for block in blocks:
+            if block.contains(pos):
+                return block
+        hits = [(conn.nearest_point(pos)[0] - conn.width / 2, i) for i, conn in enumerate(connections)]
+        dist, i = min(hits)
+        return connections[i] if dist <= blocks_lib.PICK_TOLERANCE else None
+
+    def indexed(pos):
+        return index.pick_block(pos) or index.pick_connection(pos)
+
+    timings = []
+    for fn, n in ((linear, max(1, picks // 20)), (indexed, picks)):
+        start = time.perf_counter()
+        for pos in points[:n]:
+            fn(pos)
+        timings.append((time.perf_counter() - start) * 1000.0 / n)
+    print(f"{'pick block / curve':<28} {len(connections):>6} conns  "
+          f"{len(blocks):>4} blocks  linear {timings[0]:8.3f}  indexed {timings[1]:8.3f} ms/pick  "
+          f"(index built in {build:.1f} ms)")
+
+
+def bench_camera(blocks, connections, frames, size=(1280, 800)):
+    """Frame cost through the camera: culled and level-of-detail views vs drawing everything."""
+    screen = pygame.display.set_mode(size)
+    refresh_geometry(connections)
+    font = pygame.font.SysFont("arial", 18)
+    renderer = LayeredRenderer(screen, blocks, connections, [], font,
+                               SparkSystem(connections, np.random.default_rng(0)))
+    cam = renderer.camera
+    x0, y0, x1, y1 = renderer.content_box()
+    cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+
+    def view(zoom):
+        def setup():
+            cam.zoom = zoom
+            cam.x, cam.y = cx - size[0] / (2 * zoom), cy - size[1] / (2 * zoom)
+        return setup
+
+    def fit():
+        cam.fit((x0, y0, x1, y1))
+
+    def everything():
+        cam.reset()
+        renderer._cull = lambda: None  # the pre-camera path: draw every curve and spark
+
+    cases = (("zoom 1", view(1.0)), ("zoom 0.4", view(0.4)), ("fit (splat)", fit), ("no culling", everything))
+    for name, setup in cases:
+        setup()
+        start = time.perf_counter()
+        renderer.render(0.0, 1.0 / 120)  # rebuild: what one pan/zoom step costs
+        rebuild = (time.perf_counter() - start) * 1000.0
+        n = frames if name != "no culling" else max(1, frames // 10)
+        start = time.perf_counter()
+        for i in range(n):
+            renderer.render(i / 120, 1.0 / 120)
+        frame = (time.perf_counter() - start) * 1000.0 / n
+        shown = len(connections) if renderer._visible is None else int(renderer._visible.sum())
+        print(f"{'camera ' + name:<28} {len(connections):>6} conns  "
+              f"visible {shown:>6}  rebuild {rebuild:8.2f}  frame {frame:8.2f} ms")
+    del renderer._cull
+
+
+def bench_startup(runs=3):
+    """Wall time of fresh interpreters: bare, importing the core, the renderer, and up to the first frame."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    cases = (("python", ["-c", "pass"]),
+             ("import blocks_core", ["-c", "import blocks_core"]),
+             ("import blocks_lib", ["-c", "import blocks_lib"]),
+             ("blocks.py first frame", [os.path.join(here, "blocks.py"), "--offline", "--max-frames", "1"]))
+    for name, argv in cases:
+        best = float("inf")
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, *argv], cwd=here, check=True, stdout=subprocess.DEVNULL)
+            best = min(best, time.perf_counter() - start)
+        print(f"{'startup ' + name:<28} {best * 1000.0:8.1f} ms (best of {runs})")
+
+
+def write_diagram_json(path, n_connections, n_blocks=2000, seed=0):
+    """A synthetic diagram in the blocks_lib.js JSON schema (flat connection keys)."""
+    blocks, connections = generate_scene(n_blocks, n_connections, size=(8000, 5000), seed=seed)
+    ids = {block: f"b{i}" for i, block in enumerate(blocks)}
+    with open(path, "w") as f:
+        json.dump(dict(
+            blocks=[dict(id=ids[b], x=b.rect.x, y=b.rect.y, w=b.rect.w, h=b.rect.h, label=b.label) for b in blocks],
+            edges=[dict(source=ids[c.start_block], start_edge=c.start_edge, start_t=c.start_t,
+                        target=ids[c.end_block], end_edge=c.end_edge, end_t=c.end_t,
+                        color="#%02x%02x%02x" % c.color, width=c.width, sparks=c.sparks,
+                        spark_speed=c.spark_speed) for c in connections],
+        ), f)
+
+
+def bench_diagram_load(n_connections):
+    """Loading a JSON diagram: json.load vs the streaming reader vs the compiled .npz cache."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "diagram.json")
+        write_diagram_json(path, n_connections)
+        size_mb = os.path.getsize(path) / 1e6
+
+        def timed(fn):
+            start = time.perf_counter()
+            result = fn()
+            return result, (time.perf_counter() - start) * 1000.0
+
+        _, full = timed(lambda: json.load(open(path)))
+        data, stream = timed(lambda: diagram_file.read_json(path))
+        cache_dir = os.path.join(tmp, "cache")
+        _, first = timed(lambda: diagram_file.load_diagram(path, cache_dir=cache_dir))
+        data, cached = timed(lambda: diagram_file.load_diagram(path, cache_dir=cache_dir))
+        _, build = timed(lambda: data.build(Block, Connection))
+        print(f"{'diagram load':<28} {n_connections:>6} conns  {size_mb:5.1f} MB  json.load {full:8.1f}  "
+              f"stream {stream:8.1f}  compile {first:8.1f}  cached {cached:6.1f}  build {build:8.1f} ms")
+
+
+def bench_memory(n_connections, size=(1280, 800)):
+    """
+    Python heap per connection (tracemalloc) of a loaded diagram as objects
+    (build) vs columns (build_store), after each stage that allocates per connection.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "diagram.json")
+        write_diagram_json(path, n_connections)
+        data = diagram_file.read_json(path)
+    screen = pygame.display.set_mode(size)
+    font = pygame.font.SysFont("arial", 18)
+    for name, build in (("objects", lambda: data.build(Block, Connection)), ("store", lambda: data.build_store(Block))):
+        gc.collect()
+        tracemalloc.start()
+        stages = []
+
+        def stage(label, fn):
+            result = fn()
+            stages.append((label, tracemalloc.get_traced_memory()[0]))
+            return result
+
+        blocks, connections = stage("build", build)
+        stage("geometry", lambda: refresh_geometry(connections))
+        sparks = stage("sparks", lambda: SparkSystem(connections, np.random.default_rng(0)))
+        renderer = stage("render", lambda: LayeredRenderer(screen, blocks, connections, [], font, sparks))
+        stage("render", lambda: renderer.render(0.0, 1.0 / 120))
+        index = stage("index", lambda: scene_index(blocks, connections))
+        tracemalloc.stop()
+        steps, last = {}, 0
+        for label, used in stages:
+            steps[label] = steps.get(label, 0) + used - last
+            last = used
+        print(f"{'memory ' + name:<28} {n_connections:>6} conns  "
+              + "  ".join(f"{label} {used / n_connections:7.0f}" for label, used in steps.items())
+              + f"  total {last / n_connections:7.0f} B/conn")
+        del blocks, connections, sparks, renderer, index
+
+
+def main():
+    p = argparse.ArgumentParser(description="blocks_lib renderer benchmarks")
+    p.add_argument("--frames", type=int, default=100, help="Frames timed per case (default 100)")
+    p.add_argument("--connections", type=int, default=1000,
+                   help="Connections in the synthetic scene (default 1000)")
+    p.add_argument("--seed", type=int, default=0, help="Seed for the synthetic scene")
+    args = p.parse_args()
+
+    pygame.init()
+    print(f"pygame {pygame.version.ver}, CURVE_SAMPLES={blocks_lib.CURVE_SAMPLES}")
+    bench_startup()
+    random.seed(args.seed)
+    _, connections, size = blocks_scene()
+    bench_curves("blocks.py scene", connections, size, args.frames)
+    bench_flatten("blocks.py scene", connections, size, args.frames)
+    _, connections = generate_scene(40, args.connections, size=(1600, 1000), seed=args.seed)
+    bench_curves("synthetic scene", connections, (1600, 1000), args.frames)
+    bench_flatten("synthetic scene", connections, (1600, 1000), args.frames)
+    scene_blocks, connections = generate_scene(400, 10000, size=(1600, 1000), seed=args.seed)
+    bench_drag(connections, scene_blocks[0], args.frames)
+    bench_sparks(connections, min(args.frames, 20))
+    scene_blocks, connections = generate_scene(2000, 4000, size=(8000, 5000), seed=args.seed)
+    bench_picking(scene_blocks, connections, 20 * args.frames, seed=args.seed)
+    scene_blocks, connections = generate_scene(5000, 50000, size=(40000, 25000),
+                                                seed=args.seed, reach=2)
+    bench_camera(scene_blocks, connections, min(args.frames, 20))
+    bench_diagram_load(100000)
+    bench_memory(20000)
+    pygame.quit()
+
+
+if __name__ == "__main__":
+    main()
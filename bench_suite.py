@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+End-to-end renderer benchmark suite for blocks_lib.
+
+Generates parameterized diagrams (blocks, connections, sparks per connection,
+classic or emitter sparks, layout density), renders each one headlessly for a
+fixed number of frames through run_main_loop (--offline, nothing saved) and
+reports frames/sec, ms/frame percentiles, per-phase medians and peak RSS as
+JSON. Each case runs in a fresh process so peak RSS is per case.
+
+Usage:
+    python bench_suite.py                          # default suite, JSON on stdout
+    python bench_suite.py --json bench_baseline.json
+    python bench_suite.py --baseline bench_baseline.json --threshold 0.1
+    python bench_suite.py --blocks 100 --connections 2000 --sparks 5 --emitter
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import numpy as np
+import pygame
+
+from blocks_core import EDGES
+from blocks_lib import Block, Connection, create_conn_kwargs, init_screen, parse_args, run_main_loop
+from frame_profiler import PHASES, FrameProfiler
+from input_log import drag_session
+
+try:
+    import resource
+except ImportError:  # Windows: no peak RSS
+    resource = None
+
+SIZE = (1280, 800)
+
+# name, blocks, connections, sparks per connection, emitter mode, density
+SUITE = (
+    dict(name="blocks.py", scene="blocks"),
+    dict(name="small", blocks=20, connections=100, sparks=3, emitter=False, density=0.3),
+    dict(name="medium", blocks=60, connections=1000, sparks=3, emitter=False, density=0.3),
+    dict(name="medium emitter", blocks=60, connections=1000, sparks=3, emitter=True, density=0.3),
+    dict(name="dense", blocks=200, connections=1000, sparks=3, emitter=False, density=0.7),
+    dict(name="spark heavy", blocks=40, connections=500, sparks=20, emitter=False, density=0.3),
+    dict(name="large", blocks=400, connections=5000, sparks=3, emitter=False, density=0.3),
+    dict(name="hub drag", blocks=60, connections=1000, sparks=3, emitter=False, density=0.3, drag=True),
+)
+DRAG_RADIUS = 80  # px; "drag" cases move the busiest block around a circle of this radius
+
+
+def generate_scene(n_blocks, n_connections, sparks=3, density=0.3, size=SIZE, seed=0, reach=None, **conn_kwargs):
+    """
+    Random diagram filling size: n_blocks on a grid, each covering about
+    `density` of its cell, and n_connections random curves between them.
+    With reach, each curve ends at most reach grid cells away from its start.
+    Returns (blocks, connections).
+    """
+    rng = random.Random(seed)
+    w, h = size
+    cols = max(1, int(round((n_blocks * w / h) ** 0.5)))
+    rows = (n_blocks + cols - 1) // cols
+    cell_w, cell_h = w / cols, h / rows
+    side = math.sqrt(min(1.0, max(0.01, density)))
+    blocks = []
+    for i in range(n_blocks):
+        bw, bh = max(8, int(cell_w * side)), max(8, int(cell_h * side))
+        x = int((i % cols) * cell_w + (cell_w - bw) / 2)
+        y = int((i // cols) * cell_h + (cell_h - bh) / 2)
+        blocks.append(Block(x, y, bw, bh, f"B{i}"))
+    connections = []
+    for _ in range(n_connections):
+        if reach and n_blocks > 1:
+            i = rng.randrange(n_blocks)
+            col = min(cols - 1, max(0, i % cols + rng.randint(-reach, reach)))
+            row = min(rows - 1, max(0, i // cols + rng.randint(-reach, reach)))
+            j = min(n_blocks - 1, row * cols + col)
+            s, e = blocks[i], blocks[j if j != i else (i + 1) % n_blocks]
+        else:
+            s, e = rng.sample(blocks, 2) if n_blocks > 1 else (blocks[0], blocks[0])
+        connections.append(Connection((s, rng.choice(EDGES), rng.uniform(-0.5, 0.5)),
+                                      (e, rng.choice(EDGES), rng.uniform(-0.5, 0.5)),
+                                      color=(rng.randrange(80, 255), rng.randrange(80, 255), rng.randrange(80, 255)),
+                                      width=3, sparks=sparks, spark_speed=rng.uniform(0.5, 1.0), **conn_kwargs))
+    return blocks, connections
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def hub_drag(blocks, frames, fps, size, seed):
+    """Input log dragging the block with the most connections around a circle, one move per frame."""
+    hub = max(blocks, key=lambda block: len(block.connections))
+    cx, cy = hub.rect.center
+    path = [(cx + DRAG_RADIUS * math.sin(2 * math.pi * k / frames),
+             cy + DRAG_RADIUS * (1 - math.cos(2 * math.pi * k / frames))) for k in range(1, frames + 1)]
+    return drag_session((cx, cy), path, fps, size, seed=seed)
+
+
+def run_case(case, frames, seed, fps):
+    """
+    Render one case through run_main_loop; returns its result dict (runs in a
+    child process). Drag cases replay a synthetic drag (--replay-input)
+    instead of rendering offline.
+    """
+    log_path = None
+    if case.get("drag"):
+        log_path = os.path.join(tempfile.mkdtemp(), "drag.jsonl")
+        argv = ["--replay-input", log_path, "--seed", str(seed), "--fps", str(fps)]
+    else:
+        argv = ["--offline", "--max-frames", str(frames), "--seed", str(seed), "--fps", str(fps)]
+    if case.get("emitter"):
+        argv.append("--random-spark-starts")
+    args = parse_args(argv)
+    if case.get("scene") == "blocks":
+        import blocks
+        screen = init_screen(args, (blocks.WIDTH, blocks.HEIGHT))
+        scene_blocks, connections, notes = blocks.build_scene(args)
+    else:
+        screen = init_screen(args, SIZE)
+        scene_blocks, connections = generate_scene(case["blocks"], case["connections"], case["sparks"],
+                                                   case["density"], SIZE, seed, **create_conn_kwargs(args))
+        notes = []
+    if log_path:
+        hub_drag(scene_blocks, frames, fps, SIZE, seed).save(log_path)
+    profiler = FrameProfiler(keep=2 * frames)
+    with contextlib.redirect_stdout(io.StringIO()):
+        replay = run_main_loop(screen, scene_blocks, connections, notes, args, profiler=profiler)
+    if log_path:
+        os.remove(log_path)
+        os.rmdir(os.path.dirname(log_path))
+
+    records = list(profiler.frames)
+    ms = profiler.phase_ms(records)
+    # The first frame builds the cached layers; report it apart from the steady state
+    steady = ms["frame"][1:] if len(records) > 1 else ms["frame"]
+    counts = [record[3] for record in records]
+    return dict(
+        case,
+        blocks=len(scene_blocks),
+        connections=len(connections),
+        frames=len(records),
+        fps=round(1000.0 / float(steady.mean()), 1),
+        first_ms=round(float(ms["frame"][0]), 3),
+        ms={name: round(float(value), 3) for name, value in
+            zip(("mean", "p50", "p95", "p99", "max"),
+                (steady.mean(), *np.percentile(steady, (50, 95, 99)), steady.max()))},
+        phases_p50={phase: round(float(np.median(ms[phase][1:] if len(records) > 1 else ms[phase])), 3)
+                    for phase in PHASES},
+        live_sparks=round(float(np.mean([c.get("live_sparks", 0) for c in counts])), 1),
+        draw_calls=round(float(np.mean([c.get("draw_calls", 0) for c in counts])), 1),
+        peak_rss_mb=peak_rss_mb(),
+        **(dict(interaction_ms=replay["interaction"]) if replay else {}),
+    )
+
+
+def run_suite(cases, frames, seed, fps):
+    results = []
+    spawn = multiprocessing.get_context("spawn")
+    for case in cases:
+        with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+            result = pool.submit(run_case, case, frames, seed, fps).result()
+        results.append(result)
+        print(f"{result['name']:<16} {result['blocks']:>5} blocks {result['connections']:>6} conns  "
+              f"{result['fps']:8.1f} fps  p50 {result['ms']['p50']:7.2f}  p95 {result['ms']['p95']:7.2f}  "
+              f"p99 {result['ms']['p99']:7.2f} ms  rss {result['peak_rss_mb']} MB", file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print fps and p95 against the baseline; returns the names of cases that regressed."""
+    before = {case["name"]: case for case in baseline["cases"]}
+    regressed = []
+    print(f"\n{'case':<16} {'fps':>9} {'baseline':>9} {'change':>8}   {'p95 ms':>8} {'baseline':>9}",
+          file=sys.stderr)
+    for case in results:
+        old = before.get(case["name"])
+        if old is None:
+            print(f"{case['name']:<16} {case['fps']:9.1f}  (not in baseline)", file=sys.stderr)
+            continue
+        change = case["fps"] / old["fps"] - 1.0
+        flag = ""
+        if change < -threshold:
+            flag = "  REGRESSION"
+            regressed.append(case["name"])
+        print(f"{case['name']:<16} {case['fps']:9.1f} {old['fps']:9.1f} {change:+8.1%}   "
+              f"{case['ms']['p95']:8.2f} {old['ms']['p95']:9.2f}{flag}", file=sys.stderr)
+    return regressed
+
+
+def main():
+    p = argparse.ArgumentParser(description="blocks_lib end-to-end renderer benchmark suite")
+    p.add_argument("--frames", type=int, default=300, help="Frames rendered per case (default 300)")
+    p.add_argument("--fps", type=float, default=120, help="Simulated frame rate (default 120)")
+    p.add_argument("--seed", type=int, default=0, help="Seed for the scenes and sparks")
+    p.add_argument("--json", default=None, help="Write the results to this file instead of stdout")
+    p.add_argument("--baseline", default=None, help="Compare against results saved with --json")
+    p.add_argument("--threshold", type=float, default=0.1,
+                   help="fps drop vs the baseline that counts as a regression (default 0.1 = 10%%)")
+    custom = p.add_argument_group("single custom case (replaces the default suite)")
+    custom.add_argument("--blocks", type=int, default=None, help="Number of blocks")
+    custom.add_argument("--connections", type=int, default=1000, help="Number of connections (default 1000)")
+    custom.add_argument("--sparks", type=int, default=3, help="Sparks per connection (default 3)")
+    custom.add_argument("--emitter", action="store_true", help="Emitter mode sparks")
+    custom.add_argument("--density", type=float, default=0.3,
+                        help="Fraction of each grid cell covered by its block (default 0.3)")
+    args = p.parse_args()
+
+    cases = SUITE
+    if args.blocks is not None:
+        cases = [dict(name="custom", blocks=args.blocks, connections=args.connections, sparks=args.sparks,
+                      emitter=args.emitter, density=args.density)]
+    results = run_suite(cases, args.frames, args.seed, args.fps)
+    report = dict(
+        python=platform.python_version(),
+        pygame=pygame.version.ver,
+        numpy=np.__version__,
+        platform=platform.platform(),
+        cpus=os.cpu_count(),
+        frames=args.frames,
+        fps=args.fps,
+        seed=args.seed,
+        cases=results,
+    )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.json}", file=sys.stderr)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        if not os.path.exists(args.baseline):
+            print(f"No baseline at {args.baseline}; save one with --json {args.baseline}", file=sys.stderr)
+            return
+        with open(args.baseline) as f:
+            regressed = compare(results, json.load(f), args.threshold)
+        if regressed:
+            print(f"Regressed by more than {args.threshold:.0%}: {', '.join(regressed)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
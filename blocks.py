@@ -1,4 +1,3 @@
-import pygame
 import random
 from blocks_lib import *
 
@@ -30,11 +29,8 @@ COGNITIVE_COLOR2 = (233, 30, 99)
 COGNITIVE_COLOR1 = (240, 98, 146)
 
 
-def main():
-    args = parse_args()
-    pygame.init()
-    screen = pygame.display.set_mode((WIDTH, HEIGHT))
-
+def build_scene(args):
+    """Build the thalamus/cortex scene; returns (blocks, connections, notes)."""
     # Blocks
     a = Block(460, 50, 400, 200, "Thalamus")
     b = Block(330, 360, 100, 400, "Cortex")
@@ -80,8 +76,17 @@ def main():
                 connections.append(Connection((b, "left", 0.4 - (area + t/26)), (movement, "bottom", -0.33), color=MOTOR_AREA_COLOR2, width=3, sparks=3, spark_speed=0.7 + random.random()/4, **create_conn_kwargs(args)))
                 connections.append(Connection((b, "left", 0.4 - (area + t/26)), (movement, "bottom", 0.33), color=MOTOR_AREA_COLOR2, width=3, sparks=3, spark_speed=0.7 + random.random()/4, **create_conn_kwargs(args)))
 
+    return blocks, connections, notes
+
+
+def main():
+    args = parse_args()
+    screen = init_screen(args, (WIDTH, HEIGHT))
+    blocks, connections, notes = build_scene(args)
+
     # Run the main loop
-    run_main_loop(screen, blocks, connections, notes, args, "Mermaid-like Blocks with Curved Arrows (offsets + sparks)")
+    run_main_loop(screen, blocks, connections, notes, args, "Mermaid-like Blocks with Curved Arrows (offsets + sparks)",
+                  build_scene=build_scene)
 
 
 if __name__ == "__main__":
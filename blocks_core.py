@@ -0,0 +1,1037 @@
+"""
+Geometry core of blocks_lib: layout, curves, sparks and picking, without pygame.
+
+Blocks, anchors, Bezier evaluation and flattening, arc-length tables, spark
+state, the spatial index, the camera transform and the frame governor only
+need NumPy, so batch tooling, layout checks and tests can import this module
+without loading pygame or scanning system fonts. blocks_lib subclasses Block
+and Connection with the drawing code and re-exports everything here. The
+batch helpers (refresh_geometry, invalidate_connections, scene_index,
+SparkSystem) also take the columnar connections of diagram_store.
+
+Vec2 and Rect stand in for pygame.Vector2 and pygame.Rect with the same
+arithmetic and integer semantics; pygame accepts both wherever it takes a
+point or a rect.
+"""
+
+import math
+from itertools import chain
+from operator import itemgetter
+
+import numpy as np
+
+__all__ = [
+    # Layout and drawing constants
+    "ARROW_COLOR", "ARROW_HEAD_ANGLE", "ARROW_HEAD_LEN", "CONTROL_PUSH_MAX", "CONTROL_PUSH_RATIO", "CURVE_SAMPLES",
+    "EDGES", "EDGE_DIRS", "EDGE_VECTORS", "EVENT_SPARK_SPEED", "FLATTEN_TOLERANCE", "FLATTEN_TOLERANCE_MAX",
+    "MAX_SEGMENTS", "PICK_CHUNK", "PICK_TOLERANCE", "SPATIAL_CELL", "ZOOM_MAX", "ZOOM_MIN", "BEZIER_BASIS",
+    # Scene
+    "Vec2", "Rect", "Block", "Connection", "brighten",
+    # Curves
+    "cubic_bezier", "cubic_bezier_tangent", "bernstein_basis", "curves_to_array", "bezier_polylines",
+    "arc_length_tables", "resample_uniform", "arc_lerp", "project_on_polyline", "flatten_segments",
+    "flatten_curves", "arrowhead_points", "arrowheads", "nice_controls", "nice_controls_array", "anchor_points",
+    # Batch geometry, picking, sparks and view
+    "invalidate_connections", "refresh_geometry", "refresh_strokes", "SpatialGrid", "SceneIndex", "scene_index",
+    "SparkSystem", "Camera", "FrameGovernor",
+]
+
+ARROW_COLOR = (230, 235, 240)
+
+CONTROL_PUSH_MAX = 320
+CONTROL_PUSH_RATIO = 0.42  # fraction of start->end distance (clamped by max)
+
+ARROW_HEAD_LEN = 14
+ARROW_HEAD_ANGLE = math.radians(25)
+CURVE_SAMPLES = 48  # segments of the sampled curve behind arc-length tables and hit-tests
+FLATTEN_TOLERANCE = 0.5  # px; max distance between a drawn curve and its polyline
+FLATTEN_TOLERANCE_MAX = 4.0  # loosest tolerance the frame governor may reach
+MAX_SEGMENTS = 128  # cap on segments of one flattened curve
+
+SPATIAL_CELL = 128  # px per cell of the picking grid
+PICK_TOLERANCE = 6  # px around a curve that still picks it
+PICK_CHUNK = 8  # polyline segments per indexed piece of a curve
+
+EVENT_SPARK_SPEED = 0.6  # loops/s of event sparks on connections without a spark speed
+
+# Camera zoom range
+ZOOM_MIN, ZOOM_MAX = 0.02, 8.0
+
+
+class Vec2(tuple):
+    """
+    Immutable 2D point/vector with the pygame.Vector2 operations the geometry
+    uses. A tuple, so NumPy and pygame take it as a plain (x, y) pair.
+    """
+    __slots__ = ()
+
+    def __new__(cls, x=0.0, y=0.0):
+        return tuple.__new__(cls, (float(x), float(y)))
+
+    x = property(itemgetter(0))
+    y = property(itemgetter(1))
+
+    def __add__(self, other):
+        return _vec(Vec2, (self[0] + other[0], self[1] + other[1]))
+
+    def __sub__(self, other):
+        return _vec(Vec2, (self[0] - other[0], self[1] - other[1]))
+
+    def __rsub__(self, other):
+        return _vec(Vec2, (other[0] - self[0], other[1] - self[1]))
+
+    def __mul__(self, k):
+        return _vec(Vec2, (self[0] * k, self[1] * k))
+
+    __rmul__ = __mul__
+
+    def __neg__(self):
+        return _vec(Vec2, (-self[0], -self[1]))
+
+    def __repr__(self):
+        return f"Vec2({self[0]:g}, {self[1]:g})"
+
+    def length(self):
+        x, y = self
+        return math.sqrt(x * x + y * y)
+
+    def normalize(self):
+        n = self.length()
+        if n == 0:
+            raise ValueError("Can't normalize Vector of length Zero")
+        return _vec(Vec2, (self[0] / n, self[1] / n))
+
+
+_vec = tuple.__new__  # Vec2 from a pair of floats, skipping the conversions in __new__
+EDGE_DIRS = {"top": Vec2(0, -1), "right": Vec2(1, 0), "bottom": Vec2(0, 1), "left": Vec2(-1, 0)}
+EDGES = ("top", "right", "bottom", "left")  # edge codes of the columnar formats (diagram_file, diagram_store)
+EDGE_VECTORS = np.array([EDGE_DIRS[edge] for edge in EDGES])  # (4, 2), indexed by edge code
+
+
+class Rect:
+    """
+    Integer rectangle with the pygame.Rect attributes the layout uses.
+    Like pygame.Rect, the constructor truncates; assign integers to x and y.
+    """
+    __slots__ = ("x", "y", "w", "h")
+
+    def __init__(self, x, y, w, h):
+        self.x, self.y, self.w, self.h = int(x), int(y), int(w), int(h)
+
+    left = property(lambda self: self.x)
+    top = property(lambda self: self.y)
+    width = property(lambda self: self.w)
+    height = property(lambda self: self.h)
+    right = property(lambda self: self.x + self.w)
+    bottom = property(lambda self: self.y + self.h)
+    centerx = property(lambda self: self.x + self.w // 2)
+    centery = property(lambda self: self.y + self.h // 2)
+    center = property(lambda self: (self.centerx, self.centery))
+    topleft = property(lambda self: (self.x, self.y))
+    size = property(lambda self: (self.w, self.h))
+
+    def collidepoint(self, *pos):
+        x, y = pos[0] if len(pos) == 1 else pos
+        return self.x <= x < self.x + self.w and self.y <= y < self.y + self.h
+
+    def __len__(self):
+        return 4
+
+    def __getitem__(self, i):
+        return (self.x, self.y, self.w, self.h)[i]
+
+    def __iter__(self):
+        return iter((self.x, self.y, self.w, self.h))
+
+    def __eq__(self, other):
+        try:
+            return tuple(self) == tuple(other)
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return f"<rect({self.x}, {self.y}, {self.w}, {self.h})>"
+
+
+class Block:
+    """
+    Rectangle with a label that connections anchor to. Geometry only:
+    blocks_lib.Block adds the rendered surface.
+    """
+    __slots__ = ("rect", "label", "dragging", "drag_offset", "alpha", "version", "connections")
+
+    def __init__(self, x, y, w, h, label, alpha=255):
+        self.rect = Rect(x, y, w, h)
+        self.label = label  # supports \n or <br/> for multi-line
+        self.dragging = False
+        self.drag_offset = (0, 0)
+        # Per-block transparency (0 fully transparent, 255 fully opaque)
+        self.alpha = max(0, min(255, int(alpha)))
+        # Bumped on every move; connections attached below cache against it
+        self.version = 0
+        self.connections = []  # incident connections (block -> connections index)
+
+    def contains(self, pos):
+        return self.rect.collidepoint(pos)
+
+    def start_drag(self, pos):
+        self.dragging = True
+        self.drag_offset = (pos[0] - self.rect.x, pos[1] - self.rect.y)
+
+    def move_to(self, x, y):
+        """Move the block and invalidate the geometry of its incident connections only."""
+        if (x, y) == (self.rect.x, self.rect.y):
+            return
+        self.rect.x = x
+        self.rect.y = y
+        self.version += 1
+        invalidate_connections(self.connections)
+
+    def drag(self, pos):
+        if self.dragging:
+            self.move_to(round(pos[0] - self.drag_offset[0]), round(pos[1] - self.drag_offset[1]))
+
+    def stop_drag(self):
+        self.dragging = False
+
+    def edge_dir(self, edge_name):
+        d = EDGE_DIRS.get(edge_name)
+        if d is None:
+            raise ValueError("Invalid edge name")
+        return d
+
+    def anchor_point_with_offset(self, edge_name, t):
+        """
+        Return a point on the given edge, offset by t in [-0.5, 0.5] from the center
+        along the edge direction (t=0 center; +/-0.5 near corners).
+        """
+        t = max(-0.5, min(0.5, float(t)))  # clamp
+        r = self.rect
+        if edge_name in ("top", "bottom"):
+            x = r.x + r.w // 2 + r.w * t
+            y = r.y if edge_name == "top" else r.y + r.h
+            return _vec(Vec2, (x, float(y)))
+        elif edge_name in ("left", "right"):
+            x = r.x if edge_name == "left" else r.x + r.w
+            y = r.y + r.h // 2 + r.h * t
+            return _vec(Vec2, (float(x), y))
+        else:
+            raise ValueError("Invalid edge name")
+
+
+def cubic_bezier(p0, p1, p2, p3, t):
+    u = 1 - t
+    return (u**3) * p0 + 3 * (u**2) * t * p1 + 3 * u * (t**2) * p2 + (t**3) * p3
+
+
+def cubic_bezier_tangent(p0, p1, p2, p3, t):
+    u = 1 - t
+    return 3 * ((p1 - p0) * (u**2) + 2 * (p2 - p1) * u * t + (p3 - p2) * (t**2))
+
+
+def bernstein_basis(samples=CURVE_SAMPLES):
+    """
+    Return the (samples + 1, 4) cubic Bernstein matrix for t = 0, 1/samples, ..., 1.
+    Multiplying it with a (4, 2) array of control points samples the curve.
+    """
+    t = np.linspace(0.0, 1.0, samples + 1)
+    u = 1.0 - t
+    return np.stack([u**3, 3 * u**2 * t, 3 * u * t**2, t**3], axis=1)
+
+
+BEZIER_BASIS = bernstein_basis(CURVE_SAMPLES)
+_basis_cache = {CURVE_SAMPLES: BEZIER_BASIS}
+
+
+def _basis(samples):
+    basis = _basis_cache.get(samples)
+    if basis is None:
+        basis = _basis_cache[samples] = bernstein_basis(samples)
+    return basis
+
+
+def curves_to_array(curves):
+    """Stack (p0, c1, c2, p3) tuples of points into an (N, 4, 2) float array."""
+    flat = chain.from_iterable(chain.from_iterable(curves))
+    return np.fromiter(flat, dtype=float, count=8 * len(curves)).reshape(-1, 4, 2)
+
+
+def bezier_polylines(controls, samples=CURVE_SAMPLES):
+    """
+    Sample every curve at once: (N, 4, 2) control points -> (N, samples + 1, 2) polylines.
+    The whole batch is a single matrix multiply against the cached Bernstein basis.
+    """
+    return np.matmul(_basis(samples), controls)
+
+
+def arc_length_tables(polylines):
+    """
+    Arc-length lookup tables for (N, K, 2) polylines: returns (cum, total) where
+    cum is (N, K), the length from the start to each vertex normalized to [0, 1],
+    and total is (N,) in pixels. Degenerate curves get a uniform table.
+    """
+    seg = np.hypot(*np.moveaxis(np.diff(polylines, axis=1), -1, 0))
+    cum = np.zeros(polylines.shape[:2])
+    np.cumsum(seg, axis=1, out=cum[:, 1:])
+    total = cum[:, -1].copy()
+    flat = total <= 1e-9
+    cum[~flat] /= total[~flat, None]
+    cum[flat] = np.linspace(0.0, 1.0, polylines.shape[1])
+    return cum, total
+
+
+def resample_uniform(polylines, cum, count=CURVE_SAMPLES + 1):
+    """
+    Resample (N, K, 2) polylines at `count` equally spaced arc-length fractions,
+    given their normalized tables `cum` (N, K). One searchsorted covers every
+    curve: row r of the tables is offset by 2 * r so the concatenation stays sorted.
+    """
+    n, k = cum.shape
+    rows = np.arange(n)[:, None]
+    u = np.linspace(0.0, 1.0, count)
+    keys = (cum + 2.0 * rows).ravel()
+    target = u + 2.0 * rows
+    seg = np.searchsorted(keys, target.ravel(), side="right").reshape(n, count) - 1
+    seg = np.clip(seg - rows * k, 0, k - 2)
+    c0 = cum[rows, seg]
+    span = cum[rows, seg + 1] - c0
+    frac = np.where(span > 0, (u - c0) / np.where(span > 0, span, 1.0), 0.0)
+    a = polylines[rows, seg]
+    b = polylines[rows, seg + 1]
+    return a + (b - a) * frac[..., None]
+
+
+def arc_lerp(tables, rows, s):
+    """
+    Points at arc-length fractions s on tables[rows], where tables (N, count, 2)
+    come from resample_uniform(). Constant time per query: no search, one lerp.
+    """
+    x = np.clip(s, 0.0, 1.0) * (tables.shape[1] - 1)
+    i = np.minimum(x.astype(np.intp), tables.shape[1] - 2)
+    f = (x - i)[..., None]
+    a = tables[rows, i]
+    return a + (tables[rows, i + 1] - a) * f
+
+
+def project_on_polyline(pts, pos):
+    """
+    Project pos onto every segment of pts (M, 2).
+    Returns (squared distances, segment parameters u, projected points).
+    """
+    a = pts[:-1]
+    d = pts[1:] - a
+    p = np.asarray(pos, dtype=float)
+    dd = (d * d).sum(axis=1)
+    u = np.clip(((p - a) * d).sum(axis=1) / np.where(dd > 0, dd, 1.0), 0.0, 1.0)
+    proj = a + d * u[:, None]
+    return ((proj - p) ** 2).sum(axis=1), u, proj
+
+
+def flatten_segments(controls, tolerance=FLATTEN_TOLERANCE):
+    """
+    Segments each (N, 4, 2) cubic needs so that its polyline stays within
+    tolerance px of the curve (Wang's formula):
+    n = ceil(sqrt(3/4 * max(|p0 - 2 p1 + p2|, |p1 - 2 p2 + p3|) / tolerance)).
+    Straight curves get 1 segment; the count grows with length and curvature.
+    """
+    d2 = np.diff(controls, n=2, axis=1)  # (N, 2, 2) second differences
+    m = np.hypot(d2[..., 0], d2[..., 1]).max(axis=1)
+    n = np.ceil(np.sqrt(0.75 * m / tolerance))
+    return np.clip(n, 1, MAX_SEGMENTS).astype(int)
+
+
+def flatten_curves(controls, tolerance=FLATTEN_TOLERANCE, dtype=float):
+    """
+    Adaptive polylines for (N, 4, 2) control points: a list of (n_i + 1, 2) arrays
+    of dtype. Curves are grouped by segment count, one basis matmul per group.
+    """
+    counts = flatten_segments(controls, tolerance)
+    polylines = [None] * len(counts)
+    for n in np.unique(counts).tolist():
+        rows = np.flatnonzero(counts == n)
+        for i, pts in zip(rows.tolist(), np.matmul(_basis(n), controls[rows]).astype(dtype, copy=False)):
+            polylines[i] = pts
+    return polylines
+
+
+def arrowhead_points(tip, direction):
+    """Triangle (tip, left, right) for an arrowhead along direction, or None if degenerate."""
+    if direction.length() == 0:
+        return None
+    d = direction.normalize()
+    left = Vec2(
+        d.x * math.cos(ARROW_HEAD_ANGLE) - d.y * math.sin(ARROW_HEAD_ANGLE),
+        d.x * math.sin(ARROW_HEAD_ANGLE) + d.y * math.cos(ARROW_HEAD_ANGLE),
+    )
+    right = Vec2(
+        d.x * math.cos(-ARROW_HEAD_ANGLE) - d.y * math.sin(-ARROW_HEAD_ANGLE),
+        d.x * math.sin(-ARROW_HEAD_ANGLE) + d.y * math.cos(-ARROW_HEAD_ANGLE),
+    )
+    p1 = tip
+    p2 = tip - left * ARROW_HEAD_LEN
+    p3 = tip - right * ARROW_HEAD_LEN
+    return (p1, p2, p3)
+
+
+def nice_controls(p_start, dir_start, p_end, dir_end):
+    (sx, sy), (ex, ey) = p_start, p_end
+    dx, dy = ex - sx, ey - sy
+    span = math.sqrt(dx * dx + dy * dy)
+    push = min(CONTROL_PUSH_MAX, span * CONTROL_PUSH_RATIO)
+    c1 = _vec(Vec2, (sx + dir_start[0] * push, sy + dir_start[1] * push))
+    # dir_end should be INTO the end block
+    c2 = _vec(Vec2, (ex - dir_end[0] * push, ey - dir_end[1] * push))
+    return c1, c2
+
+
+def anchor_points(rects, edges, t):
+    """
+    Block.anchor_point_with_offset for many anchors at once: (N, 4) x, y, w, h
+    integer rects, (N,) codes into EDGES and (N,) offsets -> (N, 2) points.
+    """
+    x, y, w, h = rects.astype(np.int64).T
+    t = np.clip(t, -0.5, 0.5)
+    vertical = (edges == 0) | (edges == 2)  # top / bottom: the offset runs along x
+    px = np.where(vertical, x + w // 2 + w * t, np.where(edges == 3, x, x + w))
+    py = np.where(vertical, np.where(edges == 0, y, y + h), y + h // 2 + h * t)
+    return np.stack([px, py], axis=1).astype(float)
+
+
+def nice_controls_array(p_start, dir_start, p_end, dir_end):
+    """nice_controls for (N, 2) arrays of points and directions; returns (c1, c2)."""
+    d = p_end - p_start
+    span = np.sqrt(d[:, 0] * d[:, 0] + d[:, 1] * d[:, 1])
+    push = np.minimum(CONTROL_PUSH_MAX, span * CONTROL_PUSH_RATIO)[:, None]
+    return p_start + dir_start * push, p_end - dir_end * push
+
+
+def arrowheads(controls):
+    """
+    arrowhead_points for (N, 4, 2) curves at once: (N, 3, 2) triangles (tip,
+    left, right) and a mask of the curves that have one (non-zero end tangent).
+    """
+    tip = controls[:, 3]
+    tangent = 3 * (tip - controls[:, 2])  # cubic_bezier_tangent at t = 1
+    n = np.hypot(tangent[:, 0], tangent[:, 1])
+    ok = n > 0
+    dx, dy = (tangent / np.where(ok, n, 1.0)[:, None]).T
+    cos, sin = math.cos(ARROW_HEAD_ANGLE), math.sin(ARROW_HEAD_ANGLE)
+    left = np.stack([dx * cos - dy * sin, dx * sin + dy * cos], axis=1)
+    right = np.stack([dx * cos + dy * sin, -dx * sin + dy * cos], axis=1)
+    return np.stack([tip, tip - left * ARROW_HEAD_LEN, tip - right * ARROW_HEAD_LEN], axis=1), ok
+
+
+def brighten(rgb, delta=25):
+    r = min(255, rgb[0] + delta)
+    g = min(255, rgb[1] + delta)
+    b = min(255, rgb[2] + delta)
+    return (r, g, b)
+
+
+class Connection:
+    """
+    Curved arrow with optional animated 'sparks' moving from start -> end.
+    - start: (block, edge, offset [-0.5..0.5])
+    - end:   (block, edge, offset [-0.5..0.5])
+    - color: line color
+    - width: line width in px
+    - sparks: int, number of moving dots (0 disables)
+    - spark_speed: float, loops per second; sparks move at constant pixel speed
+      (spark_speed * curve length px/s) thanks to the arc-length table
+    - spark_color: optional color; default is slightly brighter than 'color'
+
+    Geometry and caches only; blocks_lib.Connection adds draw().
+    """
+    __slots__ = ("start_block", "start_edge", "start_t", "end_block", "end_edge", "end_t", "color", "width",
+                 "sparks", "spark_speed", "spark_color", "use_emitter", "emit_mult", "max_live_sparks",
+                 "_curve", "_polyline", "_stroke", "_arrow", "_arc")
+
+    def __init__(
+        self,
+        start,
+        end,
+        color=ARROW_COLOR,
+        width=3,
+        sparks=0,
+        spark_speed=0.6,
+        spark_color=None,
+        use_emitter=False,
+        emit_mult=1.0,
+        max_live_sparks=0,
+    ):
+        self.start_block, self.start_edge, self.start_t = start
+        self.end_block, self.end_edge, self.end_t = end
+        self.color = color
+        self.width = width
+        self.sparks = int(max(0, sparks))
+        self.spark_speed = float(max(0.0, spark_speed))
+        self.spark_color = spark_color if spark_color else brighten(color, 30)
+        # Spark modes
+        self.use_emitter = bool(use_emitter)
+        self.emit_mult = float(emit_mult)
+        self.max_live_sparks = int(max_live_sparks)
+        # Cached geometry, dropped by invalidate() when either block moves
+        self._curve = None      # (p0, c1, c2, p3)
+        self._polyline = None   # (CURVE_SAMPLES + 1, 2) array
+        self._stroke = None     # (tolerance, flattened polyline, as a list for pygame)
+        self._arrow = None      # arrowhead triangle
+        self._arc = None        # (cum, total, uniform) arc-length lookup table
+        self.start_block.connections.append(self)
+        if self.end_block is not self.start_block:
+            self.end_block.connections.append(self)
+
+    def endpoints(self):
+        p0 = self.start_block.anchor_point_with_offset(self.start_edge, self.start_t)
+        d0 = self.start_block.edge_dir(self.start_edge)
+        p3 = self.end_block.anchor_point_with_offset(self.end_edge, self.end_t)
+        d3 = -self.end_block.edge_dir(self.end_edge)  # into the block
+        return p0, d0, p3, d3
+
+    def controls(self, p0, d0, p3, d3):
+        return nice_controls(p0, d0, p3, d3)
+
+    def invalidate(self):
+        self._curve = self._polyline = self._stroke = self._arrow = self._arc = None
+
+    def curve(self):
+        if self._curve is None:
+            p0, d0, p3, d3 = self.endpoints()
+            c1, c2 = self.controls(p0, d0, p3, d3)
+            self._curve = (p0, c1, c2, p3)
+        return self._curve
+
+    def polyline(self):
+        if self._polyline is None:
+            self._polyline = bezier_polylines(curves_to_array([self.curve()]))[0]
+        return self._polyline
+
+    def stroke(self, tolerance=FLATTEN_TOLERANCE):
+        """Polyline for drawing, adaptively flattened to tolerance px (as a list)."""
+        if self._stroke is None or self._stroke[0] != tolerance:
+            refresh_strokes([self], tolerance)
+        return self._stroke[2]
+
+    def arc_table(self):
+        """
+        (cum, total, uniform): normalized cumulative length at each polyline vertex,
+        length in px, and the curve resampled at equally spaced arc-length fractions.
+        """
+        if self._arc is None:
+            polyline = self.polyline()[None]
+            cum, total = arc_length_tables(polyline)
+            self._arc = (cum[0], float(total[0]), resample_uniform(polyline, cum)[0])
+        return self._arc
+
+    def length(self):
+        return self.arc_table()[1]
+
+    def point_at(self, s):
+        """Point at arc-length fraction s in [0, 1] (constant speed, unlike the Bezier t)."""
+        uniform = self.arc_table()[2]
+        x, y = arc_lerp(uniform[None], np.zeros(1, dtype=np.intp), np.array([s], dtype=float))[0]
+        return (float(x), float(y))
+
+    def nearest_point(self, pos):
+        """
+        Closest point on the curve to pos, for hit-testing.
+        Returns (distance px, arc-length fraction s, (x, y)).
+        """
+        pts = self.polyline()
+        cum = self.arc_table()[0]
+        dist2, u, proj = project_on_polyline(pts, pos)
+        i = int(np.argmin(dist2))
+        s = cum[i] + u[i] * (cum[i + 1] - cum[i])
+        return math.sqrt(dist2[i]), float(s), (float(proj[i, 0]), float(proj[i, 1]))
+
+    def bounds(self):
+        """
+        Box (x0, y0, x1, y1) of the control-polygon hull, which contains the whole
+        curve, padded for the stroke width and the arrowhead wings.
+        """
+        pts = self.curve()
+        xs = [p.x for p in pts]
+        ys = [p.y for p in pts]
+        pad = max(self.width / 2, ARROW_HEAD_LEN * math.sin(ARROW_HEAD_ANGLE)) + 1
+        return (min(xs) - pad, min(ys) - pad, max(xs) + pad, max(ys) + pad)
+
+    def arrowhead(self):
+        if self._arrow is None:
+            p0, c1, c2, p3 = self.curve()
+            # Arrowhead points toward the end block
+            tangent = cubic_bezier_tangent(p0, c1, c2, p3, 1.0)
+            self._arrow = arrowhead_points(p3, tangent) or ()
+        return self._arrow
+
+    def spark_radius(self):
+        # Spark dot size: 1px bigger than connection width
+        # We'll render a circle whose DIAMETER = width + 1
+        return max(1, (self.width + 5) // 2)
+
+
+def invalidate_connections(connections):
+    """Drop the cached geometry of connections (one column update for a DiagramStore selection)."""
+    store = getattr(connections, "store", None)
+    if store is not None:
+        store.invalidate(connections.rows)
+        return
+    for conn in connections:
+        conn.invalidate()
+
+
+def refresh_geometry(connections):
+    """
+    Resample the stale polylines (and their arc-length tables) among connections
+    in one batched evaluation. Connections with valid caches cost only an attribute check.
+    A DiagramStore selection refreshes its rows in the store's columns instead.
+    """
+    store = getattr(connections, "store", None)
+    if store is not None:
+        store.refresh(connections.rows)
+        return
+    stale = [conn for conn in connections if conn._polyline is None]
+    if not stale:
+        return
+    polylines = bezier_polylines(curves_to_array([conn.curve() for conn in stale]))
+    cum, total = arc_length_tables(polylines)
+    uniform = resample_uniform(polylines, cum)
+    for i, conn in enumerate(stale):
+        conn._polyline = polylines[i]
+        conn._arc = (cum[i], float(total[i]), uniform[i])
+
+
+def refresh_strokes(connections, tolerance=FLATTEN_TOLERANCE):
+    """
+    Re-flatten the drawing polylines among connections that are stale or were
+    flattened at another tolerance, in one batch grouped by segment count.
+    """
+    store = getattr(connections, "store", None)
+    if store is not None:
+        store.strokes(connections.rows, tolerance)
+        return
+    stale = [conn for conn in connections if conn._stroke is None or conn._stroke[0] != tolerance]
+    if not stale:
+        return
+    polylines = flatten_curves(curves_to_array([conn.curve() for conn in stale]), tolerance)
+    for conn, pts in zip(stale, polylines):
+        conn._stroke = (tolerance, pts, pts.tolist())
+
+
+class SpatialGrid:
+    """
+    Uniform grid of buckets over axis-aligned boxes (x0, y0, x1, y1).
+    Each item is listed in every cell its box overlaps; update() re-buckets a
+    single item, touching only the cells it leaves or enters.
+    """
+    def __init__(self, cell=SPATIAL_CELL):
+        self.cell = float(cell)
+        self.cells = {}   # (cx, cy) -> set of items
+        self.boxes = {}   # item -> (box, cell range)
+
+    def _range(self, box):
+        c = self.cell
+        return (int(box[0] // c), int(box[1] // c), int(box[2] // c), int(box[3] // c))
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def insert(self, item, box):
+        if item in self.boxes:
+            self.remove(item)
+        cells = self._range(box)
+        self.boxes[item] = (box, cells)
+        x0, y0, x1, y1 = cells
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                self.cells.setdefault((cx, cy), set()).add(item)
+
+    def update(self, item, box):
+        old = self.boxes.get(item)
+        if old is not None and old[1] == self._range(box):
+            self.boxes[item] = (box, old[1])
+        else:
+            self.insert(item, box)
+
+    def remove(self, item):
+        _, (x0, y0, x1, y1) = self.boxes.pop(item)
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                bucket = self.cells[(cx, cy)]
+                bucket.discard(item)
+                if not bucket:
+                    del self.cells[(cx, cy)]
+
+    def query_point(self, pos, pad=0.0):
+        """Items whose box, grown by pad, contains pos."""
+        x, y = pos
+        if pad:
+            return self.query_rect((x - pad, y - pad, x + pad, y + pad))
+        c = self.cell
+        bucket = self.cells.get((int(x // c), int(y // c)), ())
+        boxes = self.boxes
+        return [item for item in bucket
+                if boxes[item][0][0] <= x <= boxes[item][0][2] and boxes[item][0][1] <= y <= boxes[item][0][3]]
+
+    def query_rect(self, box):
+        """Items whose box intersects box."""
+        x0, y0, x1, y1 = self._range(box)
+        found = set()
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                found.update(self.cells.get((cx, cy), ()))
+        bx0, by0, bx1, by1 = box
+        boxes = self.boxes
+        return [item for item in found
+                if boxes[item][0][0] <= bx1 and bx0 <= boxes[item][0][2]
+                and boxes[item][0][1] <= by1 and by0 <= boxes[item][0][3]]
+
+
+class SceneIndex:
+    """
+    Spatial index for picking: block rects in one grid, curves in another.
+    Curves are indexed as pieces of PICK_CHUNK polyline segments, so a click
+    only tests the few segments near it even when long curves cross the scene.
+    Blocks keep their list order as pick priority (earlier wins, as in the old
+    linear scan). Call update_block() after moving a block; it re-indexes the
+    block and its incident connections only.
+    """
+    def __init__(self, blocks, connections, cell=SPATIAL_CELL):
+        self.blocks = SpatialGrid(cell)
+        self.curves = SpatialGrid(cell)  # items are (connection, piece index)
+        self.order = {block: i for i, block in enumerate(blocks)}
+        self._pieces = {}
+        for block in blocks:
+            self.blocks.insert(block, self._block_box(block))
+        for conn in connections:
+            self._index_connection(conn)
+
+    @staticmethod
+    def _block_box(block):
+        r = block.rect
+        return (r.left, r.top, r.right, r.bottom)  # loose; contains() has the final say
+
+    def _index_connection(self, conn):
+        pts = conn.polyline()
+        starts = np.arange(0, len(pts) - 1, PICK_CHUNK)
+        ends = np.minimum(starts + PICK_CHUNK, len(pts) - 1)
+        lo = np.minimum(np.minimum.reduceat(pts, starts), pts[ends])
+        hi = np.maximum(np.maximum.reduceat(pts, starts), pts[ends])
+        pad = max(conn.width / 2, ARROW_HEAD_LEN * math.sin(ARROW_HEAD_ANGLE)) + 1
+        for k, (x0, y0, x1, y1) in enumerate(np.hstack((lo - pad, hi + pad)).tolist()):
+            self.curves.update((conn, k), (x0, y0, x1, y1))
+        for k in range(len(starts), self._pieces.get(conn, 0)):
+            self.curves.remove((conn, k))
+        self._pieces[conn] = len(starts)
+
+    def update_block(self, block):
+        self.blocks.update(block, self._block_box(block))
+        for conn in block.connections:
+            self._index_connection(conn)
+
+    def pick_block(self, pos):
+        hits = [b for b in self.blocks.query_point(pos) if b.contains(pos)]
+        return min(hits, key=self.order.__getitem__) if hits else None
+
+    def pick_connection(self, pos, tolerance=PICK_TOLERANCE):
+        """Closest connection whose stroke passes within tolerance px of pos, else None."""
+        hits = self.curves.query_point(pos, pad=tolerance)
+        if not hits:
+            return None
+        # One vectorized projection over the segments of every candidate piece
+        starts, ends, owners, widths = [], [], [], []
+        for i, (conn, k) in enumerate(hits):
+            pts = conn.polyline()
+            lo = k * PICK_CHUNK
+            hi = min(lo + PICK_CHUNK, len(pts) - 1)
+            starts.append(pts[lo:hi])
+            ends.append(pts[lo + 1:hi + 1])
+            owners.append(np.full(hi - lo, i))
+            widths.append(conn.width)
+        a = np.concatenate(starts)
+        d = np.concatenate(ends) - a
+        owner = np.concatenate(owners)
+        p = np.asarray(pos, dtype=float)
+        dd = (d * d).sum(axis=1)
+        u = np.clip(((p - a) * d).sum(axis=1) / np.where(dd > 0, dd, 1.0), 0.0, 1.0)
+        dist = np.sqrt(((a + d * u[:, None] - p) ** 2).sum(axis=1)) - np.asarray(widths)[owner] / 2
+        i = int(np.argmin(dist))
+        return hits[owner[i]][0] if dist[i] <= tolerance else None
+
+    def query_rect(self, rect):
+        """(blocks, connections) overlapping rect, e.g. for marquee selection."""
+        x, y, w, h = rect
+        box = (x, y, x + w - 1, y + h - 1)
+        blocks = sorted(self.blocks.query_rect(box), key=self.order.__getitem__)
+        conns = {conn for conn, _ in self.curves.query_rect(box)}
+        return blocks, list(conns)
+
+
+def scene_index(blocks, connections):
+    """SceneIndex over blocks and connections, or the column scans of a DiagramStore's (StoreIndex)."""
+    store = getattr(connections, "store", None)
+    if store is not None:
+        return store.index(blocks)
+    return SceneIndex(blocks, connections)
+
+
+class SparkSystem:
+    """
+    Every spark in the scene, held in flat NumPy arrays (struct of arrays).
+
+    Per spark: connection index `conn`, arc-length fraction `t`, `speed` (loops
+    per second) and `color` (index into `styles`, a list of (color, radius)).
+    Classic-mode sparks are a pure function of elapsed time (evenly spaced
+    phases); emitter-mode sparks are spawned for all connections at once with
+    vectorized Poisson draws, capped per connection by max_live_sparks, then
+    advanced and culled with masks. Positions for all sparks are interpolated
+    in one pass from the arc-length tables (`arc_points`) of every
+    connection, so sparks move at constant pixel speed; the tables are
+    refreshed via update_curves() when geometry changes. Over a DiagramStore's
+    connections the settings come from its columns and `arc_points` is the
+    store's own table, kept current by refresh_geometry().
+    """
+    def __init__(self, connections, rng=None):
+        self.connections = connections
+        self.rng = rng if rng is not None else np.random.default_rng()
+        n = len(connections)
+        self.store = store = getattr(connections, "store", None)
+        if store is not None:
+            # Compact scene: per-connection settings straight from the columns,
+            # and the store's own arc-length tables (kept fresh by the store)
+            self.index = None
+            store.refresh()
+            self.arc_points = store.arc_points
+            radius = np.maximum(1, (store.width.astype(np.intp) + 5) // 2)
+            keys = np.column_stack([np.minimum(255, store.color.astype(np.intp) + 30), radius])
+            unique, style = np.unique(keys, axis=0, return_inverse=True)
+            self.styles = [((r, g, b), rad) for r, g, b, rad in unique.tolist()]
+            style = style.reshape(-1).astype(np.intp)
+            sparks = store.sparks.astype(np.intp)
+            speed = store.spark_speed
+            use_emitter = store.use_emitter
+            emit_mult = store.emit_mult
+            max_live = store.max_live_sparks
+        else:
+            self.index = {conn: i for i, conn in enumerate(connections)}
+            self.arc_points = np.zeros((n, CURVE_SAMPLES + 1, 2))
+            self.update_curves(connections)
+            styles = {}
+            style = np.array([styles.setdefault((c.spark_color, c.spark_radius()), len(styles))
+                              for c in connections], dtype=np.intp)
+            self.styles = list(styles)
+            sparks = np.array([c.sparks for c in connections], dtype=np.intp)
+            speed = np.array([c.spark_speed for c in connections], dtype=float)
+            use_emitter = np.array([c.use_emitter for c in connections], dtype=bool)
+            emit_mult = np.array([c.emit_mult for c in connections], dtype=float)
+            max_live = [c.max_live_sparks for c in connections]
+        active = (sparks > 0) & (speed > 0)
+        emitter = active & use_emitter
+
+        # Classic mode: fixed sparks, evenly spaced around the loop
+        counts = sparks * (active & ~emitter)
+        self.classic_conn = np.repeat(np.arange(n), counts)
+        starts = np.cumsum(counts) - counts
+        rank = np.arange(counts.sum()) - np.repeat(starts, counts)
+        self.classic_phase = rank / np.maximum(1, counts)[self.classic_conn]
+        self.classic_speed = speed[self.classic_conn]
+        self.classic_color = style[self.classic_conn]
+
+        # Emitter mode: expected spawns/sec ~= sparks * spark_speed * emit_mult
+        self.emit_rate = np.where(emitter, np.maximum(0.0, sparks * speed * emit_mult), 0.0)
+        self.max_live = np.array(max_live, dtype=np.intp).reshape(n)
+        self._emitting = np.flatnonzero(self.emit_rate > 0)
+        self._capped = bool((self.max_live[self._emitting] > 0).any())
+        self._speed = speed
+        self._style = style
+        self.conn = np.zeros(0, dtype=np.intp)
+        self.t = np.zeros(0)
+        self.speed = np.zeros(0)
+        self.color = np.zeros(0, dtype=np.intp)
+
+    def update_curves(self, connections):
+        """Copy the current arc-length tables of the given connections (a store's are shared)."""
+        if self.store is not None:
+            return
+        rows = [self.index[conn] for conn in connections]
+        if rows:
+            self.arc_points[rows] = [conn.arc_table()[2] for conn in connections]
+
+    def __len__(self):
+        return len(self.classic_conn) + len(self.conn)
+
+    def state(self):
+        """Snapshot of the emitter sparks and the generator, for set_state() in another process."""
+        return (self.conn.copy(), self.t.copy(), self.speed.copy(), self.color.copy(),
+                self.rng.bit_generator.state)
+
+    def set_state(self, state):
+        conn, t, speed, color, rng_state = state
+        self.conn, self.t, self.speed, self.color = conn.copy(), t.copy(), speed.copy(), color.copy()
+        self.rng.bit_generator.state = rng_state
+
+    def spawn_counts(self, dt):
+        """Poisson draw of new sparks per emitting connection for a step of dt."""
+        return self.rng.poisson(self.emit_rate[self._emitting] * dt)
+
+    def _spawn(self, conns, counts, capped=True):
+        """Start counts[i] sparks at t = 0 on connection conns[i]; returns how many were started."""
+        if capped:
+            # Respect cap on concurrent live sparks, if any
+            live = np.bincount(self.conn, minlength=len(self.connections))[conns]
+            cap = self.max_live[conns]
+            counts = np.where(cap > 0, np.minimum(counts, np.maximum(cap - live, 0)), counts)
+        if not counts.any():
+            return 0
+        new = np.repeat(conns, counts)
+        self.conn = np.concatenate([self.conn, new])
+        self.t = np.concatenate([self.t, np.zeros(len(new))])  # start at t = 0
+        self.speed = np.concatenate([self.speed, self._speed[new]])
+        self.color = np.concatenate([self.color, self._style[new]])
+        return len(new)
+
+    def event_driven(self):
+        """
+        Show only sparks started by inject() (live events): drop the classic
+        sparks and the Poisson emitters. Connections without a spark speed
+        get EVENT_SPARK_SPEED so their event sparks still travel.
+        """
+        self.classic_conn = np.zeros(0, dtype=np.intp)
+        self.classic_phase = self.classic_speed = np.zeros(0)
+        self.classic_color = np.zeros(0, dtype=np.intp)
+        self.emit_rate = np.zeros(len(self.connections))
+        self._emitting = np.zeros(0, dtype=np.intp)
+        self._speed = np.where(self._speed > 0, self._speed, EVENT_SPARK_SPEED)
+
+    def inject(self, counts):
+        """Start counts[i] sparks on connection i now (capped by max_live_sparks); returns how many."""
+        conns = np.flatnonzero(counts)
+        if not len(conns):
+            return 0
+        return self._spawn(conns, counts[conns], bool((self.max_live[conns] > 0).any()))
+
+    def step(self, dt):
+        """Spawn, advance and cull emitter sparks (classic sparks are stateless)."""
+        if len(self._emitting):
+            self._spawn(self._emitting, self.spawn_counts(dt), self._capped)
+        if len(self.t):
+            # Advance live sparks; remove those that reach t >= 1.0
+            self.t += self.speed * dt
+            keep = self.t < 1.0
+            if not keep.all():
+                self.conn, self.t = self.conn[keep], self.t[keep]
+                self.speed, self.color = self.speed[keep], self.color[keep]
+
+    def positions(self, elapsed, visible=None):
+        """
+        (xy, color) for every live spark: (S, 2) float positions and (S,) style indices.
+        visible, a bool mask over connections, restricts the result to their sparks.
+        """
+        phase, speed, cconn, ccolor = self.classic_phase, self.classic_speed, self.classic_conn, self.classic_color
+        t, conn, color = self.t, self.conn, self.color
+        if visible is not None:
+            keep = visible[cconn]
+            phase, speed, cconn, ccolor = phase[keep], speed[keep], cconn[keep], ccolor[keep]
+            keep = visible[conn]
+            t, conn, color = t[keep], conn[keep], color[keep]
+        t = np.concatenate([(phase + elapsed * speed) % 1.0, t])
+        xy = arc_lerp(self.arc_points, np.concatenate([cconn, conn]), t)
+        return xy, np.concatenate([ccolor, color])
+
+
+class Camera:
+    """
+    View transform over world (Block/Connection) coordinates:
+    screen = (world - (x, y)) * zoom. The identity camera reproduces the
+    unscaled window exactly.
+    """
+    def __init__(self, size, x=0.0, y=0.0, zoom=1.0):
+        self.size = size
+        self.x, self.y, self.zoom = x, y, zoom
+
+    @property
+    def identity(self):
+        return self.zoom == 1.0 and self.x == 0 and self.y == 0
+
+    @property
+    def state(self):
+        return (self.x, self.y, self.zoom)
+
+    def to_screen(self, xy):
+        """World points (..., 2) as screen points (float array)."""
+        return (np.asarray(xy, dtype=float) - (self.x, self.y)) * self.zoom
+
+    def to_world(self, pos):
+        return (pos[0] / self.zoom + self.x, pos[1] / self.zoom + self.y)
+
+    def view_box(self):
+        """World box (x0, y0, x1, y1) visible on screen."""
+        w, h = self.size
+        return (self.x, self.y, self.x + w / self.zoom, self.y + h / self.zoom)
+
+    def rect_to_screen(self, rect):
+        z = self.zoom
+        return Rect(round((rect[0] - self.x) * z), round((rect[1] - self.y) * z),
+                    max(1, round(rect[2] * z)), max(1, round(rect[3] * z)))
+
+    def pan(self, dx, dy):
+        """Move the view by a screen-space delta (e.g. a mouse drag)."""
+        self.x -= dx / self.zoom
+        self.y -= dy / self.zoom
+
+    def zoom_at(self, factor, pos):
+        """Scale by factor, keeping the world point under screen pos fixed."""
+        wx, wy = self.to_world(pos)
+        self.zoom = min(ZOOM_MAX, max(ZOOM_MIN, self.zoom * factor))
+        self.x = wx - pos[0] / self.zoom
+        self.y = wy - pos[1] / self.zoom
+
+    def fit(self, box, margin=24):
+        """Zoom and center so that world box (x0, y0, x1, y1) fills the view."""
+        w, h = self.size
+        x0, y0, x1, y1 = map(float, box)
+        bw, bh = max(1.0, x1 - x0), max(1.0, y1 - y0)
+        zoom = min((w - 2 * margin) / bw, (h - 2 * margin) / bh)
+        self.zoom = min(ZOOM_MAX, max(ZOOM_MIN, zoom))
+        self.x = (x0 + x1) / 2 - w / (2 * self.zoom)
+        self.y = (y0 + y1) / 2 - h / (2 * self.zoom)
+
+    def reset(self):
+        self.x, self.y, self.zoom = 0.0, 0.0, 1.0
+
+
+class FrameGovernor:
+    """
+    Frame-budget governor for the curve flattening tolerance.
+
+    Every `window` frames it compares the mean work time per frame with the
+    budget (1 / fps): over budget doubles the tolerance (fewer segments per
+    curve, up to `max_tolerance`); under `headroom` of the budget halves it
+    back toward `tolerance`. Powers of two keep the cached strokes reusable.
+    """
+    def __init__(self, fps, tolerance=FLATTEN_TOLERANCE, max_tolerance=FLATTEN_TOLERANCE_MAX,
+                 window=30, headroom=0.5):
+        self.budget = 1.0 / fps
+        self.min_tolerance = tolerance
+        self.max_tolerance = max(tolerance, max_tolerance)
+        self.tolerance = tolerance
+        self.window = window
+        self.headroom = headroom
+        self._total = 0.0
+        self._frames = 0
+
+    def update(self, seconds):
+        """Record one frame's work time; returns the new tolerance when it changes, else None."""
+        self._total += seconds
+        self._frames += 1
+        if self._frames < self.window:
+            return None
+        mean = self._total / self._frames
+        self._total, self._frames = 0.0, 0
+        tolerance = self.tolerance
+        if mean > self.budget:
+            tolerance = min(self.max_tolerance, tolerance * 2)
+        elif mean < self.budget * self.headroom:
+            tolerance = max(self.min_tolerance, tolerance / 2)
+        if tolerance == self.tolerance:
+            return None
+        self.tolerance = tolerance
+        return tolerance
@@ -12,10 +12,95 @@
     return m ? [parseInt(m[1],10), parseInt(m[2],10), parseInt(m[3],10)] : [230,235,240];
   };
   const brighten = ([r,g,b], d=30) => `rgb(${Math.min(255,r+d)},${Math.min(255,g+d)},${Math.min(255,b+d)})`;
-  const bPoint = (p0,p1,p2,p3,t)=>{ const u=1-t; return {
-    x:(u*u*u)*p0.x + 3*(u*u)*t*p1.x + 3*u*(t*t)*p2.x + (t*t*t)*p3.x,
-    y:(u*u*u)*p0.y + 3*(u*u)*t*p1.y + 3*u*(t*t)*p2.y + (t*t*t)*p3.y
-  }};
+  // Cubic Bézier point at t written into out[i], out[i+1] (no allocation per spark)
+  const bInto = (out,i,p0,p1,p2,p3,t)=>{ const u=1-t, a=u*u*u, b=3*u*u*t, c=3*u*t*t, d=t*t*t;
+    out[i]=a*p0.x + b*p1.x + c*p2.x + d*p3.x; out[i+1]=a*p0.y + b*p1.y + c*p2.y + d*p3.y; };
+  /* -------- Spark backends --------
+     Connections compute their spark positions into a flat [x0,y0,x1,y1,...]
+     array and hand them to the diagram's spark layer once per frame:
+     - "pool":   one <circle> per spark slot of a connection, created on first
+                 use and then only moved (cx/cy); unused slots are hidden.
+     - "canvas": a single <canvas> over the SVG viewBox; all sparks of the
+                 diagram are painted in one pass (one fill per connection).
+                 Sparks then sit above notes, since the canvas is on top. */
+  class PoolSparks {
+    constructor(diagram){ this.d=diagram; }
+    begin(){}
+    draw(c,pts,n){
+      const pool=c._pool||(c._pool=[]), group=c.sparkGroup||(c.sparkGroup=create("g",{},this.d.gSparks));
+      for(let i=0;i<n;i++){
+        let el=pool[i];
+        if(!el) el=pool[i]=create("circle",{r:c.sparkRadius(),fill:c.sparkColor()},group);
+        else if(i>=c._shown) el.removeAttribute("display");
+        el.setAttribute("cx",pts[2*i]); el.setAttribute("cy",pts[2*i+1]);
+      }
+      for(let i=n;i<c._shown;i++) pool[i].setAttribute("display","none");
+      c._shown=n;
+    }
+  }
+  class CanvasSparks {
+    constructor(diagram, container){
+      this.d=diagram; this.container=container;
+      this.canvas=document.createElement("canvas"); this.canvas.className="spark-canvas";
+      Object.assign(this.canvas.style,{position:"absolute",left:"0",top:"0",pointerEvents:"none"});
+      if(getComputedStyle(container).position==="static") container.style.position="relative";
+      container.appendChild(this.canvas); this.ctx=this.canvas.getContext("2d");
+      this.resize();
+      if(typeof ResizeObserver!=="undefined") new ResizeObserver(()=>this.resize()).observe(this.d.svg);
+    }
+    // Match the SVG box in CSS px and the viewBox transform (preserveAspectRatio xMidYMid meet)
+    resize(){
+      const box=this.d.svg.getBoundingClientRect(), outer=this.container.getBoundingClientRect();
+      const w=box.width, h=box.height, dpr=window.devicePixelRatio||1;
+      Object.assign(this.canvas.style,{left:`${box.left-outer.left-this.container.clientLeft}px`,
+        top:`${box.top-outer.top-this.container.clientTop}px`,width:`${w}px`,height:`${h}px`});
+      this.canvas.width=Math.max(1,Math.round(w*dpr)); this.canvas.height=Math.max(1,Math.round(h*dpr));
+      const s=Math.min(w/this.d.opts.width, h/this.d.opts.height);
+      this.m=[s*dpr,(w-this.d.opts.width*s)/2*dpr,(h-this.d.opts.height*s)/2*dpr];
+    }
+    begin(){ const {ctx,canvas,m}=this;
+      ctx.setTransform(1,0,0,1,0,0); ctx.clearRect(0,0,canvas.width,canvas.height);
+      ctx.setTransform(m[0],0,0,m[0],m[1],m[2]); }
+    draw(c,pts,n){
+      if(!n) return; const ctx=this.ctx, r=c.sparkRadius();
+      ctx.fillStyle=c.sparkColor(); ctx.beginPath();
+      for(let i=0;i<2*n;i+=2){ ctx.moveTo(pts[i]+r,pts[i+1]); ctx.arc(pts[i],pts[i+1],r,0,2*Math.PI); }
+      ctx.fill();
+    }
+  }
+  const SPARK_LAYERS={ pool:PoolSparks, canvas:CanvasSparks };
+  /* -------- Shared animation scheduler --------
+     One requestAnimationFrame loop ticks every started diagram. Diagrams
+     scrolled out of view (IntersectionObserver) and every diagram of a hidden
+     tab (visibilitychange) are skipped, and the loop stops altogether while
+     nothing is left to draw. Each diagram keeps its own animation clock that
+     only advances while it is drawn, so sparks resume where they stopped. */
+  const MAX_DT = 0.1;  // s; a longer gap between two frames is not replayed
+  class Scheduler {
+    constructor(){
+      this.diagrams=new Set(); this.raf=0; this.targets=new WeakMap();
+      this.observer = (typeof IntersectionObserver!=="undefined") ? new IntersectionObserver(entries=>{
+        for(const e of entries){ const d=this.targets.get(e.target);
+          if(d && d._onscreen!==e.isIntersecting){ d._onscreen=e.isIntersecting; d._last=null; } }
+        this.wake();
+      }) : null;
+      document.addEventListener("visibilitychange", ()=>{ for(const d of this.diagrams) d._last=null; this.wake(); });
+    }
+    add(d){
+      if(this.diagrams.has(d)) return; this.diagrams.add(d); d._last=null;
+      if(this.observer){ this.targets.set(d.svg,d); this.observer.observe(d.svg); }
+      this.wake();
+    }
+    remove(d){ if(this.diagrams.delete(d) && this.observer) this.observer.unobserve(d.svg); }
+    wake(){
+      if(this.raf || document.hidden) return;
+      for(const d of this.diagrams) if(d._onscreen){ this.raf=requestAnimationFrame(this._tick); return; }
+    }
+    _tick=(now)=>{ this.raf=0; if(document.hidden) return;
+      let any=false; for(const d of this.diagrams) if(d._onscreen){ any=true; d._frame(now); }
+      if(any) this.raf=requestAnimationFrame(this._tick); };
+  }
+  let scheduler=null;  // created with the first diagram
   class Block {
     constructor(diagram, id, x,y,w,h, label, opts = {}){
       this.d=diagram; this.id=id; this.x=x; this.y=y; this.w=w; this.h=h; this.label=label;
@@ -29,11 +114,12 @@
       this.text.replaceChildren();
       const parts = this.label.replace(/<br\/?>/g,"\n").split("\n");
       const lineH=18, totalH=lineH*parts.length;
+      this._textDy = 12 - totalH/2;  // first baseline relative to the block center, reused by setPos
       const cx = this.x + this.w/2;
-      const y0 = (this.y + this.h/2) - (totalH/2) + 12;
+      const y0 = (this.y + this.h/2) + this._textDy;
       this.text.setAttribute("x", cx); this.text.setAttribute("y", y0);
-      parts.forEach((line,i)=>{ const t=document.createElementNS(SVG_NS,"tspan");
-        if(i>0) t.setAttribute("dy", lineH); t.setAttribute("x", cx); t.textContent=line; this.text.appendChild(t); });
+      this._tspans = parts.map((line,i)=>{ const t=document.createElementNS(SVG_NS,"tspan");
+        if(i>0) t.setAttribute("dy", lineH); t.setAttribute("x", cx); t.textContent=line; this.text.appendChild(t); return t; });
     }
     anchor(edge,t){ t=clamp(t,-0.5,0.5);
       if(edge==="top"||edge==="bottom"){
@@ -46,17 +132,12 @@
     edgeDirInto(edge){ const v=this.edgeDir(edge); return {x:-v.x,y:-v.y}; }
     setPos(x,y){
       this.x=x; this.y=y; this.rect.setAttribute("x",x); this.rect.setAttribute("y",y);
-      const parts=this.label.replace(/<br\/?>/g,"\n").split("\n"); const lineH=18, totalH=lineH*parts.length;
-      const cx=this.x+this.w/2, y0=(this.y+this.h/2)-(totalH/2)+12;
-      this.text.setAttribute("x",cx); this.text.setAttribute("y",y0);
-      for(const t of this.text.querySelectorAll("tspan")) t.setAttribute("x",cx);
+      const cx=this.x+this.w/2;
+      this.text.setAttribute("x",cx); this.text.setAttribute("y",this.y+this.h/2+this._textDy);
+      for(const t of this._tspans) t.setAttribute("x",cx);
       
-      // Update hint positions when block moves
-      if (this._hintsEl && this.setHints) {
-        // Re-render hints with new position
-        const currentHints = this._currentHints || [];
-        this.setHints(currentHints);
-      }
+      // Drags reach here at most once per frame (see Diagram._flushDrag), so hints can follow directly
+      if (this._hintsEl && this.setHints) this.setHints(this._currentHints || []);
       
       // Update value text position when block moves
       if (this._valueEl) {
@@ -64,22 +145,21 @@
         this._valueEl.setAttribute("y", this.y + this.h/2);
       }
     }
+    // Pointer moves only record the client position; the diagram applies it at most once per frame
     _bindDrag(){
-      let start=null;
       const down=e=>{ 
         const pt = this._clientToSVG(e.clientX, e.clientY);
-        start={x:pt.x,y:pt.y,bx:this.x,by:this.y}; 
+        this._dragStart={x:pt.x,y:pt.y,bx:this.x,by:this.y}; this._pointer=null;
         this.g.classList.add("dragging"); 
         this.g.setPointerCapture(e.pointerId); 
       };
       const move=e=>{ 
-        if(!start) return; 
-        const pt = this._clientToSVG(e.clientX, e.clientY);
-        this.setPos(start.bx+(pt.x-start.x), start.by+(pt.y-start.y)); 
-        this.d.update(); 
-        if(this.d.opts.debug) this.d.showDebugInfo(this.x,this.y,this.id); 
+        if(!this._dragStart) return; 
+        this._pointer = {x:e.clientX, y:e.clientY};
+        this.d.requestDrag(this);
       };
-      const up  =e=>{ start=null; this.g.classList.remove("dragging"); this.g.releasePointerCapture(e.pointerId); if(this.d.opts.debug) this.d.hideDebugInfo(); };
+      const up  =e=>{ if(!this._dragStart) return; this.d.flushDrag(); this._dragStart=this._pointer=null;
+        this.g.classList.remove("dragging"); this.g.releasePointerCapture(e.pointerId); if(this.d.opts.debug) this.d.hideDebugInfo(); };
       this.g.addEventListener("pointerdown",down); this.g.addEventListener("pointermove",move);
       this.g.addEventListener("pointerup",up); this.g.addEventListener("pointercancel",up);
     }
@@ -89,6 +169,14 @@
       pt.y = clientY;
       return pt.matrixTransform(this.d.svg.getScreenCTM().inverse());
     }
+    // Where the latest pointer position puts the block; the CTM is read here, once per frame,
+    // so scrolling or resizing mid-drag is picked up
+    _dragTarget(){
+      const s=this._dragStart, p=this._pointer;
+      if(!s || !p) return null;
+      const pt=this._clientToSVG(p.x, p.y);
+      return {x:s.bx+(pt.x-s.x), y:s.by+(pt.y-s.y)};
+    }
   }
   class Connection {
     constructor(diagram, {start,end,color,className,width=3,sparks=0,sparkSpeed=0.8,emitter=false,maxLive=0,emitMult=1.0,outOffset=4,arrow=true}){
@@ -104,7 +192,7 @@
         const resolved = this.d.resolveColor(this.color);
         if (resolved) this.path.setAttribute("stroke", resolved);
       }
-      this.sparkGroup = create("g", {}, this.d.gSparks);
+      this.sparkGroup=null; this._pts=[]; this._shown=0;  // spark layer state
       if(!this.emitter) this.phases=Array.from({length:this.sparks},(_,i)=>i/Math.max(1,this.sparks));
     }
     endpoints(){
@@ -124,18 +212,20 @@
     }
     updatePath(){
       const {p0,d0,p3,dInto}=this.endpoints(); const {c1,c2}=this.controls(p0,d0,p3,dInto);
-      this.path.setAttribute("d", `M ${p0.x} ${p0.y} C ${c1.x} ${c1.y}, ${c2.x} ${c2.y}, ${p3.x} ${p3.y}`);
+      const d=`M ${p0.x} ${p0.y} C ${c1.x} ${c1.y}, ${c2.x} ${c2.y}, ${p3.x} ${p3.y}`;
+      if(d!==this._d){ this.path.setAttribute("d", d); this._d=d; }  // skip unchanged writes
       this.cached={p0,c1,c2,p3};
     }
-    drawSparks(dt,time){
+    sparkRadius(){ return Math.max(1,Math.floor((this.width+5)/2)); }
+    // Resolved once: the computed stroke covers className colors, but forces a style recalc
+    sparkColor(){ return this._sparkColor||(this._sparkColor=brighten(parseRGB(getComputedStyle(this.path).stroke),30)); }
+    drawSparks(dt,time,layer){
       if(this.sparks<=0||this.sparkSpeed<=0) return;
-      if(!this.cached) this.updatePath(); const {p0,c1,c2,p3}=this.cached;
-      this.sparkGroup.replaceChildren();
-      const r=Math.max(1,Math.floor((this.width+5)/2)); const stroke=getComputedStyle(this.path).stroke;
-      if(!this._sparkColor) this._sparkColor=brighten(parseRGB(stroke),30);
+      if(!this.cached) this.updatePath(); const {p0,c1,c2,p3}=this.cached; const pts=this._pts;
       if(!this.emitter){
-        for(const phase of this.phases){ const t=(phase+time*this.sparkSpeed)%1; const pt=bPoint(p0,c1,c2,p3,t);
-          create("circle",{cx:pt.x,cy:pt.y,r,fill:this._sparkColor},this.sparkGroup); }
+        const n=this.phases.length;
+        for(let i=0;i<n;i++) bInto(pts,2*i,p0,c1,c2,p3,(this.phases[i]+time*this.sparkSpeed)%1);
+        layer.draw(this,pts,n);
         return;
       }
       // Emitter mode: spawn randomly; probability scales with sparks & speed
@@ -144,14 +234,16 @@
       let toSpawn=Math.floor(this.emitAcc); this.emitAcc-=toSpawn; if(Math.random()<this.emitAcc){toSpawn++; this.emitAcc=0;}
       // Respect cap on concurrent live sparks, if any
       while(toSpawn--){ if(this.maxLive && this.live.length>=this.maxLive) break; this.live.push(0.0); }
-      // Advance/draw live sparks; remove those that reach t>=1.0
-      const next=[]; for(let t of this.live){ t+=this.sparkSpeed*dt; if(t<1){ const pt=bPoint(p0,c1,c2,p3,t);
-        create("circle",{cx:pt.x,cy:pt.y,r,fill:this._sparkColor},this.sparkGroup); next.push(t);} } this.live=next;
+      // Advance/draw live sparks; drop (compact in place) those that reach t>=1.0
+      const live=this.live; let n=0;
+      for(let i=0;i<live.length;i++){ const t=live[i]+this.sparkSpeed*dt;
+        if(t<1){ live[n]=t; bInto(pts,2*n,p0,c1,c2,p3,t); n++; } }
+      live.length=n; layer.draw(this,pts,n);
     }
   }
   class Diagram {
     constructor(container, opts={}){
-      this.opts=Object.assign({width:1000,height:720,grid:true,debug:false},opts);
+      this.opts=Object.assign({width:1000,height:720,grid:true,debug:false,sparkRenderer:"pool"},opts);
       this.ids={root:uid("diagram"),grid:uid("grid"),arrow:uid("arrow")};
       this.svg = create("svg",{id:this.ids.root,viewBox:`0 0 ${this.opts.width} ${this.opts.height}`,preserveAspectRatio:"xMidYMid meet",width:"100%",height:"100%"},container);
       const defs=create("defs",{},this.svg);
@@ -172,7 +264,12 @@
       this.gConns =create("g",{class:"connections"},this.svg);  // middle
       this.gSparks=create("g",{class:"sparks"},this.svg);       // above connections
       this.gNotes =create("g",{class:"notes"},this.svg);        // top
-      this.blocks={}; this.connections=[]; this._last=performance.now(); this._running=false;
+      const Layer=SPARK_LAYERS[this.opts.sparkRenderer];
+      if(!Layer) throw new Error(`run_blocks: unknown sparkRenderer "${this.opts.sparkRenderer}" (pool or canvas)`);
+      this.sparkLayer=new Layer(this, container);
+      this.blocks={}; this.connections=[]; this._running=false;
+      this.incident={}; this._dragged=new Set(); this._dragRaf=0;  // block id → its connections; pending drags
+      this.time=0; this._last=null; this._onscreen=true;  // animation clock (s), see Scheduler
       this.colors={ motor:"rgb(171,71,188)", motor2:"rgb(186,104,200)", sens1:"rgb(77,182,172)", sens2:"rgb(3,169,244)", cereb:"rgb(240,98,146)", basal:"rgb(245,127,23)", thal:"rgb(1,87,155)", olf:"rgb(56,142,60)", arrow:"rgb(230,235,240)" };
       this.const={ CONTROL_PUSH_MAX:320, CONTROL_PUSH_RATIO:0.42 };
       
@@ -200,14 +297,39 @@
     }
     addBlock(id,x,y,w,h,label,opts){ const b=new Block(this,id,x,y,w,h,label,opts); this.blocks[id]=b; return b; }
     block(id){ return this.blocks[id]; }
-    connect(opts){ const c=new Connection(this,opts); this.connections.push(c); c.updatePath(); return c; }
+    connect(opts){ const c=new Connection(this,opts); this.connections.push(c);
+      for(const id of new Set([c.start.block, c.end.block])) (this.incident[id]||(this.incident[id]=[])).push(c);
+      c.updatePath(); return c; }
     update(){ for(const c of this.connections) c.updatePath(); }
+    // Recompute only the paths touching these blocks (ids or Block objects)
+    updateBlocks(blocks){
+      const conns=new Set();
+      for(const b of blocks) for(const c of this.incident[b.id ?? b] || []) conns.add(c);
+      for(const c of conns) c.updatePath();
+    }
+    // Drags are coalesced: moves are applied, and their paths recomputed, at most once per animation frame
+    requestDrag(block){
+      this._dragged.add(block);
+      if(!this._dragRaf) this._dragRaf=requestAnimationFrame(this._flushDrag);
+    }
+    flushDrag(){ if(this._dragRaf){ cancelAnimationFrame(this._dragRaf); this._flushDrag(); } }
+    _flushDrag=()=>{ this._dragRaf=0; const moved=[];
+      for(const b of this._dragged){ const t=b._dragTarget();
+        if(t && (t.x!==b.x || t.y!==b.y)){ b.setPos(t.x,t.y); moved.push(b); } }
+      this._dragged.clear(); this.updateBlocks(moved);
+      const last=moved[moved.length-1]; if(last && this.opts.debug) this.showDebugInfo(last.x,last.y,last.id); };
     showDebugInfo(x,y,blockId){ if(this.debugDisplay){ this.debugDisplay.textContent=`${blockId}: (${Math.round(x)}, ${Math.round(y)})`; this.debugDisplay.style.display="block"; } }
     hideDebugInfo(){ if(this.debugDisplay){ this.debugDisplay.style.display="none"; } }
-    _tick=(now)=>{ if(!this._running) return; const dt=(now-this._last)/1000; this._last=now; const elapsed=now/1000;
-      for(const c of this.connections) c.drawSparks(dt,elapsed); requestAnimationFrame(this._tick); };
-    start(){ if(this._running) return; this._running=true; this._last=performance.now(); requestAnimationFrame(this._tick); }
-    stop(){ this._running=false; }
+    // One animation step, called by the scheduler; dt is capped and the clock is this diagram's own
+    _frame(now){
+      const first=this._last===null, elapsed=first ? 0 : now-this._last;
+      if(!first && this.opts.fps>0 && elapsed+1<1000/this.opts.fps) return;  // 1 ms slack for rAF jitter
+      const dt=Math.min(elapsed/1000,MAX_DT); this._last=now; this.time+=dt;
+      const layer=this.sparkLayer; layer.begin();
+      for(const c of this.connections) c.drawSparks(dt,this.time,layer);
+    }
+    start(){ if(this._running) return; this._running=true; (scheduler||(scheduler=new Scheduler())).add(this); }
+    stop(){ this._running=false; if(scheduler) scheduler.remove(this); }
 
     /* -------- JSON loader (schema tolerant) -------- */
     loadFromJSON(json){
@@ -260,6 +382,7 @@
       block:(id)=>diagram.block(id),
       connect:(o)=>diagram.connect(o),
       update:()=>diagram.update(),
+      updateBlocks:(ids)=>diagram.updateBlocks(ids),
       start:()=>diagram.start(),
       stop:()=>diagram.stop(),
       colors:diagram.colors,
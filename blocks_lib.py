@@ -1,27 +1,62 @@
 import math
-import pygame
+import importlib
+import json
 import random
 import argparse
+import multiprocessing
 import os
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
+import numpy as np
+
+import blocks_core
+from blocks_core import *
+from frame_export import FFMPEG_PRESETS, PngSequenceWriter, encode_png, open_video_writer
+from frame_profiler import FrameProfiler, NullProfiler
+from input_log import InputLog, InputRecorder, check_positions, percentiles
+
+
+class _LazyModule:
+    """Imports the module on first attribute access, so `import blocks_lib` stays cheap."""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+pygame = _LazyModule("pygame")
 
 BG = (22, 26, 30)
 GRID = (36, 40, 45)
 BLOCK_FILL = (43, 48, 54)
 BLOCK_BORDER = (90, 100, 110)
-ARROW_COLOR = (230, 235, 240)
 
 TEXT_COLOR = (235, 240, 245)
 FPS = 120
 
-CONTROL_PUSH_MAX = 320
-CONTROL_PUSH_RATIO = 0.42  # fraction of start->end distance (clamped by max)
+TEXT_CACHE_MB = 16  # default memory bound of the shared rendered-line cache
+FONT_CACHE = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                          "neuro-flow", "fonts.json")  # resolved system font paths
+
+# Level-of-detail thresholds (zoom factors)
+ZOOM_STEP = 1.15         # per mouse-wheel notch
+LOD_OUTLINE_ZOOM = 0.5   # below: no dark shadow stroke, fewer curve samples
+LOD_LABEL_ZOOM = 0.3     # below: blocks become plain rects, no labels or arrowheads
+LOD_SPLAT_ZOOM = 0.15    # below: curves are splatted as points, sparks are hidden
+SPLAT_POINTS = 2_000_000  # point budget of one splatted frame
+SPLAT_SPACING = 2.0      # px between splatted samples
 
-ARROW_HEAD_LEN = 14
-ARROW_HEAD_ANGLE = math.radians(25)
-CURVE_SAMPLES = 48  # segments when drawing the bezier
+PROFILE_PANEL_EVERY = 30  # frames between refreshes of the --profile panel
 
 
-def parse_args():
+def parse_args(argv=None):
     p = argparse.ArgumentParser(description="Animated blocks")
     p.add_argument("-o", "--save-prefix", default=None,
                    help="If set, save frames as PREFIX000001.png, PREFIX000002.png, ...")
@@ -30,262 +65,700 @@ def parse_args():
     p.add_argument("--start-index", type=int, default=1,
                    help="Starting index for saved frames (default: 1)")
     p.add_argument("--max-frames", type=int, default=0,
-                   help="Stop after saving this many frames (0 = unlimited)")
+                   help="Stop after saving (offline: rendering) this many frames (0 = unlimited)")
     p.add_argument("--random-spark-starts", action="store_true",
                    help="Enable emitter mode: sparks start at random; probability scales with 'sparks' and 'spark_speed'")
     p.add_argument("--emit-mult", type=float, default=1.0,
                    help="Global multiplier for emission rate in emitter mode (default 1.0)")
     p.add_argument("--max-live-sparks", type=int, default=0,
                    help="Cap concurrent live sparks per connection in emitter mode (0 = no cap)")
-    return p.parse_args()
+    p.add_argument("--text-cache-mb", type=float, default=TEXT_CACHE_MB,
+                   help=f"Memory bound of the shared rendered-text cache in MB (default {TEXT_CACHE_MB})")
+    p.add_argument("--encode-workers", type=int, default=0,
+                   help="Threads encoding saved PNG frames in the background (0 = auto)")
+    p.add_argument("--encode-queue", type=int, default=0,
+                   help="Max frames waiting to be encoded before rendering blocks (0 = 2 x workers)")
+    p.add_argument("--pipe-to-ffmpeg", choices=sorted(FFMPEG_PRESETS), default=None,
+                   help="Stream raw frames into ffmpeg and encode OUTPUT directly, no PNGs "
+                        "(GIF falls back to Pillow without ffmpeg)")
+    p.add_argument("--output", default=None,
+                   help="Video file for --pipe-to-ffmpeg (default: output.mp4 / output.gif)")
+    p.add_argument("--ffmpeg", default="ffmpeg", help="ffmpeg executable (default: ffmpeg)")
+    p.add_argument("--offline", action="store_true",
+                   help="Render frames headlessly with a fixed time step, as fast as possible; "
+                        "without --save-prefix or --pipe-to-ffmpeg the frames are only timed")
+    p.add_argument("--render-workers", type=int, default=1,
+                   help="Offline mode: render frame ranges on this many processes "
+                        "(default 1 = in this process, 0 = one per CPU)")
+    p.add_argument("--fps", type=float, default=None,
+                   help=f"Frame rate; the simulated time step in offline mode (default {FPS})")
+    p.add_argument("--duration", type=float, default=0.0,
+                   help="Offline mode: seconds of simulated time to render (0 = until --max-frames)")
+    p.add_argument("--seed", type=int, default=None,
+                   help="Seed the random generator so layouts and emitter sparks are reproducible")
+    p.add_argument("--fit", action="store_true",
+                   help="Start with the camera zoomed to fit the whole diagram")
+    p.add_argument("--flatten-tolerance", type=float, default=FLATTEN_TOLERANCE,
+                   help=f"Max px between a curve and its drawn polyline (default {FLATTEN_TOLERANCE}); "
+                        "interactively it is loosened while frames run over budget")
+    p.add_argument("--profile", nargs="?", const="frame_profile.json", default=None, metavar="PATH",
+                   help="Time each phase of every frame, show p50/p95/p99 next to the HUD and write "
+                        "the frames to PATH on exit: Chrome trace JSON, or CSV for *.csv "
+                        "(default: frame_profile.json)")
+    live = p.add_argument_group("live events (sparks from real activity, see event_feed.py)")
+    live.add_argument("--events", default=None, metavar="SOURCE",
+                      help="Spawn sparks from event records (connection index, timestamp, intensity) read from "
+                           "unix:PATH (listen on a socket), fifo:PATH (named pipe), file:PATH (tail) or - (stdin); "
+                           "replaces the classic and emitter sparks")
+    live.add_argument("--event-format", choices=("text", "binary"), default="text",
+                      help="Text lines 'conn timestamp intensity' or packed binary records (default text)")
+    live.add_argument("--event-policy", choices=("drop-oldest", "drop-newest"), default="drop-oldest",
+                      help="What to drop when more than --event-max-pending events are queued (default drop-oldest)")
+    live.add_argument("--event-max-pending", type=int, default=None,
+                      help="Events queued between two frames before dropping (default event_feed.MAX_PENDING, 1M)")
+    live.add_argument("--event-max-lag", type=float, default=0.0,
+                      help="Drop events this many seconds older than the newest one seen (default 0 = never)")
+    live.add_argument("--event-max-per-frame", type=int, default=None,
+                      help="Sparks spawned per connection per frame; more events are coalesced "
+                           "(default event_feed.MAX_PER_FRAME, 8)")
+    p.add_argument("--record-input", default=None, metavar="PATH",
+                   help="Record mouse and keyboard input with timestamps to PATH (JSON lines), "
+                        "plus the final block positions")
+    p.add_argument("--replay-input", default=None, metavar="PATH",
+                   help="Replay a --record-input log headlessly at a fixed time step, report frame-time "
+                        "percentiles during the interaction and check the final block positions")
+    args = p.parse_args(argv)
+    if args.replay_input and (args.offline or args.events or args.record_input):
+        p.error("--replay-input runs on its own (not with --offline, --events or --record-input)")
+    if args.events and args.offline:
+        p.error("--events needs the interactive loop (it is not deterministic)")
+    if args.pipe_to_ffmpeg and args.save_prefix:
+        p.error("--pipe-to-ffmpeg and --save-prefix are exclusive")
+    if args.offline and not (args.duration > 0 or args.max_frames > 0):
+        p.error("--offline requires --duration or --max-frames")
+    if args.render_workers != 1 and not args.offline:
+        p.error("--render-workers requires --offline")
+    return args
+
 
+def init_screen(args, size):
+    """
+    Seed the random generator (--seed), init pygame and open the window.
+    In offline mode and when replaying input no window is shown: SDL's dummy
+    video driver is used.
+    Call this before building the scene so the seed also covers the layout.
+    Sharded offline renders and input recordings draw a seed when none is
+    given, so that every worker process (or the replay) builds the same
+    layout; a replay takes the recorded seed.
+    """
+    if args.offline or args.replay_input:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    if args.seed is None:
+        if args.replay_input:
+            args.seed = InputLog.load(args.replay_input).header.get("seed")
+        elif render_workers(args) > 1 or args.record_input:
+            args.seed = random.randrange(2 ** 31)
+    if args.seed is not None:
+        random.seed(args.seed)
+    # Only the modules the renderer uses; pygame.init() would also open audio
+    pygame.display.init()
+    pygame.font.init()
+    return pygame.display.set_mode(size)
 
-def draw_grid(surface, gap=24):
+
+def draw_grid(surface, gap=24, camera=None):
+    """Draw the background grid; returns the number of lines drawn."""
     w, h = surface.get_size()
-    for x in range(0, w, gap):
-        pygame.draw.line(surface, GRID, (x, 0), (x, h), 1)
-    for y in range(0, h, gap):
-        pygame.draw.line(surface, GRID, (0, y), (w, y), 1)
+    if camera is None or camera.identity:
+        for x in range(0, w, gap):
+            pygame.draw.line(surface, GRID, (x, 0), (x, h), 1)
+        for y in range(0, h, gap):
+            pygame.draw.line(surface, GRID, (0, y), (w, y), 1)
+        return len(range(0, w, gap)) + len(range(0, h, gap))
+    step = gap * camera.zoom
+    if step < 6:
+        return 0  # zoomed out too far for the grid to read as anything but noise
+    lines = 0
+    x = (-camera.x % gap) * camera.zoom
+    while x < w:
+        pygame.draw.line(surface, GRID, (int(x), 0), (int(x), h), 1)
+        x += step
+        lines += 1
+    y = (-camera.y % gap) * camera.zoom
+    while y < h:
+        pygame.draw.line(surface, GRID, (0, int(y)), (w, int(y)), 1)
+        y += step
+        lines += 1
+    return lines
+
+
+class TextCache:
+    """
+    Shared LRU cache of rendered text lines keyed by (font, text, color).
+    Bounded by the pixel memory of the cached surfaces rather than by entry count,
+    so diagrams that change labels dynamically reuse lines without growing forever.
+    """
+    def __init__(self, max_bytes=int(TEXT_CACHE_MB * 1024 * 1024)):
+        self.max_bytes = int(max_bytes)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def render(self, font, text, color=TEXT_COLOR):
+        key = (font, text, color)
+        surf = self._entries.get(key)
+        if surf is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return surf
+        self.misses += 1
+        surf = font.render(text, True, color)
+        self._entries[key] = surf
+        self.bytes += self._size(surf)
+        self.trim()
+        return surf
+
+    def trim(self):
+        # Always keep the most recent entry, even if it alone exceeds the bound
+        while self.bytes > self.max_bytes and len(self._entries) > 1:
+            _, surf = self._entries.popitem(last=False)
+            self.bytes -= self._size(surf)
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    @staticmethod
+    def _size(surf):
+        w, h = surf.get_size()
+        return w * h * surf.get_bytesize()
+
 
+text_cache = TextCache()
+
+
+class Block(blocks_core.Block):
+    """
+    Block (see blocks_core.Block) with its body and label pre-rendered in one
+    surface, rebuilt when size, alpha, label or font change.
+    """
+    __slots__ = ("_surface", "_surface_key", "_surface_offset", "_scaled", "_scaled_key")
 
-class Block:
     def __init__(self, x, y, w, h, label, alpha=255):
-        self.rect = pygame.Rect(x, y, w, h)
-        self.label = label  # supports \n or <br/> for multi-line
-        self.dragging = False
-        self.drag_offset = (0, 0)
-        # Per-block transparency (0 fully transparent, 255 fully opaque)
-        self.alpha = max(0, min(255, int(alpha)))
-
-    def contains(self, pos):
-        return self.rect.collidepoint(pos)
-
-    def start_drag(self, pos):
-        self.dragging = True
-        self.drag_offset = (pos[0] - self.rect.x, pos[1] - self.rect.y)
-
-    def drag(self, pos):
-        if self.dragging:
-            self.rect.x = pos[0] - self.drag_offset[0]
-            self.rect.y = pos[1] - self.drag_offset[1]
-
-    def stop_drag(self):
-        self.dragging = False
-
-    def _render_multiline(self, surface, font):
-        # Convert <br/> to \n and render centered lines
+        super().__init__(x, y, w, h, label, alpha)
+        self._surface = None
+        self._surface_key = None
+        self._surface_offset = (0, 0)  # label may overflow the rect
+        self._scaled = None  # surface() resampled for the last camera zoom
+        self._scaled_key = None
+
+    def _render_surface(self, font):
+        # Convert <br/> to \n and lay out centered lines, relative to the rect
+        w, h = self.rect.size
         text = self.label.replace("<br/>", "\n")
         lines = text.splitlines() if text else [""]
-        rendered = [font.render(line, True, TEXT_COLOR) for line in lines]
+        rendered = [text_cache.render(font, line, TEXT_COLOR) for line in lines]
         total_h = sum(r.get_height() for r in rendered)
-        y = self.rect.centery - total_h // 2
+        placed = []
+        y = h // 2 - total_h // 2
         for r in rendered:
             tw, th = r.get_size()
-            surface.blit(r, (self.rect.centerx - tw // 2, y))
+            placed.append((r, w // 2 - tw // 2, y))
             y += th
+        area = pygame.Rect(0, 0, w, h).unionall([r.get_rect(topleft=(x, y)) for r, x, y in placed])
 
-    def draw(self, surface, font):
-        # Draw translucent rounded rectangle on its own surface
-        block_surf = pygame.Surface((self.rect.w, self.rect.h), pygame.SRCALPHA)
-        rr = block_surf.get_rect()
+        # Translucent rounded rectangle; text stays fully opaque on top of it
+        surf = pygame.Surface(area.size, pygame.SRCALPHA)
+        rr = pygame.Rect(-area.x, -area.y, w, h)
         fill_rgba   = (*BLOCK_FILL,  self.alpha)
         border_rgba = (*BLOCK_BORDER, self.alpha)
-        pygame.draw.rect(block_surf, fill_rgba, rr, border_radius=14)
-        pygame.draw.rect(block_surf, border_rgba, rr, width=2, border_radius=14)
-        surface.blit(block_surf, self.rect.topleft)
-
-        # Text stays fully opaque (rendered on main surface)
-        self._render_multiline(surface, font)
+        pygame.draw.rect(surf, fill_rgba, rr, border_radius=14)
+        pygame.draw.rect(surf, border_rgba, rr, width=2, border_radius=14)
+        for r, x, y in placed:
+            surf.blit(r, (x - area.x, y - area.y))
+        return surf, area.topleft
 
-    def edge_dir(self, edge_name):
-        if edge_name == "top":    return pygame.Vector2(0, -1)
-        if edge_name == "right":  return pygame.Vector2(1, 0)
-        if edge_name == "bottom": return pygame.Vector2(0, 1)
-        if edge_name == "left":   return pygame.Vector2(-1, 0)
-        raise ValueError("Invalid edge name")
+    def surface(self, font):
+        """Rendered body and label, cached on (size, alpha, label, font)."""
+        key = (self.rect.size, self.alpha, self.label, font)
+        if key != self._surface_key:
+            self._surface, self._surface_offset = self._render_surface(font)
+            self._surface_key = key
+        return self._surface
 
-    def anchor_point_with_offset(self, edge_name, t):
-        """
-        Return a point on the given edge, offset by t in [-0.5, 0.5] from the center
-        along the edge direction (t=0 center; +/-0.5 near corners).
-        """
-        t = max(-0.5, min(0.5, float(t)))  # clamp
-        r = self.rect
-        if edge_name in ("top", "bottom"):
-            x = r.centerx + r.w * t
-            y = r.top if edge_name == "top" else r.bottom
-            return pygame.Vector2(x, y)
-        elif edge_name in ("left", "right"):
-            x = r.left if edge_name == "left" else r.right
-            y = r.centery + r.h * t
-            return pygame.Vector2(x, y)
-        else:
-            raise ValueError("Invalid edge name")
+    def scaled_surface(self, font, zoom):
+        """surface() resampled for a camera zoom; the last zoom level is cached."""
+        surf = self.surface(font)
+        key = (self._surface_key, zoom)
+        if key != self._scaled_key:
+            w, h = surf.get_size()
+            size = (max(1, round(w * zoom)), max(1, round(h * zoom)))
+            self._scaled = pygame.transform.smoothscale(surf, size)
+            self._scaled_key = key
+        return self._scaled
 
+    def bounds(self, font):
+        """Screen rect covered by the block and its (possibly overflowing) label."""
+        surf = self.surface(font)
+        ox, oy = self._surface_offset
+        return surf.get_rect(topleft=(self.rect.x + ox, self.rect.y + oy))
 
-def cubic_bezier(p0, p1, p2, p3, t):
-    u = 1 - t
-    return (u**3) * p0 + 3 * (u**2) * t * p1 + 3 * u * (t**2) * p2 + (t**3) * p3
+    def draw(self, surface, font):
+        surf = self.surface(font)
+        ox, oy = self._surface_offset
+        surface.blit(surf, (self.rect.x + ox, self.rect.y + oy))
 
 
-def cubic_bezier_tangent(p0, p1, p2, p3, t):
-    u = 1 - t
-    return 3 * ((p1 - p0) * (u**2) + 2 * (p2 - p1) * u * t + (p3 - p2) * (t**2))
+def draw_polyline(surface, points, color, width):
+    pygame.draw.lines(surface, color, False, points.tolist(), width)
 
 
-def draw_bezier(surface, p0, p1, p2, p3, color, width=3, samples=CURVE_SAMPLES):
-    prev = p0
-    for i in range(1, samples + 1):
-        t = i / samples
-        pt = cubic_bezier(p0, p1, p2, p3, t)
-        pygame.draw.line(surface, color, prev, pt, width)
-        prev = pt
+def draw_bezier(surface, p0, p1, p2, p3, color, width=3, samples=None, tolerance=FLATTEN_TOLERANCE):
+    """Stroke a cubic, flattened to tolerance px (or at a fixed number of samples)."""
+    controls = curves_to_array([(p0, p1, p2, p3)])
+    if samples:
+        points = bezier_polylines(controls, samples)[0]
+    else:
+        points = flatten_curves(controls, tolerance)[0]
+    draw_polyline(surface, points, color, width)
 
 
 def draw_arrowhead(surface, tip, direction, color):
-    if direction.length() == 0:
-        return
-    d = direction.normalize()
-    left = pygame.Vector2(
-        d.x * math.cos(ARROW_HEAD_ANGLE) - d.y * math.sin(ARROW_HEAD_ANGLE),
-        d.x * math.sin(ARROW_HEAD_ANGLE) + d.y * math.cos(ARROW_HEAD_ANGLE),
-    )
-    right = pygame.Vector2(
-        d.x * math.cos(-ARROW_HEAD_ANGLE) - d.y * math.sin(-ARROW_HEAD_ANGLE),
-        d.x * math.sin(-ARROW_HEAD_ANGLE) + d.y * math.cos(-ARROW_HEAD_ANGLE),
-    )
-    p1 = tip
-    p2 = tip - left * ARROW_HEAD_LEN
-    p3 = tip - right * ARROW_HEAD_LEN
-    pygame.draw.polygon(surface, color, (p1, p2, p3))
+    points = arrowhead_points(tip, direction)
+    if points:
+        pygame.draw.polygon(surface, color, points)
+
+
+class Connection(blocks_core.Connection):
+    """Curved arrow between two blocks (see blocks_core.Connection), drawn with pygame."""
+    __slots__ = ()
 
+    def draw(self, surface, tolerance=FLATTEN_TOLERANCE):
+        points = self.stroke(tolerance)
 
-def nice_controls(p_start, dir_start, p_end, dir_end):
-    span = (p_end - p_start).length()
-    push = min(CONTROL_PUSH_MAX, span * CONTROL_PUSH_RATIO)
-    c1 = p_start + dir_start * push
-    c2 = p_end - dir_end * push  # dir_end should be INTO the end block
-    return c1, c2
+        # Curve (shadow + stroke), one draw.lines call each
+        pygame.draw.lines(surface, (0, 0, 0), False, points, self.width + 2)
+        pygame.draw.lines(surface, self.color, False, points, self.width)
 
+        arrow = self.arrowhead()
+        if arrow:
+            pygame.draw.polygon(surface, self.color, arrow)
 
-def brighten(rgb, delta=25):
-    r = min(255, rgb[0] + delta)
-    g = min(255, rgb[1] + delta)
-    b = min(255, rgb[2] + delta)
-    return (r, g, b)
+        return self.curve()  # return curve for sparks
 
 
-class Connection:
+def draw_connections(surface, connections, tolerance=FLATTEN_TOLERANCE):
     """
-    Curved arrow with optional animated 'sparks' moving from start -> end.
-    - start: (block, edge, offset [-0.5..0.5])
-    - end:   (block, edge, offset [-0.5..0.5])
-    - color: line color
-    - width: line width in px
-    - sparks: int, number of moving dots (0 disables)
-    - spark_speed: float, units of t per second (0..1 loops)
-    - spark_color: optional color; default is slightly brighter than 'color'
+    Draw all connections, batching any geometry that needs recomputing.
+    Returns the list of curves (p0, c1, c2, p3) in the same order, for the sparks.
     """
-    def __init__(
-        self,
-        start,
-        end,
-        color=ARROW_COLOR,
-        width=3,
-        sparks=0,
-        spark_speed=0.6,
-        spark_color=None,
-        use_emitter=False,
-        emit_mult=1.0,
-        max_live_sparks=0,
-    ):
-        self.start_block, self.start_edge, self.start_t = start
-        self.end_block, self.end_edge, self.end_t = end
-        self.color = color
-        self.width = width
-        self.sparks = int(max(0, sparks))
-        self.spark_speed = float(max(0.0, spark_speed))
-        self.spark_color = spark_color if spark_color else brighten(color, 30)
-        # Spark modes
-        self.use_emitter = bool(use_emitter)
-        self.emit_mult = float(emit_mult)
-        self.max_live_sparks = int(max_live_sparks)
-        if self.use_emitter:
-            # Emitter mode: spawn sparks randomly over time
-            self._live = []          # list of t positions in [0,1)
-            self._emit_accum = 0.0   # accumulator for Poisson-like spawning
+    refresh_geometry(connections)
+    refresh_strokes(connections, tolerance)
+    return [conn.draw(surface, tolerance) for conn in connections]
+
+
+class LayeredRenderer:
+    """
+    Renders the scene from cached layers so that only the sparks are redrawn per frame.
+
+    - background: BG, grid and blocks (opaque)
+    - curves:     connection strokes and arrowheads
+
+    Notes and the HUD sit above the sparks and are translucent, so they are
+    repainted, clipped, only in the region where this frame's dirty rects overlap
+    them. The layers are rebuilt only after invalidate(), e.g. when a block was
+    dragged, or when the camera moved. Between rebuilds, each frame restores the
+    area under last frame's sparks from the cached layers, draws the new sparks
+    and reports the dirty rects.
+
+    A compact scene (connections from a DiagramStore) is drawn from the store's
+    columns: `bounds` and `colors` are its arrays, and curves are stroked
+    from its cached float32 polylines with vectorized arrowheads.
+
+    Everything is drawn through `camera`. Connections whose control-point box
+    (kept per connection in `bounds`) misses the view are culled along with
+    their sparks; zooming out drops detail per the LOD_* thresholds.
+
+    With a FrameProfiler as `profiler`, render() laps the grid, blocks,
+    curves, sparks and hud phases and counts live sparks and draw calls;
+    set_panel() shows a surface (the profile table) right of the HUD.
+    """
+    def __init__(self, screen, blocks, connections, notes, font, sparks, hud_text="KintaroAI.com",
+                 camera=None):
+        self.screen = screen
+        self.blocks = blocks
+        self.connections = connections
+        self.sparks = sparks
+        self.notes = notes or []
+        self.font = font
+        self.hud_text = hud_text
+        size = screen.get_size()
+        self.camera = camera or Camera(size)
+        self.store = getattr(connections, "store", None)
+        if self.store is not None:
+            self.bounds, self.colors = self.store.bounds, self.store.color  # live columns
         else:
-            # Classic mode: fixed sparks, evenly spaced around the loop
-            self._spark_phase = [i / max(1, self.sparks) for i in range(self.sparks)]
+            self.bounds = np.array([conn.bounds() for conn in connections], dtype=float).reshape(-1, 4)
+            self.colors = np.array([conn.color for conn in connections], dtype=np.uint8).reshape(-1, 3)
+        self._radii = np.array([radius for _, radius in sparks.styles], dtype=float)
+        self._mapped = None  # connection colors as curves-layer pixel values
+        self._visible = None  # bool mask of connections in view; None when all are
+        self.tolerance = FLATTEN_TOLERANCE  # curve flattening, in screen px
+        self._view = None  # camera state the layers were built for
+        self.background = pygame.Surface(size).convert()
+        self.curves = pygame.Surface(size, pygame.SRCALPHA).convert_alpha()
+        self.static = pygame.Surface(size).convert()  # background + curves, composited
+        self.hud = font.render(hud_text, True, (180, 190, 200))
+        self.selected = None  # picked connection, drawn highlighted
+        self.dirty = True
+        self._spark_rects = []
+        self._overlay_bounds = []
+        self._circles = []  # (color, radius, center) drawn this frame
+        self.profiler = NullProfiler()
+        self.panel = None  # optional surface drawn next to the HUD
+        self._panel_stale = []  # panel areas to repaint after set_panel()
 
-    def endpoints(self):
-        p0 = self.start_block.anchor_point_with_offset(self.start_edge, self.start_t)
-        d0 = self.start_block.edge_dir(self.start_edge)
-        p3 = self.end_block.anchor_point_with_offset(self.end_edge, self.end_t)
-        d3 = -self.end_block.edge_dir(self.end_edge)  # into the block
-        return p0, d0, p3, d3
+    def invalidate(self):
+        self.dirty = True
 
-    def controls(self, p0, d0, p3, d3):
-        return nice_controls(p0, d0, p3, d3)
+    def set_tolerance(self, tolerance):
+        if tolerance != self.tolerance:
+            self.tolerance = tolerance
+            self.invalidate()
 
-    def draw(self, surface):
-        p0, d0, p3, d3 = self.endpoints()
-        c1, c2 = self.controls(p0, d0, p3, d3)
+    def _world_tolerance(self):
+        # Screen tolerance in world px, with the zoom rounded down to a power of
+        # two so that nearby zoom levels reuse the same flattened strokes
+        return self.tolerance * 2.0 ** math.floor(math.log2(1.0 / self.camera.zoom))
 
-        # Curve (shadow + stroke)
-        draw_bezier(surface, p0, c1, c2, p3, (0, 0, 0), width=self.width + 2)
-        draw_bezier(surface, p0, c1, c2, p3, self.color, width=self.width)
+    def set_panel(self, surface):
+        """Show surface right of the HUD (None hides it); repainted on the next render."""
+        if self.panel is not None:
+            self._panel_stale.append(self._panel_bounds())
+        self.panel = surface
+        if surface is not None:
+            self._panel_stale.append(self._panel_bounds())
 
-        # Arrowhead points toward the end block
-        tangent = cubic_bezier_tangent(p0, c1, c2, p3, 1.0)
-        draw_arrowhead(surface, p3, tangent, self.color)
+    def _panel_bounds(self):
+        return self.panel.get_rect(topleft=(self.hud.get_width() + 26, 10))
 
-        return (p0, c1, c2, p3)  # return curve for sparks
+    def select(self, conn):
+        if conn is not self.selected:
+            self.selected = conn
+            self.invalidate()
 
-    def draw_sparks(self, surface, curve_points, elapsed_time, dt):
-        if self.sparks <= 0 or self.spark_speed <= 0:
-            return
-        p0, c1, c2, p3 = curve_points
-
-        # Spark dot size: 1px bigger than connection width
-        # We'll render a circle whose DIAMETER = width + 1
-        radius = max(1, (self.width + 5) // 2)
-
-        if not self.use_emitter:
-            # Classic loop: evenly spaced phases
-            for phase in self._spark_phase:
-                t = (phase + elapsed_time * self.spark_speed) % 1.0
-                pt = cubic_bezier(p0, c1, c2, p3, t)
-                pygame.draw.circle(surface, self.spark_color, (int(pt.x), int(pt.y)), radius)
+    def update_curves(self, connections):
+        """Refresh the culling boxes of the given connections after they moved."""
+        if self.store is not None:
+            return  # the store refreshes its bounds column with the geometry
+        rows = [self.sparks.index[conn] for conn in connections]
+        if rows:
+            self.bounds[rows] = [conn.bounds() for conn in connections]
+
+    def content_box(self):
+        """World box around every block, note and connection (for Camera.fit)."""
+        rects = [block.rect for block in self.blocks + self.notes]
+        boxes = np.vstack([self.bounds, [(r.left, r.top, r.right, r.bottom) for r in rects]]) \
+            if rects else self.bounds
+        if not len(boxes):
+            return (0, 0) + self.camera.size
+        lo, hi = boxes[:, :2].min(axis=0), boxes[:, 2:].max(axis=0)
+        return (lo[0], lo[1], hi[0], hi[1])
+
+    def _cull(self):
+        x0, y0, x1, y1 = self.camera.view_box()
+        b = self.bounds
+        visible = (b[:, 0] <= x1) & (b[:, 2] >= x0) & (b[:, 1] <= y1) & (b[:, 3] >= y0)
+        return None if visible.all() else visible
+
+    def _block_rect(self, block):
+        """Screen rect of a block (and its label) under the camera."""
+        cam = self.camera
+        if cam.identity:
+            return block.bounds(self.font)
+        if cam.zoom < LOD_LABEL_ZOOM:
+            return pygame.Rect(cam.rect_to_screen(block.rect))
+        r = block.bounds(self.font)
+        if cam.zoom == 1.0:
+            return r.move(-round(cam.x), -round(cam.y))
+        return pygame.Rect(cam.rect_to_screen(r))
+
+    def _draw_blocks(self, surface, blocks, outline_only=False):
+        cam = self.camera
+        if cam.identity or cam.zoom >= LOD_LABEL_ZOOM or not blocks:
+            view = cam.view_box()
+            return sum(self._draw_block(surface, block, view) for block in blocks)
+        # Too small to read: flat boxes (notes only get their outline), placed in one pass
+        w, h = cam.size
+        xywh = np.array([tuple(block.rect) for block in blocks], dtype=float)
+        r = np.rint(np.hstack((cam.to_screen(xywh[:, :2]), xywh[:, 2:] * cam.zoom))).astype(int)
+        r[:, 2:] = np.maximum(1, r[:, 2:])
+        on_screen = (r[:, 0] < w) & (r[:, 1] < h) & (r[:, 0] + r[:, 2] > 0) & (r[:, 1] + r[:, 3] > 0)
+        for rect in r[on_screen].tolist():
+            if not outline_only:
+                pygame.draw.rect(surface, BLOCK_FILL, rect)
+            pygame.draw.rect(surface, BLOCK_BORDER, rect, 1)
+        return int(on_screen.sum()) * (1 if outline_only else 2)
+
+    def _draw_block(self, surface, block, view):
+        """Blit one block if it is in view; returns whether it was drawn."""
+        cam = self.camera
+        if cam.identity:
+            block.draw(surface, self.font)
+            return True
+        r = block.rect
+        if r.right < view[0] or r.left > view[2] or r.bottom < view[1] or r.top > view[3]:
+            return False
+        surf = block.surface(self.font) if cam.zoom == 1.0 else block.scaled_surface(self.font, cam.zoom)
+        surface.blit(surf, self._block_rect(block))
+        return True
+
+    def _stroke(self, conn, color, width, outline, tolerance):
+        """
+        Draw one connection through the (non-identity) camera, at the zoom's
+        level of detail. Returns the number of draw calls made.
+        """
+        cam = self.camera
+        points = cam.to_screen(conn.stroke(tolerance)).tolist()
+        width = max(1, round(width * cam.zoom))
+        calls = 1
+        if outline and cam.zoom >= LOD_OUTLINE_ZOOM:
+            pygame.draw.lines(self.curves, (0, 0, 0), False, points, width + 2)
+            calls += 1
+        pygame.draw.lines(self.curves, color, False, points, width)
+        arrow = conn.arrowhead()
+        if arrow and outline and cam.zoom >= LOD_LABEL_ZOOM:
+            pygame.draw.polygon(self.curves, color, cam.to_screen(arrow).tolist())
+            calls += 1
+        return calls
+
+    def _stroke_store(self, rows, tolerance):
+        """
+        Compact scenes: stroke the curves of rows straight from the DiagramStore
+        columns, in the same order and level of detail as conn.draw() and
+        _stroke(). Returns the number of draw calls made.
+        """
+        store, cam = self.store, self.camera
+        zoom = 1.0 if cam.identity else cam.zoom
+        outline = zoom >= LOD_OUTLINE_ZOOM
+        heads, has_head = arrowheads(store.curves[rows]) if zoom >= LOD_LABEL_ZOOM else (None, None)
+        widths = store.width[rows].astype(int)
+        if not cam.identity:
+            widths = np.maximum(1, np.rint(widths * zoom)).astype(int)
+            if heads is not None:
+                heads = cam.to_screen(heads)
+        draw_lines, surface = pygame.draw.lines, self.curves
+        calls = 0
+        for i, (pts, color, width) in enumerate(zip(store.strokes(rows, tolerance),
+                                                   store.color[rows].tolist(), widths.tolist())):
+            points = (pts if cam.identity else cam.to_screen(pts)).tolist()
+            if outline:
+                draw_lines(surface, (0, 0, 0), False, points, width + 2)
+            draw_lines(surface, color, False, points, width)
+            calls += 1 + outline
+            if heads is not None and has_head[i]:
+                pygame.draw.polygon(surface, color, heads[i].tolist())
+                calls += 1
+        return calls
+
+    def _splat_curves(self, rows):
+        """
+        Far zoom: plot the arc-length samples of all visible curves straight into
+        the pixels in one NumPy pass, thinned or densified to about one per pixel.
+        """
+        cam = self.camera
+        arc = self.sparks.arc_points
+        # Samples are equally spaced along each curve, so one segment gives the
+        # spacing; at this zoom the mean is close enough for all of them
+        first = np.abs(arc[rows, 1] - arc[rows, 0]).max(axis=1)
+        spacing = float(first.mean()) * cam.zoom if len(rows) else 0.0
+        cols = np.arange(CURVE_SAMPLES + 1)
+        if 0 < spacing < SPLAT_SPACING:
+            stride = min(CURVE_SAMPLES, int(SPLAT_SPACING / spacing))
+            cols = np.append(cols[:-1:stride], CURVE_SAMPLES)
+            spacing *= stride
+        pts = cam.to_screen(arc[rows[:, None], cols])
+        a, d = pts[:, :-1], np.diff(pts, axis=1)
+        budget = max(1, SPLAT_POINTS // max(1, d.shape[0] * d.shape[1]))
+        n_sub = int(min(budget, max(1, math.ceil(spacing / SPLAT_SPACING))))
+        if n_sub > 1:
+            steps = np.arange(n_sub) / n_sub
+            a = (a[:, :, None, :] + d[:, :, None, :] * steps[None, None, :, None]).reshape(len(rows), -1, 2)
+        else:
+            a = pts
+        xy = a.astype(np.intp).reshape(-1, 2)
+        if self._mapped is None:
+            # Colors as packed pixel values of the curves layer, opaque
+            shifts = self.curves.get_shifts()
+            c = self.colors.astype(np.uint32)
+            self._mapped = ((c[:, 0] << shifts[0]) | (c[:, 1] << shifts[1]) | (c[:, 2] << shifts[2])
+                            | np.uint32(255 << shifts[3]))
+        color = np.repeat(self._mapped[rows], a.shape[1])
+        w, h = cam.size
+        inside = (xy[:, 0] >= 0) & (xy[:, 0] < w) & (xy[:, 1] >= 0) & (xy[:, 1] < h)
+        px = pygame.surfarray.pixels2d(self.curves)
+        px[xy[inside, 0], xy[inside, 1]] = color[inside]
+        del px  # unlock the surface
+
+    def rebuild(self):
+        cam = self.camera
+        prof = self.profiler
+        self.background.fill(BG)
+        prof.count("draw_calls", 1 + draw_grid(self.background, camera=cam))
+        prof.lap("grid")
+        prof.count("draw_calls", self._draw_blocks(self.background, self.blocks))
+        prof.lap("blocks")
+
+        self.curves.fill((0, 0, 0, 0))
+        self._visible = self._cull()
+        tolerance = self.tolerance if cam.identity else self._world_tolerance()
+        calls = 1
+        if self.store is not None and (cam.identity or cam.zoom >= LOD_SPLAT_ZOOM):
+            rows = np.arange(len(self.connections)) if self._visible is None else np.flatnonzero(self._visible)
+            calls += self._stroke_store(rows, tolerance)
+        elif cam.identity:
+            refresh_strokes(self.connections, tolerance)
+            for conn in self.connections:
+                conn.draw(self.curves, tolerance)
+            if prof.enabled:
+                calls += sum(3 if conn.arrowhead() else 2 for conn in self.connections)
+        else:
+            rows = np.arange(len(self.connections)) if self._visible is None else np.flatnonzero(self._visible)
+            if cam.zoom < LOD_SPLAT_ZOOM:
+                self._splat_curves(rows)
+                calls += 1
+            else:
+                visible = [self.connections[i] for i in rows.tolist()]
+                refresh_strokes(visible, tolerance)
+                for conn in visible:
+                    calls += self._stroke(conn, conn.color, conn.width, True, tolerance)
+        if self.selected is not None:
+            conn = self.selected
+            if cam.identity:
+                pygame.draw.lines(self.curves, brighten(conn.color, 60), False,
+                                  conn.stroke(tolerance), conn.width + 2)
+                calls += 1
+            else:
+                calls += self._stroke(conn, brighten(conn.color, 60), conn.width + 2, False, tolerance)
+
+        self.static.blit(self.background, (0, 0))
+        self.static.blit(self.curves, (0, 0))
+        prof.count("draw_calls", calls + 2)
+        prof.lap("curves")
+        self._overlay_bounds = [self._block_rect(block) for block in self.notes]
+        self._overlay_bounds.append(self.hud.get_rect(topleft=(10, 10)))
+        self._view = cam.state
+        self.dirty = False
+
+    def _draw_overlay(self):
+        calls = self._draw_blocks(self.screen, self.notes, outline_only=True)
+        self.screen.blit(self.hud, (10, 10))
+        if self.panel is not None:
+            self.screen.blit(self.panel, self._panel_bounds())
+            calls += 1
+        self.profiler.count("draw_calls", calls + 1)
+
+    def _repaint_overlay(self, dirty, spark_rects):
+        # Notes are translucent: repaint their dirty area exactly once, from the
+        # static layer up, instead of blending them again per (overlapping) rect
+        bounds = self._overlay_bounds
+        if self.panel is not None:
+            bounds = bounds + [self._panel_bounds()]
+        hits = [r for r in dirty if r.collidelist(bounds) != -1]
+        if not hits:
             return
+        screen = self.screen
+        area = hits[0].unionall(hits[1:])
+        screen.set_clip(area)
+        screen.blit(self.static, area, area)
+        circles = self._circles  # spark_rects[i] is what circles[i] covered when drawn
+        for i in area.collidelistall(spark_rects):
+            color, radius, center = circles[i]
+            pygame.draw.circle(screen, color, center, radius)
+        self._draw_overlay()
+        screen.set_clip(None)
 
-        # Emitter mode: spawn randomly; probability scales with sparks & speed
-        # Expected spawns/sec ~= sparks * spark_speed * emit_mult
-        rate = max(0.0, self.sparks * self.spark_speed * self.emit_mult)
-        self._emit_accum += rate * dt
-
-        # Spawn floor(self._emit_accum) sparks; probabilistically one more
-        to_spawn = int(self._emit_accum)
-        self._emit_accum -= to_spawn
-        if random.random() < self._emit_accum:
-            to_spawn += 1
-            self._emit_accum = 0.0
-
-        # Respect cap on concurrent live sparks, if any
-        for _ in range(to_spawn):
-            if self.max_live_sparks and len(self._live) >= self.max_live_sparks:
-                break
-            self._live.append(0.0)  # start at the beginning (t = 0.0)
+    def _draw_sparks(self, elapsed, dt):
+        self.sparks.step(dt)
+        cam = self.camera
+        if cam.zoom < LOD_SPLAT_ZOOM:
+            self._circles = []
+            return []
+        xy, style = self.sparks.positions(elapsed, self._visible)
+        styles = self.sparks.styles
+        if cam.identity:
+            circles = [(*styles[s], center)
+                       for center, s in zip(xy.astype(int).tolist(), style.tolist())]
+        else:
+            xy = cam.to_screen(xy)
+            radius = np.maximum(1, np.rint(self._radii[style] * cam.zoom)).astype(int)
+            circles = [(styles[s][0], r, center) for center, s, r in
+                       zip(xy.astype(int).tolist(), style.tolist(), radius.tolist())]
+        self._circles = circles
+        self.profiler.count("draw_calls", len(circles))
+        draw = pygame.draw.circle
+        screen = self.screen
+        return [draw(screen, color, center, radius) for color, radius, center in circles]
+
+    def render(self, elapsed, dt):
+        """Draw one frame; returns the changed rects, or None if the whole screen changed."""
+        screen = self.screen
+        prof = self.profiler
+        prof.count("live_sparks", len(self.sparks))
+        if self.dirty or self._view != self.camera.state:
+            self.rebuild()
+            screen.blit(self.static, (0, 0))
+            self._spark_rects = self._draw_sparks(elapsed, dt)
+            prof.count("draw_calls", 1)
+            prof.lap("sparks")
+            self._draw_overlay()
+            self._panel_stale = []
+            prof.lap("hud")
+            return None
+
+        # Restore under last frame's sparks and wherever the panel was replaced
+        old = self._spark_rects + self._panel_stale
+        self._panel_stale = []
+        for r in old:
+            screen.blit(self.static, r, r)
+        new = self._draw_sparks(elapsed, dt)
+        prof.count("draw_calls", len(old))
+        prof.lap("sparks")
+        dirty = old + new
+        self._repaint_overlay(dirty, new)
+        prof.lap("hud")
+        self._spark_rects = new
+        return dirty
 
-        # Advance/draw live sparks; remove those that reach t>=1.0
-        new_live = []
-        for t in self._live:
-            t += self.spark_speed * dt
-            if t < 1.0:
-                pt = cubic_bezier(p0, c1, c2, p3, t)
-                pygame.draw.circle(surface, self.spark_color, (int(pt.x), int(pt.y)), radius)
-                new_live.append(t)
-        self._live = new_live
+
+def open_profiler(args):
+    """FrameProfiler for --profile, else a NullProfiler that records nothing."""
+    return FrameProfiler() if args.profile else NullProfiler()
+
+
+def open_event_feed(args, sparks):
+    """Started EventFeed for --events, with sparks switched to event-driven mode; else None."""
+    if not args.events:
+        return None
+    import event_feed  # asyncio costs startup time; only load it when asked for
+    sparks.event_driven()
+    limits = dict(max_pending=args.event_max_pending, max_per_frame=args.event_max_per_frame)
+    return event_feed.EventFeed(args.events, args.event_format, args.event_policy, max_lag=args.event_max_lag,
+                                **{name: value for name, value in limits.items() if value is not None}).start()
+
+
+def render_profile_panel(font, lines):
+    """The --profile table as a translucent surface, one monospace row per line."""
+    rows = [font.render(line, True, (180, 190, 200)) for line in lines]
+    pad, step = 6, font.get_linesize()
+    w = max((row.get_width() for row in rows), default=0) + 2 * pad
+    panel = pygame.Surface((w, step * len(rows) + 2 * pad), pygame.SRCALPHA)
+    panel.fill((0, 0, 0, 150))
+    for i, row in enumerate(rows):
+        panel.blit(row, (pad, pad + i * step))
+    return panel
 
 
 def create_conn_kwargs(args):
@@ -297,79 +770,551 @@ def create_conn_kwargs(args):
     )
 
 
-def run_main_loop(screen, blocks, connections, notes, args, caption="Animated blocks"):
-    """Run the main pygame loop with common functionality."""
+def load_font(args, size=18):
+    text_cache.max_bytes = int(args.text_cache_mb * 1024 * 1024)
+    return system_font("arial", size)
+
+
+def system_font(name, size):
+    """
+    pygame.font.SysFont(name, size) without the system font scan on every run:
+    the resolved file is remembered in FONT_CACHE (pygame's default font when
+    the system has no match) and looked up again only if it disappears.
+    """
+    try:
+        with open(FONT_CACHE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    path = cache.get(name)
+    if path is None or (path and not os.path.exists(path)):
+        path = cache[name] = pygame.font.match_font(name) or ""
+        try:
+            os.makedirs(os.path.dirname(FONT_CACHE), exist_ok=True)
+            tmp = f"{FONT_CACHE}.{os.getpid()}"
+            with open(tmp, "w") as f:
+                json.dump(cache, f, indent=1)
+            os.replace(tmp, FONT_CACHE)  # atomic, as export workers may race here
+        except OSError:
+            pass  # read-only home: resolve again next time
+    return pygame.font.Font(path or None, size)
+
+
+def make_output_dir(save_prefix):
+    outdir = os.path.dirname(save_prefix)
+    if outdir:
+        os.makedirs(outdir, exist_ok=True)
+
+
+def surface_rgb(surface):
+    """Copy the surface pixels out as raw RGB24 bytes."""
+    tobytes = getattr(pygame.image, "tobytes", None) or pygame.image.tostring  # pygame < 2.1.3
+    return tobytes(surface, "RGB")
+
+
+def open_frame_writer(args, size):
+    """
+    Frame sink for the export flags: an ffmpeg/Pillow video stream for
+    --pipe-to-ffmpeg, else background PNG encoding for --save-prefix.
+    Rendering only pays for the pixel copy either way.
+    """
+    if args.pipe_to_ffmpeg:
+        output = args.output or f"output.{args.pipe_to_ffmpeg}"
+        make_output_dir(output)
+        # Saved frames are every frame_skip-th frame of the simulation
+        fps = (args.fps or FPS) / max(1, int(args.frame_skip))
+        return open_video_writer(args.pipe_to_ffmpeg, output, size, fps, args.ffmpeg)
+    make_output_dir(args.save_prefix)
+    return PngSequenceWriter(args.save_prefix, start_index=max(0, int(args.start_index)),
+                             workers=args.encode_workers, max_pending=args.encode_queue)
+
+
+def render_workers(args):
+    """Number of processes for an offline render (--render-workers, 0 = one per CPU)."""
+    if not args.offline:
+        return 1
+    return args.render_workers if args.render_workers > 0 else os.cpu_count() or 1
+
+
+def offline_renderer(screen, blocks, connections, notes, args):
+    """(sparks, renderer) set up for an offline render, as both export paths need them."""
+    font = load_font(args)
+    refresh_geometry(connections)
+    sparks = SparkSystem(connections, np.random.default_rng(args.seed))
+    renderer = LayeredRenderer(screen, blocks, connections, notes, font, sparks)
+    renderer.set_tolerance(args.flatten_tolerance)
+    if args.fit:
+        renderer.camera.fit(renderer.content_box())
+    return sparks, renderer
+
+
+def run_offline(screen, blocks, connections, notes, args, profiler=None, build_scene=None):
+    """
+    Deterministic headless export. Simulated time advances by exactly 1/fps per
+    frame, only the frames that will be saved are rendered (skipped frames just
+    step the emitter sparks), and nothing sleeps, so it runs as fast as the CPU
+    allows. With --seed, output is byte-identical across runs. Without an
+    export flag the frames are rendered and dropped, e.g. for benchmarks.
+
+    With --render-workers > 1 and the scene's build_scene, the frame range is
+    rendered by a process pool instead (run_offline_sharded).
+    """
+    if render_workers(args) > 1:
+        if build_scene is not None:
+            return run_offline_sharded(screen, connections, args, build_scene)
+        print("--render-workers needs the scene's build_scene; rendering in this process")
+    fps = args.fps or FPS
+    dt = 1.0 / fps
+    total = int(round(args.duration * fps)) if args.duration > 0 else 0
+
+    frame_skip = max(1, int(args.frame_skip))
+    max_frames = max(0, int(args.max_frames))
+    frames_saved = 0
+    frame_counter = 0
+    sparks, renderer = offline_renderer(screen, blocks, connections, notes, args)
+    # Exported frames stay free of the profile panel; timings only go to the dump
+    profiler = renderer.profiler = profiler or open_profiler(args)
+
+    start = time.perf_counter()
+    exporting = args.save_prefix or args.pipe_to_ffmpeg
+    with open_frame_writer(args, screen.get_size()) if exporting else nullcontext() as writer:
+        while not total or frame_counter < total:
+            frame_counter += 1
+            if frame_counter % frame_skip:
+                sparks.step(dt)
+                continue
+            profiler.begin_frame()
+            # Multiply rather than accumulate so elapsed time does not drift
+            renderer.render(frame_counter * dt, dt)
+            if writer:
+                writer.write(surface_rgb(screen), screen.get_size())
+            profiler.lap("save")
+            profiler.end_frame()
+            frames_saved += 1
+            if max_frames and frames_saved >= max_frames:
+                break
+
+    wall = time.perf_counter() - start
+    print(f"{'Saved' if writer else 'Rendered'} {frames_saved} frames "
+          f"({frame_counter * dt:.2f} s simulated at {fps:g} FPS) in {wall:.2f} s")
+    if args.profile:
+        profiler.dump(args.profile)
+    pygame.quit()
+
+
+def offline_frames(args):
+    """Simulation frame numbers (1-based) of the frames an offline render keeps, in order."""
+    fps = args.fps or FPS
+    frame_skip = max(1, int(args.frame_skip))
+    total = int(round(args.duration * fps)) if args.duration > 0 else 0
+    max_frames = max(0, int(args.max_frames))
+    last = total if total else max_frames * frame_skip
+    frames = range(frame_skip, last + 1, frame_skip)
+    return frames[:max_frames] if max_frames else frames
+
+
+_shard = None  # (screen, sparks, renderer) of this worker process
+
+
+def _init_shard(args, build_scene, size):
+    """Worker initializer: rebuild the scene from the shared seed, headlessly."""
+    global _shard
+    screen = init_screen(args, size)
+    blocks, connections, notes = build_scene(args)
+    _shard = (screen,) + offline_renderer(screen, blocks, connections, notes, args)
+
+
+def _render_shard(start, end, frame_skip, dt, state, index, prefix):
+    """
+    Render simulation frames start..end (inclusive) from the spark state at the
+    start of frame `start`. Kept frames are written as PREFIX{index:06d}.png
+    onwards when prefix is set (returns their byte sizes), else returned raw.
+    """
+    screen, sparks, renderer = _shard
+    sparks.set_state(state)
+    out = []
+    for frame in range(start, end + 1):
+        if frame % frame_skip:
+            sparks.step(dt)
+            continue
+        renderer.render(frame * dt, dt)
+        rgb = surface_rgb(screen)
+        if prefix:
+            data = encode_png(rgb, *screen.get_size())
+            with open(f"{prefix}{index:06d}.png", "wb") as f:
+                f.write(data)
+            out.append(len(data))
+            index += 1
+        else:
+            out.append(rgb)
+    return out
+
+
+def run_offline_sharded(screen, connections, args, build_scene):
+    """
+    Offline export split across a process pool. A frame depends only on the
+    simulated time and the layout, apart from emitter sparks, which depend on
+    every earlier step. So this process only steps the sparks (no drawing) to
+    snapshot their state (and generator) at the start of each shard. Every
+    worker rebuilds the scene with build_scene(args) from the shared seed and
+    renders its shards from those snapshots. The output is byte-identical to a
+    single-process run. PNG frames are encoded and written by the workers under
+    their final numbers; video frames come back raw and are streamed in order.
+    """
+    fps = args.fps or FPS
+    dt = 1.0 / fps
+    frame_skip = max(1, int(args.frame_skip))
+    frames = offline_frames(args)
+    workers = min(render_workers(args), max(1, len(frames)))
+    # A few shards per worker balance the load; small ones keep video frames in flight bounded
+    per_shard = max(1, min(32, math.ceil(len(frames) / (workers * 4))))
+    ends = list(frames[per_shard - 1::per_shard])
+    if frames and ends[-1] != frames[-1]:
+        ends.append(frames[-1])
+
+    refresh_geometry(connections)
+    sparks = SparkSystem(connections, np.random.default_rng(args.seed))
+    first_index = max(0, int(args.start_index))
+    shards = []
+    frame = 1
+    for i, end in enumerate(ends):
+        shards.append((frame, end, frame_skip, dt, sparks.state(),
+                       first_index + i * per_shard, args.save_prefix))
+        while frame <= end:
+            sparks.step(dt)
+            frame += 1
+
+    size = screen.get_size()
+    if args.save_prefix:
+        make_output_dir(args.save_prefix)
+    writer = open_frame_writer(args, size) if args.pipe_to_ffmpeg else nullcontext()
+    start = time.perf_counter()
+    frames_done = bytes_written = 0
+    spawn = multiprocessing.get_context("spawn")  # fresh pygame/SDL state per worker
+    with writer, ProcessPoolExecutor(workers, mp_context=spawn, initializer=_init_shard,
+                                     initargs=(args, build_scene, size)) as pool:
+        pending = deque()
+        shards = iter(shards)
+        while True:
+            while len(pending) < 2 * workers:
+                shard = next(shards, None)
+                if shard is None:
+                    break
+                pending.append(pool.submit(_render_shard, *shard))
+            if not pending:
+                break
+            # Collect in submission order so video frames reach the writer in order
+            for result in pending.popleft().result():
+                if args.save_prefix:
+                    bytes_written += result
+                elif args.pipe_to_ffmpeg:
+                    writer.write(result, size)
+                frames_done += 1
+
+    wall = time.perf_counter() - start
+    total = frames[len(frames) - 1] * dt if frames else 0.0
+    verb = "Saved" if args.save_prefix or args.pipe_to_ffmpeg else "Rendered"
+    print(f"{verb} {frames_done} frames ({total:.2f} s simulated at {fps:g} FPS) in {wall:.2f} s "
+          f"on {workers} processes ({frames_done / max(wall, 1e-9):.1f} frames/sec"
+          + (f", {bytes_written / 1e6:.1f} MB)" if args.save_prefix else ")"))
+    pygame.quit()
+
+
+def input_record(event):
+    """The part of a pygame event the loop reacts to, as an input log record (None for the rest)."""
+    if event.type == pygame.QUIT:
+        return dict(type="quit")
+    if event.type in (pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP):
+        return dict(type="down" if event.type == pygame.MOUSEBUTTONDOWN else "up",
+                    button=event.button, pos=list(event.pos))
+    if event.type == pygame.MOUSEMOTION:
+        return dict(type="move", pos=list(event.pos), rel=list(event.rel))
+    if event.type == pygame.MOUSEWHEEL:
+        return dict(type="wheel", y=event.y, pos=list(pygame.mouse.get_pos()))
+    if event.type == pygame.KEYDOWN:
+        return dict(type="key", key=pygame.key.name(event.key))
+    return None
+
+
+class Interaction:
+    """
+    Mouse and keyboard handling of the interactive loop. It takes input
+    records (input_record) rather than pygame events, so a live session and
+    its --replay-input run go through the same code.
+    """
+    def __init__(self, renderer, index, sparks):
+        self.renderer = renderer
+        self.camera = renderer.camera
+        self.index = index
+        self.sparks = sparks
+        self.dragging = None  # block under the mouse
+        self.panning = False
+        self._unindexed = None  # block moved since its last re-index (see reindex())
+
+    @property
+    def active(self):
+        return self.dragging is not None or self.panning
+
+    def handle(self, record):
+        """Apply one record; returns False on quit."""
+        kind = record["type"]
+        camera, renderer = self.camera, self.renderer
+        if kind == "quit":
+            return False
+        if kind == "down" and record["button"] == 1:
+            self.reindex()
+            pos = camera.to_world(record["pos"])
+            block = self.index.pick_block(pos)
+            if block:
+                self.dragging = block
+                block.start_drag(pos)
+            else:
+                # Clicking a curve selects (highlights) it; empty space clears
+                renderer.select(self.index.pick_connection(pos, PICK_TOLERANCE / camera.zoom))
+        elif kind == "up" and record["button"] == 1:
+            if self.dragging:
+                # Moves handled earlier in this frame have not been refreshed yet
+                self.refresh()
+                self.dragging.stop_drag()
+                self.dragging = None
+        # Camera: right/middle drag pans, wheel zooms at the cursor, F fits, 0 resets
+        elif kind == "down" and record["button"] in (2, 3):
+            self.panning = True
+        elif kind == "up" and record["button"] in (2, 3):
+            self.panning = False
+        elif kind == "move" and self.panning:
+            camera.pan(*record["rel"])
+        elif kind == "wheel":
+            camera.zoom_at(ZOOM_STEP ** record["y"], record["pos"])
+        elif kind == "key" and record["key"] == "f":
+            camera.fit(renderer.content_box())
+        elif kind == "key" and record["key"] in ("0", "home"):
+            camera.reset()
+        elif kind == "move" and self.dragging:
+            block = self.dragging
+            version = block.version
+            block.drag(camera.to_world(record["pos"]))
+            if block.version != version:
+                renderer.invalidate()
+                self._unindexed = block  # re-indexed once per frame by refresh(), not per event
+        return True
+
+    def reindex(self):
+        """Bring the picking index up to date with the last moved block (before a pick, and from refresh())."""
+        block, self._unindexed = self._unindexed, None
+        if block is not None:
+            refresh_geometry(block.connections)  # batched; update_block reuses the polylines
+            self.index.update_block(block)
+
+    def refresh(self):
+        """Recompute the curves of the dragged block; returns True if one is dragged."""
+        if not self.dragging:
+            return False
+        # Only connections touching the dragged block have stale geometry
+        conns = self.dragging.connections
+        refresh_geometry(conns)
+        self.sparks.update_curves(conns)
+        self.renderer.update_curves(conns)
+        self.reindex()
+        return True
+
+
+def open_input_recorder(args, size, fps):
+    """InputRecorder for --record-input, else None."""
+    if not args.record_input:
+        return None
+    make_output_dir(args.record_input)
+    return InputRecorder(args.record_input, size, fps, args.seed, args.fit, args.flatten_tolerance)
+
+
+def run_input_replay(screen, blocks, connections, notes, args, profiler=None, log=None):
+    """
+    Replay a --record-input session (or the InputLog given) headlessly: each
+    frame advances exactly 1/fps, handles the records due by then and renders.
+    Prints and returns frame-time percentiles over the frames with input or
+    a drag/pan in progress ("interaction") and the rest ("idle"), and checks
+    the final positions of the blocks and notes against the recording (exit
+    status 1 when they differ, for regression tests). The recording's fit and
+    flatten tolerance replace the command line's.
+    """
+    if log is None:
+        log = InputLog.load(args.replay_input)
+    fps = args.fps or log.fps or FPS
+    dt = 1.0 / fps
+    if log.size and tuple(screen.get_size()) != log.size:
+        print(f"Window is {screen.get_size()}, the recording {log.size}: positions may not match")
+    args.fit = bool(log.header.get("fit", args.fit))
+    args.flatten_tolerance = log.header.get("flatten_tolerance") or args.flatten_tolerance
+    movable = blocks + (notes or [])  # everything Interaction can drag
+    sparks, renderer = offline_renderer(screen, blocks, connections, notes, args)
+    interaction = Interaction(renderer, scene_index(movable, connections), sparks)
+    profiler = renderer.profiler = profiler or open_profiler(args)
+
+    records = log.records
+    settle = int(math.ceil(0.25 * fps))  # idle frames after the last record
+    active_ms, idle_ms = [], []
+    i = frame = 0
+    start = time.perf_counter()
+    while i < len(records) or settle > 0:
+        frame += 1
+        elapsed = frame * dt
+        frame_start = time.perf_counter()
+        profiler.begin_frame()
+        handled = 0
+        while i < len(records) and records[i]["t"] <= elapsed + 1e-9:
+            interaction.handle(records[i])
+            i += 1
+            handled += 1
+        profiler.lap("events")
+        if interaction.refresh():
+            profiler.lap("curves")
+        renderer.render(elapsed, dt)
+        profiler.end_frame()
+        ms = (time.perf_counter() - frame_start) * 1000.0
+        (active_ms if handled or interaction.active else idle_ms).append(ms)
+        if i >= len(records):
+            settle -= 1
+    wall = time.perf_counter() - start
+
+    problems = check_positions(movable, log.final, log.labels)
+    report = dict(events=len(records), frames=frame, fps=fps, interaction=percentiles(active_ms),
+                  idle=percentiles(idle_ms), positions_ok=not problems, problems=problems)
+    print(f"Replayed {len(records)} input events over {frame} frames ({frame * dt:.2f} s at {fps:g} FPS) "
+          f"in {wall:.2f} s")
+    for name in ("interaction", "idle"):
+        stats = report[name]
+        if stats:
+            print(f"  {name:<12} {len(active_ms if name == 'interaction' else idle_ms):>6} frames  "
+                  + "  ".join(f"{key} {value:7.2f}" for key, value in stats.items()) + " ms")
+    if log.final is None:
+        print("  no final positions in the recording to check")
+    elif problems:
+        print("  final positions differ from the recording:")
+        for problem in problems:
+            print(f"    {problem}")
+    else:
+        print(f"  final positions of all {len(movable)} blocks and notes match the recording")
+    if args.profile:
+        profiler.dump(args.profile)
+    pygame.quit()
+    if problems and args.replay_input:
+        raise SystemExit(1)
+    return report
+
+
+def run_main_loop(screen, blocks, connections, notes, args, caption="Animated blocks", profiler=None,
+                  build_scene=None):
+    """
+    Run the main pygame loop with common functionality (or the offline export).
+    A caller-supplied profiler records the frames without the on-screen panel or
+    the --profile dump (see bench_suite.py). build_scene(args), the function
+    that built the scene, lets an offline export rebuild it in worker processes
+    (--render-workers). With --replay-input it replays a recorded session
+    instead and returns its report (run_input_replay).
+    """
+    if args.offline:
+        return run_offline(screen, blocks, connections, notes, args, profiler, build_scene)
+    if args.replay_input:
+        return run_input_replay(screen, blocks, connections, notes, args, profiler)
     pygame.display.set_caption(caption)
     clock = pygame.time.Clock()
-    font = pygame.font.SysFont("arial", 18)
-    
-    conn_kwargs = create_conn_kwargs(args)
+    font = load_font(args)
+    fps = args.fps or FPS
     
-    dragging_target = None
     running = True
     elapsed = 0.0  # seconds since start
     
     # --- Export init ---
     save_prefix = args.save_prefix
     frame_skip = max(1, int(args.frame_skip))
-    start_idx = max(0, int(args.start_index))
     max_frames = max(0, int(args.max_frames))
     frames_saved = 0
-    frame_index = start_idx
     frame_counter = 0
-    if save_prefix:
-        outdir = os.path.dirname(save_prefix)
-        if outdir:
-            os.makedirs(outdir, exist_ok=True)
-
-    while running:
-        dt_ms = clock.tick(FPS)
-        dt = dt_ms / 1000.0
-        elapsed += dt
-
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
-            elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
-                for block in blocks + (notes or []):
-                    if block.contains(event.pos):
-                        dragging_target = block; block.start_drag(event.pos)
-                        break
-            elif event.type == pygame.MOUSEBUTTONUP and event.button == 1:
-                if dragging_target:
-                    dragging_target.stop_drag()
-                    dragging_target = None
-            elif event.type == pygame.MOUSEMOTION and dragging_target:
-                dragging_target.drag(event.pos)
-
-        # ---- Draw ----
-        screen.fill(BG)
-        draw_grid(screen)
-        for block in blocks:
-            block.draw(screen, font)
-
-        # Draw all connections & their sparks
-        for conn in connections:
-            curve = conn.draw(screen)
-            conn.draw_sparks(screen, curve, elapsed, dt)
-
-        if notes:
-            for block in notes:
-                block.draw(screen, font)
-
-        hud = font.render("KintaroAI.com", True, (180, 190, 200))
-        screen.blit(hud, (10, 10))
-
-        # --- Save frame if requested ---
-        frame_counter += 1
-        if save_prefix and (frame_counter % frame_skip == 0):
-            filename = f"{save_prefix}{frame_index:06d}.png"
-            pygame.image.save(screen, filename)
-            frame_index += 1
-            frames_saved += 1
-            if max_frames and frames_saved >= max_frames:
-                running = False
+    refresh_geometry(connections)
+    sparks = SparkSystem(connections, np.random.default_rng(args.seed))
+    renderer = LayeredRenderer(screen, blocks, connections, notes, font, sparks)
+    renderer.set_tolerance(args.flatten_tolerance)
+    governor = FrameGovernor(fps, args.flatten_tolerance)
+    camera = renderer.camera
+    if args.fit:
+        camera.fit(renderer.content_box())
+    interaction = Interaction(renderer, scene_index(blocks + (notes or []), connections), sparks)
+    recorder = open_input_recorder(args, screen.get_size(), fps)
+    exporting = save_prefix or args.pipe_to_ffmpeg
+    writer = open_frame_writer(args, screen.get_size()) if exporting else None
+    profiler = renderer.profiler = profiler or open_profiler(args)
+    panel_font = system_font("monospace", 13) if args.profile else None
+    feed = open_event_feed(args, sparks)
+
+    try:
+        while running:
+            dt_ms = clock.tick(fps)
+            dt = dt_ms / 1000.0
+            elapsed += dt
+            frame_start = time.perf_counter()
+            profiler.begin_frame()
+            if panel_font and frame_counter % PROFILE_PANEL_EVERY == 0:
+                # Rolling percentiles next to the HUD, refreshed a few times a second
+                lines = profiler.lines()
+                if lines:
+                    renderer.set_panel(render_profile_panel(panel_font, lines))
+                profiler.lap("hud")
+            if feed and frame_counter % PROFILE_PANEL_EVERY == 0:
+                pygame.display.set_caption(f"{caption} | {feed.status()}")
+
+            for event in pygame.event.get():
+                record = input_record(event)
+                if record is None:
+                    continue
+                if recorder:
+                    recorder.write(elapsed, record)
+                if not interaction.handle(record):
+                    running = False
+            if feed:
+                # Sparks for the activity queued by the reader thread since the last frame
+                coalesced = feed.coalesced
+                profiler.count("feed_events", feed.consume(sparks))
+                profiler.count("feed_coalesced", feed.coalesced - coalesced)
+            profiler.lap("events")
+
+            if interaction.refresh():
+                profiler.lap("curves")
+
+            # ---- Draw ----
+            # Cached grid/blocks/curves/notes layers; only the sparks are repainted
+            dirty_rects = renderer.render(elapsed, dt)
+
+            # --- Save frame if requested ---
+            frame_counter += 1
+            if writer and (frame_counter % frame_skip == 0):
+                writer.write(surface_rgb(screen), screen.get_size())
+                frames_saved += 1
+                if max_frames and frames_saved >= max_frames:
+                    running = False
+            profiler.lap("save")
 
-        pygame.display.flip()
+            if dirty_rects is None:
+                pygame.display.flip()
+            else:
+                pygame.display.update(dirty_rects)
+            profiler.lap("flip")
+            profiler.end_frame()
 
+            # Trade curve smoothness for frame rate while frames run over budget
+            tolerance = governor.update(time.perf_counter() - frame_start)
+            if tolerance:
+                renderer.set_tolerance(tolerance)
+    finally:
+        # Also on an exception or Ctrl-C: flush frames still queued for encoding
+        if writer:
+            writer.close()
+        if feed:
+            feed.close()
+    if feed:
+        print(feed.summary())
+    if recorder:
+        recorder.close(blocks + (notes or []))
+        print(f"Recorded {recorder.count} input events to {recorder.path}")
+    if args.profile:
+        profiler.dump(args.profile)
     pygame.quit()
@@ -1,4 +1,3 @@
-import pygame
 from blocks_lib import *
 
 # ---------- Config ----------
@@ -15,11 +14,8 @@ THALAMUS = (1, 87, 155)
 OLFACT = (56, 142, 60)
 
 
-def main():
-    args = parse_args()
-    pygame.init()
-    screen = pygame.display.set_mode((WIDTH, HEIGHT))
-
+def build_scene(args):
+    """Build the motor/sensory pathway scene; returns (blocks, connections, notes)."""
     # --- Blocks (positions chosen to mirror TD flow) ---
     A = Block(390, 30, 220, 80, "Motor Cortex")
     B = Block(390, 130, 220, 80, "Corticospinal Tract")
@@ -75,8 +71,17 @@ def main():
     connections.append(Connection((L, "left", 0.0), (A, "bottom", 0.3),
                                   color=OLFACT, width=3, sparks=3, spark_speed=0.8, **create_conn_kwargs(args)))
 
+    return blocks, connections, None
+
+
+def main():
+    args = parse_args()
+    screen = init_screen(args, (WIDTH, HEIGHT))
+    blocks, connections, notes = build_scene(args)
+
     # Run the main loop
-    run_main_loop(screen, blocks, connections, None, args, "Neuro Flow: Motor/Sensory/Cerebellum/Basal/Thalamus")
+    run_main_loop(screen, blocks, connections, notes, args, "Neuro Flow: Motor/Sensory/Cerebellum/Basal/Thalamus",
+                  build_scene=build_scene)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,73 @@
+import argparse
+import sys
+
+from blocks_lib import *
+from diagram_file import load_diagram
+
+# ---------- Config ----------
+MARGIN = 40
+MAX_WIDTH, MAX_HEIGHT = 1600, 1000  # larger diagrams open clipped; pan/zoom or --fit
+
+
+def split_args(argv=None):
+    """The diagram path, --no-cache and --compact, then the usual blocks_lib flags."""
+    p = argparse.ArgumentParser(description="Animated blocks from a JSON diagram file", add_help=False)
+    p.add_argument("diagram", help="Diagram file: JSON (the blocks_lib.js schema) or a compiled .npz")
+    p.add_argument("--no-cache", action="store_true",
+                   help="Parse the JSON every time instead of reusing the compiled .npz cache")
+    p.add_argument("--compact", action="store_true",
+                   help="Keep connections as columns (DiagramStore) instead of objects: far less memory "
+                        "for very large diagrams")
+    if argv is None:
+        argv = sys.argv[1:]
+    if any(a in ("-h", "--help") for a in argv):
+        p.print_help()
+        print()
+        parse_args(["--help"])
+    own, rest = p.parse_known_args(argv)
+    args = parse_args(rest)
+    args.diagram, args.no_cache, args.compact = own.diagram, own.no_cache, own.compact
+    return args
+
+
+def conn_overrides(args):
+    """Renderer flags that replace the per-connection spark settings of the file."""
+    overrides = {}
+    if args.random_spark_starts:
+        overrides["use_emitter"] = True
+    if args.emit_mult != 1.0:
+        overrides["emit_mult"] = args.emit_mult
+    if args.max_live_sparks:
+        overrides["max_live_sparks"] = args.max_live_sparks
+    return overrides
+
+
+def build_scene(args, data=None):
+    """Build the scene from args.diagram; returns (blocks, connections, notes)."""
+    if data is None:
+        data = load_diagram(args.diagram, cache=not args.no_cache)
+    if args.compact:
+        blocks, connections = data.build_store(Block, **conn_overrides(args))
+    else:
+        blocks, connections = data.build(Block, Connection, **conn_overrides(args))
+    return blocks, connections, []
+
+
+def window_size(data):
+    x0, y0, x1, y1 = data.bounds() or (0, 0, 0, 0)
+    return (max(400, min(MAX_WIDTH, x1 + MARGIN)), max(300, min(MAX_HEIGHT, y1 + MARGIN)))
+
+
+def main():
+    args = split_args()
+    data = load_diagram(args.diagram, cache=not args.no_cache)
+    screen = init_screen(args, window_size(data))
+    blocks, connections, notes = build_scene(args, data)
+
+    # Run the main loop
+    run_main_loop(screen, blocks, connections, notes, args, f"Diagram: {args.diagram}",
+                  build_scene=build_scene)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,445 @@
+"""
+Diagram files for blocks_lib: the JSON schema of Diagram.loadFromJSON in
+blocks_lib.js, plus a compiled columnar cache for fast reloads.
+
+- read_json:    streaming parse of a JSON diagram into columns (DiagramData)
+- write_npz / read_npz: the same columns as an uncompressed .npz
+- load_diagram: read_json behind a cache of .npz files keyed by source hash
+  (the hash itself is reused while the file's size and mtime are unchanged)
+
+The JSON reader takes the same tolerant schema as the web version: blocks
+under "blocks" or "nodes" ({id|name, x, y, w|width, h|height, label|text}),
+connections under "connections", "edges" or "links", with nested
+start/end objects ({block, edge, t}) or flat keys (from/to, src/dst,
+source/target, start_id/end_id, ...). When several aliases of the same
+array are present, the JS priority picks one (blocks before nodes;
+connections, then edges, then links) whatever their order in the file.
+Block ids are matched as JS object keys are, by their string form (so 1
+and "1" name the same block). Colors may be [r, g, b], #rgb, #rrggbb,
+rgb()/rgba() or a name from the JS palette (PALETTE). The reader only
+ever holds one array element of the file in memory next to the typed
+columns, so files larger than half of RAM still load. It needs NumPy and blocks_core's Block/Connection, not
+pygame, so batch tools can compile or inspect diagrams without a display.
+"""
+
+import hashlib
+import json
+import os
+from array import array
+
+import numpy as np
+
+from blocks_core import ARROW_COLOR, EDGES, Block, Connection
+from diagram_store import CONNECTION_DTYPES, DiagramStore
+
+FORMAT_VERSION = 2
+CHUNK = 1 << 20  # bytes read at a time by the streaming parser
+DIAGRAM_CACHE = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                             "neuro-flow", "diagrams")  # compiled .npz files, one per source hash
+
+EDGE_CODES = {name: code for code, name in enumerate(EDGES)}
+
+BLOCK_KEYS = ("blocks", "nodes")  # in the priority of `data.blocks || data.nodes`
+CONNECTION_KEYS = ("connections", "edges", "links")
+
+# Diagram.colors in blocks_lib.js: color names a web diagram may use
+PALETTE = {
+    "motor": "rgb(171,71,188)", "motor2": "rgb(186,104,200)", "sens1": "rgb(77,182,172)",
+    "sens2": "rgb(3,169,244)", "cereb": "rgb(240,98,146)", "basal": "rgb(245,127,23)",
+    "thal": "rgb(1,87,155)", "olf": "rgb(56,142,60)", "arrow": "rgb(230,235,240)",
+}
+
+BLOCK_COLUMNS = ("block_id", "block_rect", "block_label", "block_alpha")
+CONNECTION_COLUMNS = ("start", "start_edge", "start_t", "end", "end_edge", "end_t", "color", "width",
+                      "sparks", "spark_speed", "use_emitter", "emit_mult", "max_live_sparks")
+
+
+def _first(obj, *keys, default=None):
+    """First key present with a non-null value (JS `a ?? b ?? default`)."""
+    for key in keys:
+        value = obj.get(key)
+        if value is not None:
+            return value
+    return default
+
+
+def parse_color(value, colors=None, default=ARROW_COLOR):
+    """
+    RGB tuple from [r, g, b], "#rrggbb", "#rgb", "rgb(r, g, b)", "rgba(r, g, b, a)"
+    or a name in colors (whose value may be any of those). Anything else falls
+    back to default.
+    """
+    if colors and isinstance(value, str) and value in colors:
+        value = colors[value]
+    if isinstance(value, (list, tuple)) and len(value) >= 3:
+        return tuple(max(0, min(255, int(c))) for c in value[:3])
+    if not isinstance(value, str):
+        return default
+    value = value.strip()
+    if value.startswith("#"):
+        digits = value[1:]
+        if len(digits) == 3:
+            digits = "".join(c * 2 for c in digits)
+        if len(digits) == 6:
+            try:
+                rgb = int(digits, 16)
+                return (rgb >> 16, (rgb >> 8) & 255, rgb & 255)
+            except ValueError:
+                pass
+        return default
+    name, paren, args = value.partition("(")
+    if paren and name.strip().lower() in ("rgb", "rgba") and args.endswith(")"):
+        parts = args[:-1].replace(",", " ").replace("/", " ").split()
+        try:
+            channels = [float(c[:-1]) * 2.55 if c.endswith("%") else float(c) for c in parts[:3]]
+        except ValueError:
+            return default
+        if len(channels) == 3:
+            return tuple(max(0, min(255, int(round(c)))) for c in channels)
+    return default
+
+
+def _js_key(value):
+    """A block id as the string key a JS object would file it under (1, 1.0 and "1" are the same block)."""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class _JsonStream:
+    """Incremental reader over a text file: one JSON value at a time, refilling the buffer as needed."""
+
+    def __init__(self, f, chunk=CHUNK):
+        self.f = f
+        self.chunk = chunk
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        data = self.f.read(self.chunk)
+        self.eof = not data
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return data
+
+    def peek(self):
+        """Next non-whitespace character ('' at end of file)."""
+        while True:
+            n = len(self.buf)
+            while self.pos < n and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < n:
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError(f"diagram JSON: expected {' or '.join(map(repr, chars))}, got {c!r}")
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number at the very end of the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def items(self):
+        """Elements of the array starting at the cursor."""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+    def members(self):
+        """(key, stream) pairs of the object starting at the cursor; the caller consumes each value."""
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key, self
+            if self.expect(",}") == "}":
+                return
+
+
+class DiagramData:
+    """
+    A diagram as columns: one array per block or connection field, connection
+    endpoints as block indices and edges as codes into EDGES. build() turns it
+    into Block / Connection objects, build_store() into Blocks over a
+    DiagramStore.
+    """
+
+    def __init__(self, columns):
+        for name in BLOCK_COLUMNS + CONNECTION_COLUMNS:
+            setattr(self, name, columns[name])
+
+    @property
+    def n_blocks(self):
+        return len(self.block_rect)
+
+    @property
+    def n_connections(self):
+        return len(self.start)
+
+    def columns(self):
+        return {name: getattr(self, name) for name in BLOCK_COLUMNS + CONNECTION_COLUMNS}
+
+    def bounds(self):
+        """(x0, y0, x1, y1) around all blocks, or None for an empty diagram."""
+        if not self.n_blocks:
+            return None
+        r = self.block_rect
+        return (int(r[:, 0].min()), int(r[:, 1].min()),
+                int((r[:, 0] + r[:, 2]).max()), int((r[:, 1] + r[:, 3]).max()))
+
+    def build(self, block_cls=Block, connection_cls=Connection, **overrides):
+        """
+        Returns (blocks, connections). Keyword arguments of connection_cls
+        given here (e.g. use_emitter=True) replace the per-connection values.
+        """
+        blocks = [block_cls(x, y, w, h, label, alpha) for (x, y, w, h), label, alpha in
+                  zip(self.block_rect.tolist(), self.block_label.tolist(), self.block_alpha.tolist())]
+        fields = dict(
+            color=map(tuple, self.color.tolist()),
+            width=self.width.tolist(),
+            sparks=self.sparks.tolist(),
+            spark_speed=self.spark_speed.tolist(),
+            use_emitter=self.use_emitter.tolist(),
+            emit_mult=self.emit_mult.tolist(),
+            max_live_sparks=self.max_live_sparks.tolist(),
+        )
+        extra = {name: value for name, value in overrides.items() if name not in fields}
+        names = list(fields)
+        columns = [[overrides[name]] * self.n_connections if name in overrides else fields[name] for name in names]
+        connections = []
+        for s, se, st, e, ee, et, *values in zip(self.start.tolist(), self.start_edge.tolist(), self.start_t.tolist(),
+                                                  self.end.tolist(), self.end_edge.tolist(), self.end_t.tolist(),
+                                                  *columns):
+            connections.append(connection_cls((blocks[s], EDGES[se], st), (blocks[e], EDGES[ee], et),
+                                              **dict(zip(names, values)), **extra))
+        return blocks, connections
+
+    def build_store(self, block_cls=Block, **overrides):
+        """
+        Returns (blocks, connections) with the connections as columns: a
+        DiagramStore's ConnectionRows. overrides replace spark settings as in build().
+        """
+        blocks = [block_cls(x, y, w, h, label, alpha) for (x, y, w, h), label, alpha in
+                  zip(self.block_rect.tolist(), self.block_label.tolist(), self.block_alpha.tolist())]
+        columns = {name: getattr(self, name) for name in CONNECTION_DTYPES}
+        for name, value in overrides.items():
+            if name not in columns:
+                raise TypeError(f"build_store() got an unexpected keyword argument {name!r}")
+            columns[name] = np.full(self.n_connections, value)
+        return blocks, DiagramStore(blocks, columns).connections
+
+
+def _edge_code(name, n):
+    try:
+        return EDGE_CODES[name]
+    except KeyError:
+        raise ValueError(f"connection {n}: invalid edge {name!r}") from None
+
+
+def _read_blocks(items):
+    """Columns of one blocks / nodes array."""
+    ids, labels, rect, alpha = [], [], array("i"), array("B")
+    for b in items:
+        ids.append(_js_key(_first(b, "id", "name", default=len(ids))))
+        rect.extend(round(v) for v in (b.get("x", 0), b.get("y", 0), _first(b, "w", "width", default=0),
+                                       _first(b, "h", "height", default=0)))
+        labels.append(str(_first(b, "label", "text", default="")))
+        alpha.append(max(0, min(255, int(b.get("alpha", 255)))))
+    return dict(ids=ids, labels=labels, rect=rect, alpha=alpha)
+
+
+def _read_connections(items, colors):
+    """Columns of one connections / edges / links array, endpoints still as block ids."""
+    c = dict(ends=[], start_edge=array("B"), end_edge=array("B"), start_t=array("d"), end_t=array("d"),
+             color=array("B"), width=array("i"), sparks=array("i"), spark_speed=array("d"),
+             use_emitter=array("B"), emit_mult=array("d"), max_live=array("i"))
+    ends = c["ends"]
+    for e in items:
+        start = e.get("start") or dict(block=_first(e, "start_id", "from", "src", "source"),
+                                        edge=_first(e, "start_edge", "edge_from", default="right"),
+                                        t=_first(e, "start_t", "t_from", default=0))
+        end = e.get("end") or dict(block=_first(e, "end_id", "to", "dst", "target"),
+                                    edge=_first(e, "end_edge", "edge_to", default="left"),
+                                    t=_first(e, "end_t", "t_to", default=0))
+        c["start_edge"].append(_edge_code(start.get("edge", "right"), len(ends)))
+        c["end_edge"].append(_edge_code(end.get("edge", "left"), len(ends)))
+        ends.append((_js_key(start.get("block")), _js_key(end.get("block"))))
+        c["start_t"].append(float(start.get("t", 0)))
+        c["end_t"].append(float(end.get("t", 0)))
+        c["color"].extend(parse_color(_first(e, "color", "stroke"), colors))
+        c["width"].append(int(round(_first(e, "width", "stroke_width", default=3))))
+        c["sparks"].append(int(_first(e, "sparks", "spark_count", default=0)))
+        c["spark_speed"].append(float(_first(e, "spark_speed", "sparkSpeed", default=0.8)))
+        c["use_emitter"].append(bool(_first(e, "emitter", "random", default=False)))
+        c["emit_mult"].append(float(_first(e, "emit_mult", "emitMult", default=1.0)))
+        c["max_live"].append(int(_first(e, "max_live", "maxLive", default=0)))
+    return c
+
+
+def read_json(path, colors=None, chunk=CHUNK):
+    """
+    Stream-parse a JSON diagram file into DiagramData (see the module docstring
+    for the schema). colors maps color names to colors; default PALETTE.
+    """
+    colors = PALETTE if colors is None else colors
+    found = {}  # alias key -> its columns; the JS priority picks among them below
+    with open(path, encoding="utf-8") as f:
+        stream = _JsonStream(f, chunk)
+        for key, value in stream.members():
+            if key in found or key not in BLOCK_KEYS + CONNECTION_KEYS or value.peek() != "[":
+                value.value()  # unrelated key, a repeated key or no array (JS falls through on null)
+                continue
+            found[key] = _read_blocks(value.items()) if key in BLOCK_KEYS else _read_connections(value.items(), colors)
+    blocks = next((found[key] for key in BLOCK_KEYS if key in found), None) or _read_blocks(())
+    conns = next((found[key] for key in CONNECTION_KEYS if key in found), None) or _read_connections((), colors)
+    del found
+
+    ids = blocks["ids"]
+    index = {block_id: i for i, block_id in enumerate(ids)}
+    start, end = array("i"), array("i")
+    for n, (s, e) in enumerate(conns.pop("ends")):
+        for block_id, column in ((s, start), (e, end)):
+            if block_id not in index:
+                raise ValueError(f"connection {n}: unknown block {block_id!r}")
+            column.append(index[block_id])
+
+    def column(values, dtype, shape=(-1,)):
+        if not values:
+            return np.zeros((0,) + shape[1:], dtype)
+        return np.frombuffer(values, dtype=dtype).reshape(shape)
+
+    return DiagramData(dict(
+        block_id=np.array(ids, dtype=str),
+        block_rect=column(blocks["rect"], np.intc, (-1, 4)),
+        block_label=np.array(blocks["labels"], dtype=str),
+        block_alpha=column(blocks["alpha"], np.uint8),
+        start=column(start, np.intc),
+        start_edge=column(conns["start_edge"], np.uint8),
+        start_t=column(conns["start_t"], np.float64),
+        end=column(end, np.intc),
+        end_edge=column(conns["end_edge"], np.uint8),
+        end_t=column(conns["end_t"], np.float64),
+        color=column(conns["color"], np.uint8, (-1, 3)),
+        width=column(conns["width"], np.intc),
+        sparks=column(conns["sparks"], np.intc),
+        spark_speed=column(conns["spark_speed"], np.float64),
+        use_emitter=column(conns["use_emitter"], np.uint8).astype(bool),
+        emit_mult=column(conns["emit_mult"], np.float64),
+        max_live_sparks=column(conns["max_live"], np.intc),
+    ))
+
+
+def write_npz(data, path, source_hash=""):
+    """Save the columns uncompressed (loading is then a read per column); the write is atomic."""
+    tmp = f"{path}.{os.getpid()}"
+    with open(tmp, "wb") as f:
+        np.savez(f, format_version=FORMAT_VERSION, source_hash=source_hash, **data.columns())
+    os.replace(tmp, path)
+
+
+def read_npz(path, source_hash=None):
+    """DiagramData from write_npz; None if the file is from another format version or source."""
+    with np.load(path, allow_pickle=False) as f:
+        if int(f["format_version"]) != FORMAT_VERSION:
+            return None
+        if source_hash is not None and str(f["source_hash"]) != source_hash:
+            return None
+        return DiagramData({name: f[name] for name in BLOCK_COLUMNS + CONNECTION_COLUMNS})
+
+
+def source_hash(path, colors=None, chunk=CHUNK):
+    """Digest of the file bytes, the format version and the color names they were resolved with."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{FORMAT_VERSION}:{json.dumps(colors, sort_keys=True)}:".encode())
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(chunk), b""):
+            h.update(data)
+    return h.hexdigest()
+
+
+def _cached_hash(path, colors, cache_dir):
+    """
+    source_hash(path, colors), reusing the last digest taken of the file while
+    its size and mtime are unchanged (index.json in cache_dir).
+    """
+    st = os.stat(path)
+    stamp = [st.st_size, st.st_mtime_ns, json.dumps(colors, sort_keys=True)]
+    index_path = os.path.join(cache_dir, "index.json")
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    key = os.path.abspath(path)
+    entry = index.get(key)
+    if entry and entry[:3] == stamp:
+        return entry[3]
+    digest = source_hash(path, colors)
+    index[key] = stamp + [digest]
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f"{index_path}.{os.getpid()}"
+        with open(tmp, "w") as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp, index_path)
+    except OSError:
+        pass  # read-only cache: hash again next time
+    return digest
+
+
+def load_diagram(path, colors=None, cache=True, cache_dir=DIAGRAM_CACHE):
+    """
+    DiagramData for a .json or .npz diagram. JSON is parsed once: the columns
+    are kept in cache_dir under the hash of the source, so reloading an
+    unchanged file only reads the arrays back. colors as in read_json.
+    """
+    colors = PALETTE if colors is None else colors
+    if path.endswith(".npz"):
+        data = read_npz(path)
+        if data is None:
+            raise ValueError(f"{path}: not a diagram file of format version {FORMAT_VERSION}")
+        return data
+    if not cache:
+        return read_json(path, colors)
+    digest = _cached_hash(path, colors, cache_dir)
+    cached = os.path.join(cache_dir, digest + ".npz")
+    try:
+        data = read_npz(cached, digest)
+        if data is not None:
+            return data
+    except (OSError, ValueError, KeyError):
+        pass  # missing or truncated: parse again
+    data = read_json(path, colors)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_npz(data, cached, digest)
+    except OSError:
+        pass  # read-only cache: parse again next time
+    return data
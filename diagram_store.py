@@ -0,0 +1,324 @@
+"""
+Compact, columnar scenes for very large diagrams (diagram.py --compact).
+
+A DiagramStore holds a diagram in typed NumPy arrays instead of one Python
+object per connection with its own floats, tuples and cached polylines:
+
+- blocks:      block_rect (B, 4) int32, the source of truth for positions;
+               each Block object stays (labels, drag state, rendered surface)
+               but its rect is a RectView into this column
+- connections: start/end block rows, edge codes (EDGES), offsets, color,
+               width and the spark settings, one array per field
+- geometry:    curves (M, 4, 2) control points, bounds (M, 4) culling boxes
+               and arc_points (M, CURVE_SAMPLES + 1, 2) float32 arc-length
+               tables, computed in vectorized batches (anchor_points,
+               nice_controls_array) and refreshed only for stale rows; drawing
+               polylines are flattened lazily and kept as float32 arrays
+
+ConnectionView is a Connection over one row, made on demand and holding
+nothing else, and ConnectionRows a sequence of them (all connections, or a
+block's incident ones via a CSR adjacency index). blocks_core dispatches on
+the rows' `store`: refresh_geometry, refresh_strokes, invalidate_connections,
+scene_index and SparkSystem work on the columns, and LayeredRenderer strokes
+straight from them. The store itself never draws: building and querying one
+needs only NumPy and blocks_core.
+"""
+
+import math
+
+import numpy as np
+
+from blocks_core import (ARROW_HEAD_ANGLE, ARROW_HEAD_LEN, CURVE_SAMPLES, EDGE_VECTORS, EDGES, FLATTEN_TOLERANCE,
+                         PICK_CHUNK, PICK_TOLERANCE, Connection, Rect, Vec2, anchor_points, arc_length_tables, arrowhead_points,
+                         bezier_polylines, brighten, cubic_bezier_tangent, flatten_curves, nice_controls_array,
+                         resample_uniform)
+
+CHUNK = 16384  # rows per batch of geometry work; bounds the temporaries of a refresh or pick
+
+CONNECTION_DTYPES = dict(
+    start=np.int32, end=np.int32, start_edge=np.uint8, end_edge=np.uint8,
+    start_t=np.float64, end_t=np.float64, color=np.uint8, width=np.int16,
+    sparks=np.int32, spark_speed=np.float64, use_emitter=bool, emit_mult=np.float64, max_live_sparks=np.int32,
+)
+
+
+class RectView(Rect):
+    """Rect whose x, y, w, h are one row of DiagramStore.block_rect (writes move the block in the column)."""
+    __slots__ = ("_row",)
+
+    def __init__(self, row):
+        self._row = row
+
+    def _field(i):
+        def get(self):
+            return int(self._row[i])
+
+        def set(self, value):
+            self._row[i] = int(value)
+        return property(get, set)
+
+    x, y, w, h = _field(0), _field(1), _field(2), _field(3)
+    del _field
+
+
+class ConnectionView(Connection):
+    """One connection of a DiagramStore with the Connection interface; geometry comes from the columns."""
+    __slots__ = ("store", "row")
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    def _column(name, convert):
+        return property(lambda self: convert(getattr(self.store, name)[self.row]))
+
+    start_block = property(lambda self: self.store.blocks[self.store.start[self.row]])
+    end_block = property(lambda self: self.store.blocks[self.store.end[self.row]])
+    start_edge = property(lambda self: EDGES[self.store.start_edge[self.row]])
+    end_edge = property(lambda self: EDGES[self.store.end_edge[self.row]])
+    start_t = _column("start_t", float)
+    end_t = _column("end_t", float)
+    color = property(lambda self: tuple(self.store.color[self.row].tolist()))
+    spark_color = property(lambda self: brighten(self.color, 30))
+    width = _column("width", int)
+    sparks = _column("sparks", int)
+    spark_speed = _column("spark_speed", float)
+    use_emitter = _column("use_emitter", bool)
+    emit_mult = _column("emit_mult", float)
+    max_live_sparks = _column("max_live_sparks", int)
+    del _column
+
+    def __eq__(self, other):
+        return isinstance(other, ConnectionView) and other.store is self.store and other.row == self.row
+
+    def __hash__(self):
+        return hash((id(self.store), self.row))
+
+    def __repr__(self):
+        return f"<ConnectionView {self.row}>"
+
+    def invalidate(self):
+        self.store.invalidate([self.row])
+
+    def curve(self):
+        self.store.refresh(np.array([self.row]))
+        return tuple(Vec2(x, y) for x, y in self.store.curves[self.row].tolist())
+
+    def polyline(self):
+        self.curve()
+        return bezier_polylines(self.store.curves[self.row][None])[0]
+
+    def stroke(self, tolerance=FLATTEN_TOLERANCE):
+        return self.store.strokes(np.array([self.row]), tolerance)[0].tolist()
+
+    def arc_table(self):
+        polyline = self.polyline()[None]
+        cum, total = arc_length_tables(polyline)
+        return cum[0], float(total[0]), resample_uniform(polyline, cum)[0]
+
+    def bounds(self):
+        self.curve()
+        return tuple(self.store.bounds[self.row].tolist())
+
+    def arrowhead(self):
+        p0, c1, c2, p3 = self.curve()
+        return arrowhead_points(p3, cubic_bezier_tangent(p0, c1, c2, p3, 1.0)) or ()
+
+
+class ConnectionRows:
+    """
+    Sequence of the ConnectionViews of some rows of a store (all of them, or a
+    block's incident ones). blocks_core helpers act on `rows` in one batch.
+    """
+    __slots__ = ("store", "rows")
+
+    def __init__(self, store, rows):
+        self.store = store
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return ConnectionRows(self.store, self.rows[i])
+        return ConnectionView(self.store, int(self.rows[i]))
+
+    def __iter__(self):
+        store = self.store
+        return (ConnectionView(store, row) for row in self.rows.tolist())
+
+
+class StoreIndex:
+    """
+    SceneIndex for a DiagramStore: the same queries answered by vectorized
+    scans over the block rects and curve bounds instead of grids of Python
+    objects. Moves need no re-indexing, and a pick costs
+    a pass over the bounds plus the candidate curves.
+    """
+    def __init__(self, store, blocks):
+        self.store = store
+        self.extra = list(blocks[len(store.blocks):])  # e.g. notes, scanned after the store's blocks
+
+    def update_block(self, block):
+        pass  # the scans read the live columns
+
+    def pick_block(self, pos):
+        x, y = pos
+        r = self.store.block_rect
+        hit = np.flatnonzero((r[:, 0] <= x) & (x < r[:, 0] + r[:, 2]) & (r[:, 1] <= y) & (y < r[:, 1] + r[:, 3]))
+        if len(hit):
+            return self.store.blocks[hit[0]]  # earlier blocks win, as in SceneIndex
+        return next((block for block in self.extra if block.contains(pos)), None)
+
+    def pick_connection(self, pos, tolerance=PICK_TOLERANCE):
+        """Closest connection whose stroke passes within tolerance px of pos, else None."""
+        store = self.store
+        store.refresh()
+        x, y = pos
+        b = store.bounds
+        rows = np.flatnonzero((b[:, 0] - tolerance <= x) & (x <= b[:, 2] + tolerance)
+                              & (b[:, 1] - tolerance <= y) & (y <= b[:, 3] + tolerance))
+        p = np.asarray(pos, dtype=float)
+        best, best_dist = None, tolerance
+        for lo in range(0, len(rows), CHUNK):
+            chunk = rows[lo:lo + CHUNK]
+            pts = bezier_polylines(store.curves[chunk])  # the polylines SceneIndex tests
+            a = pts[:, :-1]
+            d = pts[:, 1:] - a
+            dd = (d * d).sum(axis=2)
+            u = np.clip(((p - a) * d).sum(axis=2) / np.where(dd > 0, dd, 1.0), 0.0, 1.0)
+            dist = np.sqrt(((a + d * u[..., None] - p) ** 2).sum(axis=2)).min(axis=1) - store.width[chunk] / 2
+            i = int(np.argmin(dist))
+            if dist[i] <= best_dist:
+                best, best_dist = int(chunk[i]), float(dist[i])
+        return None if best is None else ConnectionView(store, best)
+
+    def query_rect(self, rect):
+        """(blocks, connections) overlapping rect, e.g. for marquee selection."""
+        x, y, w, h = rect
+        x1, y1 = x + w - 1, y + h - 1
+        store = self.store
+        store.refresh()
+        r = store.block_rect
+        hit = np.flatnonzero((r[:, 0] <= x1) & (x <= r[:, 0] + r[:, 2]) & (r[:, 1] <= y1) & (y <= r[:, 1] + r[:, 3]))
+        blocks = [store.blocks[i] for i in hit.tolist()]
+        blocks += [b for b in self.extra if b.rect.left <= x1 and x <= b.rect.right
+                   and b.rect.top <= y1 and y <= b.rect.bottom]
+        b = store.bounds
+        rows = np.flatnonzero((b[:, 0] <= x1) & (x <= b[:, 2]) & (b[:, 1] <= y1) & (y <= b[:, 3]))
+        # Then the padded pieces of PICK_CHUNK segments that SceneIndex indexes
+        starts = np.arange(0, CURVE_SAMPLES, PICK_CHUNK)
+        ends = np.minimum(starts + PICK_CHUNK, CURVE_SAMPLES)
+        hits = []
+        for lo in range(0, len(rows), CHUNK):
+            chunk = rows[lo:lo + CHUNK]
+            pts = bezier_polylines(store.curves[chunk])
+            pad = (np.maximum(store.width[chunk] / 2, store._head_pad) + 1)[:, None]
+            p0 = np.minimum(np.minimum.reduceat(pts, starts, axis=1), pts[:, ends]) - pad[..., None]
+            p1 = np.maximum(np.maximum.reduceat(pts, starts, axis=1), pts[:, ends]) + pad[..., None]
+            hit = (p0[..., 0] <= x1) & (x <= p1[..., 0]) & (p0[..., 1] <= y1) & (y <= p1[..., 1])
+            hits.append(chunk[hit.any(axis=1)])
+        return blocks, list(ConnectionRows(store, np.concatenate(hits) if hits else rows))
+
+
+class DiagramStore:
+    """
+    A scene as columns (see the module docstring). blocks are Block objects,
+    rebound onto block_rect; columns maps the CONNECTION_DTYPES names to
+    arrays (start/end are rows of blocks, edges codes into EDGES).
+    `connections` is the ConnectionRows over every row.
+    """
+    def __init__(self, blocks, columns):
+        self.blocks = blocks
+        self.block_rect = np.array([tuple(block.rect) for block in blocks], dtype=np.int32).reshape(-1, 4)
+        for i, block in enumerate(blocks):
+            block.rect = RectView(self.block_rect[i])
+        for name, dtype in CONNECTION_DTYPES.items():
+            setattr(self, name, np.ascontiguousarray(columns[name], dtype=dtype))
+        self.color = self.color.reshape(-1, 3)
+        m = len(self.start)
+        self.sparks = np.maximum(self.sparks, 0)
+        self.spark_speed = np.maximum(self.spark_speed, 0.0)
+
+        # Derived geometry, computed for every row on the first refresh()
+        self.curves = np.zeros((m, 4, 2))
+        self.bounds = np.zeros((m, 4))
+        self.arc_points = np.zeros((m, CURVE_SAMPLES + 1, 2), dtype=np.float32)
+        self._stale = np.ones(m, dtype=bool)
+        self._strokes = [None] * m  # float32 polylines at _tolerance, valid where _stroked
+        self._stroked = np.zeros(m, dtype=bool)
+        self._tolerance = None
+        self._head_pad = ARROW_HEAD_LEN * math.sin(ARROW_HEAD_ANGLE)
+
+        # Incident connections per block (CSR), in connection order like Block.connections
+        loops = self.end == self.start
+        owner = np.concatenate([self.start, self.end[~loops]])
+        rows = np.concatenate([np.arange(m, dtype=np.int32), np.flatnonzero(~loops).astype(np.int32)])
+        order = np.lexsort((rows, owner))
+        self.incident = rows[order]
+        self.incident_ptr = np.zeros(len(blocks) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(owner, minlength=len(blocks)), out=self.incident_ptr[1:])
+        for i, block in enumerate(blocks):
+            block.connections = ConnectionRows(self, self.incident[self.incident_ptr[i]:self.incident_ptr[i + 1]])
+        self.connections = ConnectionRows(self, np.arange(m, dtype=np.int32))
+
+    def __len__(self):
+        return len(self.start)
+
+    def nbytes(self):
+        """Bytes held in the store's arrays (columns, geometry, index and cached strokes)."""
+        arrays = [value for value in vars(self).values() if isinstance(value, np.ndarray)]
+        strokes = {id(pts.base if pts.base is not None else pts): pts.base if pts.base is not None else pts
+                   for pts in self._strokes if pts is not None}
+        return sum(a.nbytes for a in arrays) + sum(a.nbytes for a in strokes.values())
+
+    def invalidate(self, rows):
+        """Mark rows stale after a block moved; recomputed by the next refresh() or strokes()."""
+        self._stale[rows] = True
+        self._stroked[rows] = False
+
+    def refresh(self, rows=None):
+        """Recompute curves, bounds and arc-length tables of the stale rows among rows (default all)."""
+        stale = np.flatnonzero(self._stale) if rows is None else rows[self._stale[rows]]
+        for lo in range(0, len(stale), CHUNK):
+            self._compute(stale[lo:lo + CHUNK])
+
+    def _compute(self, rows):
+        rect = self.block_rect
+        start, end = self.start[rows], self.end[rows]
+        p0 = anchor_points(rect[start], self.start_edge[rows], self.start_t[rows])
+        p3 = anchor_points(rect[end], self.end_edge[rows], self.end_t[rows])
+        d0, d3 = EDGE_VECTORS[self.start_edge[rows]], -EDGE_VECTORS[self.end_edge[rows]]
+        c1, c2 = nice_controls_array(p0, d0, p3, d3)
+        curves = np.stack([p0, c1, c2, p3], axis=1)
+        self.curves[rows] = curves
+        pad = np.maximum(self.width[rows] / 2, self._head_pad) + 1
+        self.bounds[rows] = np.column_stack([curves[..., 0].min(axis=1) - pad, curves[..., 1].min(axis=1) - pad,
+                                             curves[..., 0].max(axis=1) + pad, curves[..., 1].max(axis=1) + pad])
+        polylines = bezier_polylines(curves)
+        cum, _ = arc_length_tables(polylines)
+        self.arc_points[rows] = resample_uniform(polylines, cum)
+        self._stale[rows] = False
+
+    def strokes(self, rows, tolerance=FLATTEN_TOLERANCE):
+        """Drawing polylines of rows, flattened to tolerance px: a list of float32 (n_i + 1, 2) arrays."""
+        if tolerance != self._tolerance:
+            self._tolerance = tolerance
+            self._stroked[:] = False
+        self.refresh(rows)
+        need = rows[~self._stroked[rows]]
+        strokes = self._strokes
+        for lo in range(0, len(need), CHUNK):
+            chunk = need[lo:lo + CHUNK]
+            for row, pts in zip(chunk.tolist(), flatten_curves(self.curves[chunk], tolerance, np.float32)):
+                strokes[row] = pts
+        self._stroked[need] = True
+        return [strokes[row] for row in rows.tolist()]
+
+    def connection(self, row):
+        return ConnectionView(self, int(row))
+
+    def index(self, blocks=None):
+        """StoreIndex for picking; blocks beyond the store's own (e.g. notes) are scanned after them."""
+        return StoreIndex(self, self.blocks if blocks is None else blocks)
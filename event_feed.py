@@ -0,0 +1,365 @@
+"""
+Live spark events for blocks_lib: activity records read from a UNIX socket,
+a named pipe, a tailed file or stdin, turned into sparks once per frame.
+
+A record is (connection, timestamp, intensity):
+- connection: index into the scene's connection list (construction order)
+- timestamp:  seconds on the producer's clock (any epoch)
+- intensity:  sparks the event is worth; the events of one connection in a
+              frame are summed and rounded up (so any positive event shows)
+
+Two wire formats: "text", one `conn timestamp intensity` line per event
+(whitespace or commas, # comments), and "binary", packed little-endian
+records of RECORD (uint32 conn, float32 intensity, float64 timestamp).
+
+EventFeed runs an asyncio loop on a daemon thread. The reader decodes whole
+chunks into NumPy batches and appends them to a deque; the render loop
+drains it once per frame with consume(). deque.append/popleft are atomic,
+and every counter has a single writer thread, so the handoff takes no lock.
+Under overload the backlog is bounded (max_pending events): drop-oldest
+evicts queued batches (and keeps only the last max_pending events of an
+oversize one), drop-newest discards incoming ones. Events older than
+max_lag seconds behind the newest timestamp seen are dropped as stale, and
+at most max_per_frame sparks per connection are spawned per frame. Events
+that share a spark with others, or fall past that cap, count as coalesced.
+"""
+
+import asyncio
+import os
+import stat
+import sys
+import threading
+from collections import deque
+
+import numpy as np
+
+RECORD = np.dtype([("conn", "<u4"), ("intensity", "<f4"), ("time", "<f8")])
+FORMATS = ("text", "binary")
+POLICIES = ("drop-oldest", "drop-newest")
+
+CHUNK = 1 << 16  # bytes per read
+MAX_PENDING = 1 << 20  # events queued between two frames before the drop policy applies
+MAX_PER_FRAME = 8  # sparks spawned per connection per frame
+TAIL_POLL = 0.01  # seconds between polls of a tailed file
+
+_WHITESPACE = np.zeros(256, dtype=bool)  # bytes.split() separators, by byte value
+_WHITESPACE[list(b" \t\n\r\x0b\x0c")] = True
+
+
+def parse_source(spec):
+    """
+    (kind, path) from a --events value: unix:PATH (listen on a socket),
+    fifo:PATH (named pipe, created if missing), file:PATH (tail), - (stdin).
+    A bare path is a pipe if it is one, otherwise a tailed file.
+    """
+    if spec == "-":
+        return "stdin", None
+    kind, sep, path = spec.partition(":")
+    if sep and kind in ("unix", "fifo", "file"):
+        return kind, path
+    try:
+        if stat.S_ISFIFO(os.stat(spec).st_mode):
+            return "fifo", spec
+    except OSError:
+        pass
+    return "file", spec
+
+
+class EventDecoder:
+    """Bytes from one stream -> (conn, time, intensity) arrays; partial records wait for the next chunk."""
+
+    def __init__(self, fmt="text"):
+        if fmt not in FORMATS:
+            raise ValueError(f"unknown event format {fmt!r}")
+        self.fmt = fmt
+        self.rest = b""
+        self.malformed = 0
+
+    def feed(self, data):
+        data = self.rest + data
+        if self.fmt == "binary":
+            whole = len(data) - len(data) % RECORD.itemsize
+            self.rest = data[whole:]
+            records = np.frombuffer(data, RECORD, whole // RECORD.itemsize)
+            return (records["conn"].astype(np.intp), records["time"].astype(float),
+                    records["intensity"].astype(float))
+        end = data.rfind(b"\n") + 1
+        self.rest = data[end:]
+        return self._parse_lines(data[:end])
+
+    def _parse_lines(self, text):
+        text = text.replace(b",", b" ")
+        tokens = text.split()
+        if _three_per_line(text, len(tokens)):
+            try:
+                values = np.array(tokens).astype(float).reshape(-1, 3)
+                return values[:, 0].astype(np.intp), values[:, 1], values[:, 2]
+            except ValueError:
+                pass
+        # Slow path: blank lines, comments or bad records somewhere in the chunk
+        rows = []
+        for line in text.splitlines():
+            fields = line.split()
+            if not fields or fields[0].startswith(b"#"):
+                continue
+            try:
+                conn, timestamp, intensity = map(float, fields)
+            except ValueError:
+                self.malformed += 1
+                continue
+            rows.append((conn, timestamp, intensity))
+        values = np.array(rows, dtype=float).reshape(-1, 3)
+        return values[:, 0].astype(np.intp), values[:, 1], values[:, 2]
+
+
+def _three_per_line(text, n_tokens):
+    """Whether every line of text (ending in a newline) holds exactly three of its n_tokens fields."""
+    newlines = text.count(b"\n")
+    if n_tokens != 3 * newlines:
+        return False
+    b = np.frombuffer(text, dtype=np.uint8)
+    space = _WHITESPACE[b]
+    starts = np.flatnonzero(~space[1:] & space[:-1]) + 1
+    if len(b) and not space[0]:
+        starts = np.concatenate(([0], starts))
+    ends = np.flatnonzero(b == ord("\n"))
+    # Fields 3k..3k+2 must all fall between newline k-1 and newline k
+    return bool((starts[2::3] < ends).all() and (starts[3::3] > ends[:-1]).all())
+
+
+def coalesce(conn, intensity, n_connections, max_per_frame=MAX_PER_FRAME):
+    """Sparks per connection for one frame of events: summed intensity, rounded up, capped."""
+    weight = np.bincount(conn, weights=np.maximum(intensity, 0.0), minlength=n_connections)
+    return np.minimum(np.ceil(weight - 1e-9), max_per_frame).astype(np.intp)
+
+
+class EventFeed:
+    """
+    Background reader of spark events (see the module docstring).
+    start() launches the reader thread; call consume(sparks) once per frame
+    and close() on exit.
+    """
+
+    def __init__(self, source, fmt="text", policy="drop-oldest", max_pending=MAX_PENDING,
+                 max_lag=0.0, max_per_frame=MAX_PER_FRAME):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown drop policy {policy!r}")
+        self.source = source
+        self.kind, self.path = parse_source(source)
+        self.fmt = fmt
+        self.policy = policy
+        self.max_pending = max(1, int(max_pending))
+        self.max_lag = max_lag
+        self.max_per_frame = max_per_frame
+        self._batches = deque()
+        self._decoders = []
+        self._thread = None
+        self._loop = None
+        self._stop = None
+        # Reader thread counters
+        self.received = 0
+        self.overload = 0  # dropped by the policy
+        self._queued = 0
+        self._evicted = 0
+        # Render thread counters
+        self._taken = 0
+        self.stale = 0
+        self.unknown = 0  # connection index out of range
+        self.rendered = 0  # sparks spawned
+        self.coalesced = 0  # events merged into another event's spark, or past max_per_frame
+        self.newest = -np.inf  # latest timestamp seen
+        self.error = None
+
+    @property
+    def malformed(self):
+        return sum(decoder.malformed for decoder in self._decoders)
+
+    @property
+    def dropped(self):
+        return self.overload + self.stale + self.unknown + self.malformed
+
+    @property
+    def pending(self):
+        return self._queued - self._taken - self._evicted
+
+    # --- reader thread ---
+
+    def start(self):
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(ready,), name="event-feed", daemon=True)
+        self._thread.start()
+        ready.wait(5.0)
+        if self.error:
+            raise self.error
+        return self
+
+    def _run(self, ready):
+        try:
+            asyncio.run(self._main(ready))
+        except Exception as e:
+            self.error = e
+        ready.set()
+
+    async def _main(self, ready):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        reader = getattr(self, f"_read_{self.kind}")
+        task = asyncio.ensure_future(reader(ready))
+        stop = asyncio.ensure_future(self._stop.wait())
+        done, _ = await asyncio.wait((task, stop), return_when=asyncio.FIRST_COMPLETED)
+        if task in done and task.exception():
+            self.error = task.exception()
+        for t in (task, stop):
+            t.cancel()
+        await asyncio.gather(task, stop, return_exceptions=True)
+        ready.set()
+
+    def _push(self, batch):
+        conn = batch[0]
+        n = len(conn)
+        if not n:
+            return
+        self.received += n
+        if self.pending + n > self.max_pending:
+            if self.policy == "drop-newest":
+                self.overload += n
+                return
+            if n > self.max_pending:
+                self.overload += n - self.max_pending
+                batch = tuple(column[-self.max_pending:] for column in batch)
+                n = self.max_pending
+            while self.pending + n > self.max_pending:
+                try:
+                    old = self._batches.popleft()
+                except IndexError:  # drained by the render thread meanwhile
+                    break
+                self._evicted += len(old[0])
+                self.overload += len(old[0])
+        self._batches.append(batch)
+        self._queued += n
+
+    async def _pump(self, reader):
+        decoder = EventDecoder(self.fmt)
+        self._decoders.append(decoder)
+        while True:
+            data = await reader.read(CHUNK)
+            if not data:
+                return
+            self._push(decoder.feed(data))
+
+    async def _read_unix(self, ready):
+        if os.path.exists(self.path) and stat.S_ISSOCK(os.stat(self.path).st_mode):
+            os.unlink(self.path)  # stale socket of an earlier run
+
+        async def client(reader, writer):
+            try:
+                await self._pump(reader)
+            finally:
+                writer.close()
+
+        server = await asyncio.start_unix_server(client, self.path)
+        ready.set()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            server.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    async def _pipe_reader(self, f):
+        reader = asyncio.StreamReader(limit=CHUNK)
+        await self._loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), f)
+        return reader
+
+    async def _read_fifo(self, ready):
+        if not os.path.exists(self.path):
+            os.mkfifo(self.path)
+        f = os.fdopen(os.open(self.path, os.O_RDONLY | os.O_NONBLOCK), "rb", 0)
+        # Hold a write end open ourselves so writers can come and go without EOF
+        keep = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+        try:
+            reader = await self._pipe_reader(f)
+            ready.set()
+            await self._pump(reader)
+        finally:
+            os.close(keep)
+
+    async def _read_stdin(self, ready):
+        reader = await self._pipe_reader(sys.stdin.buffer)
+        ready.set()
+        await self._pump(reader)
+
+    async def _read_file(self, ready):
+        decoder = EventDecoder(self.fmt)
+        self._decoders.append(decoder)
+        with open(self.path, "rb") as f:
+            f.seek(0, os.SEEK_END)  # only new records, like tail -f
+            ready.set()
+            while True:
+                data = f.read(CHUNK)
+                if data:
+                    self._push(decoder.feed(data))
+                    continue
+                if os.fstat(f.fileno()).st_size < f.tell():
+                    f.seek(0)  # truncated: start over
+                    decoder.rest = b""
+                await asyncio.sleep(TAIL_POLL)
+
+    def close(self):
+        if self._loop and self._stop and self._thread.is_alive():
+            self._loop.call_soon_threadsafe(self._stop.set)
+            self._thread.join(2.0)
+
+    # --- render thread ---
+
+    def drain(self):
+        """Every queued event as (conn, time, intensity) arrays."""
+        batches = []
+        while True:
+            try:
+                batch = self._batches.popleft()
+            except IndexError:
+                break
+            self._taken += len(batch[0])
+            batches.append(batch)
+        if not batches:
+            return None
+        if len(batches) == 1:
+            return batches[0]
+        return tuple(np.concatenate(column) for column in zip(*batches))
+
+    def consume(self, sparks):
+        """Turn the events queued since the last frame into sparks; returns the number of events taken."""
+        batch = self.drain()
+        if batch is None:
+            return 0
+        conn, timestamp, intensity = batch
+        n = len(conn)
+        self.newest = max(self.newest, float(timestamp.max()))
+        keep = (conn >= 0) & (conn < len(sparks.connections))
+        self.unknown += int(n - keep.sum())
+        if self.max_lag > 0:
+            fresh = timestamp >= self.newest - self.max_lag
+            self.stale += int((keep & ~fresh).sum())
+            keep &= fresh
+        if not keep.all():
+            conn, timestamp, intensity = conn[keep], timestamp[keep], intensity[keep]
+        counts = coalesce(conn, intensity, len(sparks.connections), self.max_per_frame)
+        events = np.bincount(conn, minlength=len(counts))
+        self.coalesced += int(np.maximum(events - counts, 0).sum())
+        self.rendered += sparks.inject(counts)
+        return n
+
+    def status(self):
+        """One line of counters, for the window caption."""
+        return (f"events {self.received} received, {self.dropped} dropped, {self.coalesced} coalesced, "
+                f"{self.rendered} sparks"
+                + (f", {self.pending} pending" if self.pending else ""))
+
+    def summary(self):
+        lines = [f"Events from {self.source}: {self.received} received, {self.rendered} sparks rendered, "
+                 f"{self.coalesced} coalesced, {self.dropped} dropped (overload {self.overload}, stale {self.stale}, "
+                 f"unknown connection {self.unknown}, malformed {self.malformed})"]
+        if self.error:
+            lines.append(f"Event reader stopped: {self.error}")
+        return "\n".join(lines)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Feed spark events to a running diagram (--events) for testing.
+
+Either replays a recorded event file, paced by its timestamps, or generates
+synthetic Poisson traffic at a given rate over random connections. Events
+are written in batches every --batch-ms to a UNIX socket (as a client), a
+named pipe, a file (appended, for --events file:PATH) or stdout.
+
+Usage:
+    python blocks.py --events unix:/tmp/blocks.sock &
+    python event_replay.py unix:/tmp/blocks.sock --rate 100000 --connections 67 --duration 10
+    python event_replay.py unix:/tmp/blocks.sock --input spikes.txt --speed 2 --loop
+    python event_replay.py - --rate 1000 --connections 20 | python cerebellum.py --events -
+"""
+
+import argparse
+import socket
+import sys
+import time
+
+import numpy as np
+
+from event_feed import FORMATS, RECORD, EventDecoder, parse_source
+
+
+def open_target(spec):
+    """Binary writer for a target spec: unix:PATH, fifo:PATH, file:PATH or - (stdout)."""
+    kind, path = parse_source(spec)
+    if kind == "stdin":
+        return sys.stdout.buffer
+    if kind == "unix":
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        return sock.makefile("wb")
+    if kind == "fifo":
+        return open(path, "wb")  # waits for the reader
+    return open(path, "ab")
+
+
+def encode(conn, timestamp, intensity, fmt):
+    if fmt == "binary":
+        records = np.empty(len(conn), RECORD)
+        records["conn"], records["time"], records["intensity"] = conn, timestamp, intensity
+        return records.tobytes()
+    return "".join(map("{} {:.6f} {:g}\n".format, conn.tolist(), timestamp.tolist(), intensity.tolist())).encode()
+
+
+def read_events(path, fmt):
+    """Every record of a recorded event file as (conn, time, intensity) arrays, in time order."""
+    decoder = EventDecoder(fmt)
+    with open(path, "rb") as f:
+        conn, timestamp, intensity = decoder.feed(f.read() + (b"\n" if fmt == "text" else b""))
+    order = np.argsort(timestamp, kind="stable")
+    return conn[order], timestamp[order], intensity[order]
+
+
+def synthetic(rate, connections, batch, rng, intensity=1.0):
+    """One batch of Poisson traffic: about rate * batch events spread over the batch interval."""
+    n = rng.poisson(rate * batch)
+    now = time.time()
+    stamps = now - batch + np.sort(rng.random(n)) * batch
+    return rng.integers(0, connections, n), stamps, np.full(n, intensity)
+
+
+def main():
+    p = argparse.ArgumentParser(description="Send spark events to a diagram started with --events")
+    p.add_argument("target", help="unix:PATH, fifo:PATH, file:PATH (append) or - (stdout)")
+    p.add_argument("--format", choices=FORMATS, default="text", help="Wire format (default text)")
+    p.add_argument("--input", default=None, help="Replay this recorded event file instead of synthetic traffic")
+    p.add_argument("--input-format", choices=FORMATS, default=None, help="Format of --input (default --format)")
+    p.add_argument("--speed", type=float, default=1.0, help="Replay speed factor (default 1)")
+    p.add_argument("--loop", action="store_true", help="Replay --input forever")
+    p.add_argument("--rate", type=float, default=1000.0, help="Synthetic events per second (default 1000)")
+    p.add_argument("--connections", type=int, default=None, help="Synthetic: connection indices 0..N-1")
+    p.add_argument("--intensity", type=float, default=1.0, help="Synthetic: intensity of every event (default 1)")
+    p.add_argument("--duration", type=float, default=0.0, help="Stop after this many seconds (0 = never)")
+    p.add_argument("--batch-ms", type=float, default=5.0, help="Write interval in ms (default 5)")
+    p.add_argument("--seed", type=int, default=None, help="Seed for the synthetic traffic")
+    args = p.parse_args()
+    if args.input is None and not args.connections:
+        p.error("give --input or --connections for synthetic traffic")
+
+    batch = args.batch_ms / 1000.0
+    rng = np.random.default_rng(args.seed)
+    out = open_target(args.target)
+    if args.input:
+        conn, timestamp, intensity = read_events(args.input, args.input_format or args.format)
+        if not len(conn):
+            p.error(f"{args.input}: no events")
+        offsets = (timestamp - timestamp[0]) / args.speed  # seconds into the replay
+        span = offsets[-1] + batch  # one lap, for --loop
+    sent = 0
+    start = lap_start = tick = time.perf_counter()
+    cursor = 0
+    try:
+        while not args.duration or tick - start < args.duration:
+            tick += batch
+            delay = tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            if args.input:
+                if cursor >= len(conn):
+                    if not args.loop:
+                        break
+                    cursor, lap_start = 0, lap_start + span
+                # Everything whose offset has come due, stamped with the wall-clock time it was due
+                played = time.perf_counter() - lap_start
+                due = np.searchsorted(offsets, played, side="right")
+                if due <= cursor:
+                    continue
+                c, i = conn[cursor:due], intensity[cursor:due]
+                t = time.time() - (played - offsets[cursor:due])
+                cursor = due
+            else:
+                c, t, i = synthetic(args.rate, args.connections, batch, rng, args.intensity)
+            if len(c):
+                out.write(encode(c, t, i, args.format))
+                out.flush()
+                sent += len(c)
+    except (BrokenPipeError, ConnectionResetError):
+        print("Receiver went away", file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        try:
+            out.close()
+        except OSError:
+            pass
+    seconds = time.perf_counter() - start
+    print(f"Sent {sent} events in {seconds:.2f} s ({sent / max(seconds, 1e-9):.0f}/s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
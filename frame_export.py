@@ -0,0 +1,219 @@
+"""
+Frame export sinks used by blocks_lib.
+
+Sinks take raw RGB24 frames (bytes, width * height * 3) so that the render loop
+only pays for a pixel copy; compression and disk I/O happen elsewhere.
+
+- PngSequenceWriter: numbered PNG files, encoded on a thread pool
+- FfmpegWriter:      raw frames piped into a local ffmpeg process (MP4 / GIF)
+- PillowGifWriter:   pure-Python GIF fallback when ffmpeg is not installed
+"""
+
+import os
+import queue
+import shutil
+import struct
+import subprocess
+import threading
+import time
+import zlib
+
+import numpy as np
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def _png_chunk(tag, data):
+    crc = zlib.crc32(tag + data) & 0xFFFFFFFF
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", crc)
+
+
+def encode_png(rgb, width, height, level=6):
+    """
+    Encode raw RGB24 pixels as a PNG file image (bytes).
+    Every row uses the 'Sub' filter, which suits flat diagram backgrounds.
+    """
+    rows = np.frombuffer(rgb, dtype=np.uint8).reshape(height, width * 3)
+    filtered = np.empty((height, width * 3 + 1), dtype=np.uint8)
+    filtered[:, 0] = 1  # filter type: Sub
+    filtered[:, 1:4] = rows[:, :3]
+    np.subtract(rows[:, 3:], rows[:, :-3], out=filtered[:, 4:])
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)  # 8-bit RGB
+    return (PNG_SIGNATURE
+            + _png_chunk(b"IHDR", header)
+            + _png_chunk(b"IDAT", zlib.compress(filtered.tobytes(), level))
+            + _png_chunk(b"IEND", b""))
+
+
+class PngSequenceWriter:
+    """
+    Writes PREFIX000001.png, PREFIX000002.png, ... from a pool of worker threads.
+
+    write() only queues the raw frame. The queue is bounded (max_pending), so a
+    renderer that outruns the encoders blocks there instead of growing memory.
+    zlib and numpy release the GIL, so the workers encode in parallel with the
+    render loop. close() flushes every queued frame and reports throughput.
+    """
+    def __init__(self, prefix, start_index=1, workers=None, max_pending=None, level=6):
+        self.prefix = prefix
+        self.index = start_index
+        self.level = level
+        self.workers = max(1, workers or min(4, os.cpu_count() or 1))
+        self.max_pending = max(1, max_pending or 2 * self.workers)
+        self.frames = 0
+        self.bytes_written = 0
+        self._queue = queue.Queue(maxsize=self.max_pending)
+        self._error = None
+        self._lock = threading.Lock()
+        self._started = None
+        self._threads = [threading.Thread(target=self._work, name=f"png-encoder-{i}", daemon=True)
+                         for i in range(self.workers)]
+        for t in self._threads:
+            t.start()
+
+    def write(self, rgb, size):
+        """Queue one RGB24 frame of the given (width, height); blocks when the queue is full."""
+        if self._error:
+            raise self._error
+        if self._started is None:
+            self._started = time.perf_counter()
+        self._queue.put((f"{self.prefix}{self.index:06d}.png", rgb, size))
+        self.index += 1
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            filename, rgb, (w, h) = item
+            try:
+                data = encode_png(rgb, w, h, self.level)
+                with open(filename, "wb") as f:
+                    f.write(data)
+                with self._lock:
+                    self.frames += 1
+                    self.bytes_written += len(data)
+            except Exception as e:  # surfaced on the next write()/close()
+                self._error = self._error or e
+
+    def close(self):
+        """Flush pending frames, stop the workers and print the achieved throughput."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        if self._error:
+            raise self._error
+        if self.frames:
+            seconds = time.perf_counter() - self._started
+            print(f"Encoded {self.frames} PNG frames in {seconds:.2f} s "
+                  f"({self.frames / seconds:.1f} frames/sec, {self.workers} workers, "
+                  f"{self.bytes_written / 1e6:.1f} MB)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Output options per preset; the input side is always rawvideo rgb24 on stdin
+FFMPEG_PRESETS = {
+    # H.264 needs even dimensions for yuv420p
+    "mp4": ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-c:v", "libx264", "-preset", "medium",
+            "-crf", "18", "-pix_fmt", "yuv420p", "-movflags", "+faststart"],
+    # One pass: split the stream, build the palette from one copy, apply it to the other
+    "gif": ["-filter_complex", "[0:v]split[a][b];[a]palettegen=stats_mode=diff[p];[b][p]paletteuse",
+            "-loop", "0"],
+}
+
+
+class FfmpegWriter:
+    """
+    Streams raw RGB frames to the stdin of a local ffmpeg process.
+    No intermediate PNGs are written; ffmpeg encodes straight to `output`.
+    """
+    def __init__(self, output, size, fps, preset="mp4", ffmpeg="ffmpeg"):
+        w, h = size
+        self.output = output
+        self.size = size
+        self.frames = 0
+        cmd = [ffmpeg, "-hide_banner", "-loglevel", "error", "-y",
+               "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{w}x{h}", "-framerate", f"{fps:g}",
+               "-i", "-", *FFMPEG_PRESETS[preset], output]
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        self._started = time.perf_counter()
+
+    def write(self, rgb, size):
+        if size != self.size:
+            raise ValueError(f"frame size {size} does not match stream size {self.size}")
+        try:
+            self._proc.stdin.write(rgb)
+        except BrokenPipeError:
+            raise RuntimeError(f"ffmpeg exited early (code {self._proc.wait()})") from None
+        self.frames += 1
+
+    def close(self):
+        self._proc.stdin.close()
+        code = self._proc.wait()
+        if code:
+            raise RuntimeError(f"ffmpeg failed with exit code {code}")
+        seconds = time.perf_counter() - self._started
+        print(f"Streamed {self.frames} frames to {self.output} via ffmpeg in {seconds:.2f} s")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PillowGifWriter:
+    """
+    Pure-Python GIF writer for machines without ffmpeg (requires Pillow).
+    All frames share one adaptive palette built from the first frame, and are
+    kept palettized (1 byte per pixel) until close() writes the file.
+    """
+    def __init__(self, output, size, fps):
+        try:
+            from PIL import Image  # optional, and only loaded for the GIF fallback
+        except ImportError:
+            raise RuntimeError("the GIF fallback needs Pillow: pip install Pillow") from None
+        self._image = Image
+        self.output = output
+        self.size = size
+        self.duration = max(20, int(round(1000.0 / fps)))  # ms; most viewers clamp below 20
+        self.frames = []
+        self._palette = None
+        self._started = time.perf_counter()
+
+    def write(self, rgb, size):
+        img = self._image.frombytes("RGB", size, rgb)
+        if self._palette is None:
+            self._palette = img.quantize(colors=256)
+        self.frames.append(img.quantize(palette=self._palette, dither=0))
+
+    def close(self):
+        if self.frames:
+            first, rest = self.frames[0], self.frames[1:]
+            first.save(self.output, save_all=True, append_images=rest,
+                       duration=self.duration, loop=0, optimize=False)
+        seconds = time.perf_counter() - self._started
+        print(f"Wrote {len(self.frames)} frames to {self.output} with Pillow in {seconds:.2f} s")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_video_writer(preset, output, size, fps, ffmpeg="ffmpeg"):
+    """FfmpegWriter if ffmpeg is on PATH; for GIFs fall back to Pillow otherwise."""
+    exe = shutil.which(ffmpeg)
+    if exe:
+        return FfmpegWriter(output, size, fps, preset, exe)
+    if preset == "gif":
+        print(f"{ffmpeg} not found; writing the GIF with Pillow")
+        return PillowGifWriter(output, size, fps)
+    raise RuntimeError(f"{ffmpeg} not found on PATH; it is required for {preset} output")
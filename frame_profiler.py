@@ -0,0 +1,138 @@
+"""
+Per-phase frame timing for blocks_lib (--profile).
+
+A frame is split into named phases with lap(): each call charges the time
+since the previous lap (or begin_frame()) to that phase, so instrumenting a
+loop costs one clock read per phase. FrameProfiler keeps rolling percentiles
+for the on-screen panel and a per-frame record that dump() writes on exit as
+a Chrome trace (chrome://tracing, https://ui.perfetto.dev) or as CSV.
+"""
+
+import csv
+import json
+import time
+from collections import deque
+
+import numpy as np
+
+PHASES = ("events", "grid", "blocks", "curves", "sparks", "hud", "save", "flip")
+COUNTERS = ("live_sparks", "draw_calls", "feed_events", "feed_coalesced")
+
+
+class NullProfiler:
+    """Stand-in with the FrameProfiler interface that records nothing."""
+    enabled = False
+
+    def begin_frame(self):
+        pass
+
+    def lap(self, phase):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def end_frame(self):
+        pass
+
+
+class FrameProfiler:
+    """
+    Records, per frame, the time spent in each phase plus counters
+    (live_sparks, draw_calls). Percentiles cover the last `window` frames;
+    the trace keeps the last `keep` frames (about 5 minutes at 120 FPS).
+    """
+    enabled = True
+
+    def __init__(self, window=240, keep=36000):
+        self.window = window
+        self.frames = deque(maxlen=keep)  # (start, duration, laps, counters)
+        self._origin = time.perf_counter()
+        self._start = self._last = None
+        self._laps = []
+        self._counts = {}
+
+    def begin_frame(self):
+        self._start = self._last = time.perf_counter()
+        self._laps = []
+        self._counts = {}
+
+    def lap(self, phase):
+        """Charge the time since the previous lap to phase."""
+        if self._start is None:
+            return
+        now = time.perf_counter()
+        self._laps.append((phase, self._last, now - self._last))
+        self._last = now
+
+    def count(self, name, n=1):
+        self._counts[name] = self._counts.get(name, 0) + n
+
+    def end_frame(self):
+        if self._start is None:
+            return
+        self.frames.append((self._start, self._last - self._start, self._laps, self._counts))
+        self._start = None
+
+    def phase_ms(self, frames=None):
+        """{phase: per-frame milliseconds} (phases summed within a frame), plus 'frame' totals."""
+        frames = list(self.frames)[-self.window:] if frames is None else frames
+        out = {phase: np.zeros(len(frames)) for phase in PHASES}
+        out["frame"] = np.array([duration for _, duration, _, _ in frames]) * 1000.0
+        for i, (_, _, laps, _) in enumerate(frames):
+            for phase, _, seconds in laps:
+                out.setdefault(phase, np.zeros(len(frames)))[i] += seconds * 1000.0
+        return out
+
+    def summary(self):
+        """{phase: (p50, p95, p99) ms} over the rolling window."""
+        if not self.frames:
+            return {}
+        return {phase: tuple(np.percentile(ms, (50, 95, 99)))
+                for phase, ms in self.phase_ms().items()}
+
+    def lines(self):
+        """Text lines for the on-screen panel."""
+        stats = self.summary()
+        if not stats:
+            return []
+        lines = [f"{'phase':<7}{'p50':>7}{'p95':>7}{'p99':>7} ms"]
+        for phase in PHASES + ("frame",):
+            p50, p95, p99 = stats[phase]
+            lines.append(f"{phase:<7}{p50:7.2f}{p95:7.2f}{p99:7.2f}")
+        counts = self.frames[-1][3]
+        lines.append("  ".join(f"{name} {counts.get(name, 0)}" for name in COUNTERS))
+        return lines
+
+    def dump(self, path):
+        """Write the recorded frames: CSV for *.csv, otherwise Chrome trace JSON."""
+        if path.lower().endswith(".csv"):
+            self._dump_csv(path)
+        else:
+            self._dump_trace(path)
+        print(f"Wrote frame profile of {len(self.frames)} frames to {path}")
+
+    def _dump_csv(self, path):
+        frames = list(self.frames)
+        ms = self.phase_ms(frames)
+        with open(path, "w", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(["frame", "start_ms", "frame_ms", *PHASES, *COUNTERS])
+            for i, (start, _, _, counts) in enumerate(frames):
+                w.writerow([i, f"{(start - self._origin) * 1000.0:.3f}", f"{ms['frame'][i]:.3f}",
+                            *(f"{ms[phase][i]:.3f}" for phase in PHASES),
+                            *(counts.get(name, 0) for name in COUNTERS)])
+
+    def _dump_trace(self, path):
+        us = lambda t: round((t - self._origin) * 1e6, 1)
+        events = []
+        for i, (start, duration, laps, counts) in enumerate(self.frames):
+            events.append({"name": "frame", "cat": "frame", "ph": "X", "pid": 1, "tid": 1,
+                           "ts": us(start), "dur": round(duration * 1e6, 1), "args": {"frame": i}})
+            for phase, t0, seconds in laps:
+                events.append({"name": phase, "cat": "phase", "ph": "X", "pid": 1, "tid": 2,
+                               "ts": us(t0), "dur": round(seconds * 1e6, 1)})
+            events.append({"name": "counts", "ph": "C", "pid": 1, "ts": us(start),
+                           "args": {name: counts.get(name, 0) for name in COUNTERS}})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
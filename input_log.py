@@ -0,0 +1,142 @@
+"""
+Recorded input sessions for blocks_lib: --record-input writes the mouse and
+keyboard events of an interactive run, --replay-input plays them back
+headlessly at a fixed time step.
+
+A log is JSON lines: a header ({"input_log": 1, "size", "fps", "seed", "fit",
+"flatten_tolerance"}), one record per event ({"t", "type", ...} with t the
+elapsed seconds of the frame that handled it), and a trailer with the final
+positions of everything draggable, blocks then notes ({"final": [[x, y],
+...], "labels": [...]}), which a replay asserts on. A replay also renders at
+the recorded flatten_tolerance. Record types:
+
+- down / up:  button, pos (screen px)
+- move:       pos, rel
+- wheel:      y, pos (cursor at the time)
+- key:        key (pygame.key.name: "f", "0", "home", ...)
+- quit
+
+Records are plain dicts of pygame-independent values (key names, screen
+positions), so synthetic sessions (drag_session) can be written by
+benchmarks and tests without a display.
+"""
+
+import json
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+
+class InputRecorder:
+    """Appends records to a log as they happen; close(blocks) writes the final positions (blocks and notes)."""
+
+    def __init__(self, path, size, fps, seed=None, fit=False, flatten_tolerance=None):
+        self.path = path
+        self.f = open(path, "w")
+        self.count = 0
+        self._line(dict(input_log=FORMAT_VERSION, size=list(size), fps=fps, seed=seed, fit=fit,
+                        flatten_tolerance=flatten_tolerance))
+
+    def _line(self, obj):
+        self.f.write(json.dumps(obj, separators=(",", ":")) + "\n")
+
+    def write(self, t, record):
+        self._line(dict(record, t=round(t, 6)))
+        self.count += 1
+
+    def close(self, blocks):
+        self._line(dict(final=[[b.rect.x, b.rect.y] for b in blocks], labels=[b.label for b in blocks]))
+        self.f.close()
+
+
+class InputLog:
+    """A recorded session: header fields, records in time order and the final positions (or None)."""
+
+    def __init__(self, header, records, final=None, labels=None):
+        if header.get("input_log") != FORMAT_VERSION:
+            raise ValueError(f"not an input log of format version {FORMAT_VERSION}")
+        self.header = header
+        self.records = sorted(records, key=lambda r: r["t"])
+        self.final = final
+        self.labels = labels
+
+    @property
+    def size(self):
+        return tuple(self.header.get("size") or ())
+
+    @property
+    def fps(self):
+        return self.header.get("fps")
+
+    @property
+    def duration(self):
+        return self.records[-1]["t"] if self.records else 0.0
+
+    @classmethod
+    def load(cls, path):
+        header, records, final, labels = None, [], None, None
+        with open(path) as f:
+            for n, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                obj = json.loads(line)
+                if header is None:
+                    header = obj
+                elif "final" in obj:
+                    final, labels = obj["final"], obj.get("labels")
+                elif "type" in obj and "t" in obj:
+                    records.append(obj)
+                else:
+                    raise ValueError(f"{path}:{n}: not an input record")
+        if header is None:
+            raise ValueError(f"{path}: empty input log")
+        return cls(header, records, final, labels)
+
+    def save(self, path):
+        with open(path, "w") as f:
+            for obj in [self.header, *self.records] + ([dict(final=self.final, labels=self.labels)]
+                                                       if self.final is not None else []):
+                f.write(json.dumps(obj, separators=(",", ":")) + "\n")
+
+
+def check_positions(blocks, final, labels=None):
+    """Differences between the blocks' positions and a recorded list of [x, y]; empty when they match."""
+    if final is None:
+        return []
+    if len(final) != len(blocks):
+        return [f"scene has {len(blocks)} blocks, the recording {len(final)}"]
+    problems = []
+    for i, (block, (x, y)) in enumerate(zip(blocks, final)):
+        if (block.rect.x, block.rect.y) != (x, y):
+            name = labels[i] if labels else block.label
+            problems.append(f"block {i} {name!r}: at ({block.rect.x}, {block.rect.y}), recorded ({x}, {y})")
+    return problems
+
+
+def percentiles(ms):
+    """mean/p50/p95/p99/max of frame times in ms (None when there are none)."""
+    if not len(ms):
+        return None
+    ms = np.asarray(ms, dtype=float)
+    p50, p95, p99 = np.percentile(ms, (50, 95, 99))
+    return dict(mean=round(float(ms.mean()), 3), p50=round(float(p50), 3), p95=round(float(p95), 3),
+                p99=round(float(p99), 3), max=round(float(ms.max()), 3))
+
+
+def drag_session(grab, path, fps, size, hold=0.1, seed=None, fit=False):
+    """
+    Synthetic log: press at screen point grab, move through the points of
+    path one frame apart, release. For interaction benchmarks.
+    """
+    dt = 1.0 / fps
+    t = dt
+    records = [dict(type="down", button=1, pos=list(grab), t=t)]
+    last = grab
+    for point in path:
+        t += dt
+        point = [int(round(point[0])), int(round(point[1]))]
+        records.append(dict(type="move", pos=point, rel=[point[0] - last[0], point[1] - last[1]], t=t))
+        last = point
+    records.append(dict(type="up", button=1, pos=list(last), t=t + hold))
+    return InputLog(dict(input_log=FORMAT_VERSION, size=list(size), fps=fps, seed=seed, fit=fit), records)
@@ -20,8 +20,8 @@ setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     url="https://github.com/kintaroai/neuro-flow",
-    py_modules=["blocks_lib"],
-    scripts=["blocks.py", "cerebellum.py"],
+    py_modules=["blocks_core", "blocks_lib", "diagram_file", "diagram_store", "event_feed", "frame_export", "frame_profiler", "input_log"],
+    scripts=["blocks.py", "cerebellum.py", "diagram.py", "event_replay.py"],
     classifiers=[
         "Development Status :: 4 - Beta",
         "Intended Audience :: Developers",
@@ -50,6 +50,7 @@ setup(
         "console_scripts": [
             "neuro-flow-blocks=blocks:main",
             "neuro-flow-cerebellum=cerebellum:main",
+            "neuro-flow-diagram=diagram:main",
         ],
     },
 )
@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+from diagram_file import PALETTE, parse_color, read_json
+
+
+def load(tmp_path, diagram):
+    path = tmp_path / "diagram.json"
+    path.write_text(json.dumps(diagram))
+    return read_json(str(path))
+
+
+@pytest.mark.parametrize("value, rgb", [
+    ([1, 2, 3], (1, 2, 3)),
+    ("#102030", (16, 32, 48)),
+    ("#fff", (255, 255, 255)),
+    ("rgb(10, 20, 30)", (10, 20, 30)),
+    ("rgba(10,20,30,0.5)", (10, 20, 30)),
+    ("rgb(100%, 0%, 0%)", (255, 0, 0)),
+    ("motor", (171, 71, 188)),
+])
+def test_parse_color(value, rgb):
+    assert parse_color(value, PALETTE) == rgb
+
+
+def test_unknown_colors_fall_back():
+    assert parse_color("rgb(1, 2)", PALETTE, default=(9, 9, 9)) == (9, 9, 9)
+    assert parse_color("#12345g", PALETTE, default=(9, 9, 9)) == (9, 9, 9)
+
+
+def test_aliases_follow_js_priority_not_file_order(tmp_path):
+    data = load(tmp_path, {
+        "nodes": [{"id": "x"}],
+        "edges": [],
+        "blocks": [{"id": "a", "x": 0, "y": 0, "w": 10, "h": 10}],
+        "connections": [{"from": "a", "to": "a"}],
+    })
+    assert data.block_id.tolist() == ["a"]
+    assert data.n_connections == 1
+
+
+def test_numeric_ids_match_string_ids(tmp_path):
+    data = load(tmp_path, {
+        "blocks": [{"id": 1, "x": 0, "y": 0, "w": 10, "h": 10}, {"id": "2", "x": 50, "y": 0, "w": 10, "h": 10}],
+        "connections": [{"from": "1", "to": 2}, {"from": 1.0, "to": "2", "color": "thal"}],
+    })
+    assert data.start.tolist() == [0, 0] and data.end.tolist() == [1, 1]
+    assert data.color[1].tolist() == [1, 87, 155]
@@ -0,0 +1,72 @@
+import numpy as np
+
+from event_feed import RECORD, EventDecoder, EventFeed
+
+
+def test_text_records():
+    conn, timestamp, intensity = EventDecoder("text").feed(b"1 0.5 2\n3,1.5,1\n")
+    assert conn.tolist() == [1, 3]
+    assert timestamp.tolist() == [0.5, 1.5]
+    assert intensity.tolist() == [2.0, 1.0]
+
+
+def test_partial_record_waits_for_next_chunk():
+    decoder = EventDecoder("text")
+    assert len(decoder.feed(b"1 0.5 2\n4 2.")[0]) == 1
+    conn, timestamp, _ = decoder.feed(b"5 1\n")
+    assert conn.tolist() == [4] and timestamp.tolist() == [2.5]
+
+
+def test_lines_with_wrong_field_counts_are_malformed():
+    # Six fields over two lines: the totals match 3 per line, the lines do not
+    decoder = EventDecoder("text")
+    conn, timestamp, intensity = decoder.feed(b"1 2\n3 4 5 6\n7 0.25 1\n")
+    assert conn.tolist() == [7]
+    assert timestamp.tolist() == [0.25]
+    assert decoder.malformed == 2
+
+
+def test_comments_and_blank_lines():
+    decoder = EventDecoder("text")
+    conn, _, _ = decoder.feed(b"# header\n\n2 1.0 1\n")
+    assert conn.tolist() == [2] and decoder.malformed == 0
+
+
+def test_binary_records():
+    records = np.zeros(2, RECORD)
+    records["conn"], records["time"], records["intensity"] = [5, 6], [1.0, 2.0], [1.0, 3.0]
+    data = records.tobytes()
+    decoder = EventDecoder("binary")
+    assert len(decoder.feed(data[:20])[0]) == 1
+    conn, timestamp, intensity = decoder.feed(data[20:])
+    assert conn.tolist() == [6] and timestamp.tolist() == [2.0] and intensity.tolist() == [3.0]
+
+
+class FakeSparks:
+    def __init__(self, n_connections):
+        self.connections = [None] * n_connections
+
+    def inject(self, counts):
+        return int(counts.sum())
+
+
+def batch(conn, intensity=1.0):
+    conn = np.asarray(conn, dtype=np.intp)
+    return conn, np.arange(len(conn), dtype=float), np.full(len(conn), intensity)
+
+
+def test_drop_oldest_keeps_the_tail_of_an_oversize_batch():
+    feed = EventFeed("-", max_pending=4)
+    feed._push(batch([0, 1]))
+    feed._push(batch([2, 3, 4, 5, 6, 7]))
+    conn, timestamp, _ = feed.drain()
+    assert conn.tolist() == [4, 5, 6, 7] and timestamp.tolist() == [2, 3, 4, 5]
+    assert feed.overload == 4 and feed.received == 8 and feed.pending == 0
+
+
+def test_coalesced_events_are_counted():
+    feed = EventFeed("-", max_per_frame=2)
+    feed._push(batch([0, 0, 0, 0, 1, 2, 2], 0.5))
+    assert feed.consume(FakeSparks(3)) == 7
+    # conn 0: 4 events, 2 sparks; conn 1: 1 event, 1 spark; conn 2: 2 events, 1 spark
+    assert feed.rendered == 4 and feed.coalesced == 3 and feed.dropped == 0
@@ -0,0 +1,89 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import blocks
+from blocks_lib import Interaction, init_screen, offline_renderer, parse_args, run_input_replay, scene_index
+from input_log import drag_session
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def replay_scene():
+    args = parse_args(["--offline", "--max-frames", "1", "--seed", "7"])
+    screen = init_screen(args, (blocks.WIDTH, blocks.HEIGHT))
+    scene_blocks, connections, notes = blocks.build_scene(args)
+    sparks, renderer = offline_renderer(screen, scene_blocks, connections, notes, args)
+    interaction = Interaction(renderer, scene_index(scene_blocks + notes, connections), sparks)
+    return scene_blocks, connections, sparks, renderer, interaction
+
+
+def test_move_and_release_in_one_frame_refresh_sparks_and_culling():
+    scene_blocks, connections, sparks, renderer, interaction = replay_scene()
+    block = scene_blocks[0]
+    start = block.rect.topleft
+    grab = block.rect.center
+    drop = (grab[0] + 40, grab[1] + 25)
+    # Frame 1: press. Frame 2: the last move and the release arrive together.
+    interaction.handle(dict(type="down", button=1, pos=list(grab)))
+    interaction.refresh()
+    renderer.render(1 / 60, 1 / 60)
+    interaction.handle(dict(type="move", pos=list(drop), rel=[40, 25]))
+    interaction.handle(dict(type="up", button=1, pos=list(drop)))
+    interaction.refresh()
+    renderer.render(2 / 60, 1 / 60)
+
+    assert block.rect.topleft == (start[0] + 40, start[1] + 25)
+    rows = [sparks.index[conn] for conn in block.connections]
+    assert rows
+    for row, conn in zip(rows, block.connections):
+        np.testing.assert_allclose(sparks.arc_points[row], conn.arc_table()[2])
+        np.testing.assert_allclose(renderer.bounds[row], conn.bounds())
+    assert interaction.index.pick_block(drop) is block
+
+
+def drag_log(path, dx, dy, same_frame=False):
+    """drag_session moving the Thalamus block by (dx, dy), with the final positions it should leave."""
+    scene_blocks, _, notes = blocks.build_scene(parse_args([]))
+    block = scene_blocks[0]
+    grab = block.rect.center
+    steps = 10
+    moves = [(grab[0] + dx * i / steps, grab[1] + dy * i / steps) for i in range(1, steps + 1)]
+    log = drag_session(grab, moves, 60, (blocks.WIDTH, blocks.HEIGHT), seed=7)
+    if same_frame:
+        log.records[-1]["t"] = log.records[-2]["t"]  # the release lands in the last move's frame
+    final = [[b.rect.x, b.rect.y] for b in scene_blocks + notes]
+    final[0] = [block.rect.x + dx, block.rect.y + dy]
+    log.final, log.labels = final, [b.label for b in scene_blocks + notes]
+    log.save(path)
+    return log
+
+
+def replay(path):
+    args = parse_args(["--replay-input", str(path)])
+    screen = init_screen(args, (blocks.WIDTH, blocks.HEIGHT))
+    scene_blocks, connections, notes = blocks.build_scene(args)
+    return run_input_replay(screen, scene_blocks, connections, notes, args)
+
+
+@pytest.mark.parametrize("same_frame", [False, True])
+def test_replayed_drag_ends_where_recorded(tmp_path, same_frame):
+    path = tmp_path / "drag.jsonl"
+    drag_log(path, 60, 30, same_frame)
+    report = replay(path)
+    assert report["positions_ok"], report["problems"]
+    assert report["interaction"] is not None
+
+
+def test_replay_exit_status(tmp_path):
+    good, bad = tmp_path / "good.jsonl", tmp_path / "bad.jsonl"
+    drag_log(good, 60, 30, same_frame=True)
+    log = drag_log(bad, 60, 30)
+    log.final[0][0] += 1
+    log.save(bad)
+    script = os.path.join(ROOT, "blocks.py")
+    assert subprocess.run([sys.executable, script, "--replay-input", str(good)], capture_output=True).returncode == 0
+    assert subprocess.run([sys.executable, script, "--replay-input", str(bad)], capture_output=True).returncode == 1